@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+b'This script requires python 3.4'
+
+"""
+Benchmark of the hot path of crawlerHPSS.py on synthetic HPSS listings
+and tar table-of-contents.
+
+For detailed documentation, see: ReadMe.md
+"""
+
+import sys
+import os
+import json
+import math
+import time
+import shutil
+import argparse
+import resource
+import subprocess
+import contextlib
+
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from crawlerHPSS import hpssUtil, HPSS_BASE_FOLDER, PICO_FOLDERS
+from commandUtil import getCaptureFileName
+from mongoUtil import ensureIndexes
+import mongoMemory
+
+##############################################
+# -- GLOBAL CONSTANTS
+
+BENCH_SCALES  = [100000, 1000000, 10000000]
+BENCH_STAGES  = ['parseLine', 'makePicoDstDoc', 'insertPicoDsts', 'crawl']
+BENCH_DB_NAME = 'SDMS_Benchmark'
+
+CHUNK_SIZE         = 100000  # number of entries generated at once - not timed
+INSERT_BULK_SIZE   = 10000   # same as the bulk of picoDsts in crawlerHPSS.py
+
+FILES_PER_RUN = 50
+DAYS_PER_YEAR = 365
+
+TAR_FRACTION  = 0.5  # fraction of production days stored in tar files
+
+DAYS_PER_TAPE = 10   # production days on one tape volume
+
+# -- runyear, system, energy, trigger, production
+#    production None -> 7 token variant without production
+DATASETS = [
+    ('Run10', 'AuAu', '11GeV',  'all',      None),
+    ('Run10', 'AuAu', '39GeV',  'all',      'P10ik'),
+    ('Run11', 'AuAu', '200GeV', 'all',      'P11id'),
+    ('Run14', 'AuAu', '200GeV', 'physics2', 'P15ic'),
+    ('Run16', 'AuAu', '200GeV', 'all',      'P16ij'),
+    ('Run16', 'dAu',  '200GeV', 'all',      'P17id'),
+]
+
+STREAMS = ['st_physics', 'st_physics_adc', 'st_hlt', 'st_mtd']
+
+PROJECT_BASE_FOLDER = '/project/projectdirs/starprod/picodsts'
+
+##############################################
+
+# -- Check for a proper Python Version
+if sys.version[0:3] < '3.0':
+    print ('Python version 3.0 or greater required (found: {0}).'.format(sys.version[0:5]))
+    sys.exit(-1)
+
+# ----------------------------------------------------------------------------------
+class starPathGenerator:
+    """Generator of synthetic STAR picoDst paths.
+
+       The paths follow runyear/system/energy/trigger/production/day/runnumber
+       and the 7 token variant without production. They are generated
+       production day by production day, as they are stored on HPSS.
+       """
+
+    # _________________________________________________________
+    def __init__(self, nFiles):
+        self._nFiles = nFiles
+
+        nRuns = math.ceil(nFiles / FILES_PER_RUN)
+        self._runsPerDay = math.ceil(nRuns / (len(DATASETS) * DAYS_PER_YEAR))
+
+        self._picoFolder = '{0}/{1}'.format(HPSS_BASE_FOLDER, PICO_FOLDERS[0])
+
+    # _________________________________________________________
+    def iterDayPlan(self):
+        """Generator of production days: index, dataset, day and isTar.
+
+           The days are filled with runsPerDay runs, the datasets with
+           DAYS_PER_YEAR days, until nFiles files are reached.
+           """
+
+        nDays = math.ceil(self._nFiles / (self._runsPerDay * FILES_PER_RUN))
+
+        for idxDay in range(nDays):
+            isTar = (idxDay % 100) < TAR_FRACTION * 100
+            yield idxDay, DATASETS[idxDay // DAYS_PER_YEAR], idxDay % DAYS_PER_YEAR + 1, isTar
+
+    # _________________________________________________________
+    def iterDays(self):
+        """Generator of production days: dataset, day, isTar and list of (runnumber, fileNames)."""
+
+        for idxDay, dataset, day, isTar in self.iterDayPlan():
+            yearPrefix = int(dataset[0][3:]) + 1
+            idxFirstFile = idxDay * self._runsPerDay * FILES_PER_RUN
+
+            listRuns = []
+            for idxRun in range(self._runsPerDay):
+                runnumber = yearPrefix * 1000000 + day * 1000 + idxRun
+
+                nFilesRun = min(FILES_PER_RUN, self._nFiles - idxFirstFile - idxRun * FILES_PER_RUN)
+                if nFilesRun <= 0:
+                    break
+
+                listFileNames = ['{0}_{1}_raw_{2:07d}.picoDst.root'.format(STREAMS[idxFile % len(STREAMS)],
+                                                                            runnumber, 1000001 + idxFile)
+                                 for idxFile in range(nFilesRun)]
+                listRuns.append((runnumber, listFileNames))
+
+            yield dataset, day, isTar, listRuns
+
+    # _________________________________________________________
+    def getProductionPath(self, dataset):
+        """Get relative path of production - or trigger for the 7 token variant."""
+
+        return '/'.join([token for token in dataset if token])
+
+    # _________________________________________________________
+    def iterFullPaths(self):
+        """Generator of full HPSS paths of all picoDsts."""
+
+        for dataset, day, isTar, listRuns in self.iterDays():
+            productionPath = self.getProductionPath(dataset)
+            for runnumber, listFileNames in listRuns:
+                for fileName in listFileNames:
+                    yield '{0}/{1}/{2}/{3}/{4}'.format(self._picoFolder, productionPath, day, runnumber, fileName)
+
+    # _________________________________________________________
+    def iterLsBlocks(self):
+        """Generator of blocks of an "ls -lR" listing of all picoDsts.
+
+           Yields block path and the list of lines of the block.
+           """
+
+        for dataset, day, isTar, listRuns in self.iterDays():
+            productionPath = '{0}/{1}'.format(self._picoFolder, self.getProductionPath(dataset))
+
+            for runnumber, listFileNames in listRuns:
+                yield '{0}/{1}/{2}'.format(productionPath, day, runnumber), \
+                    [makeLsLine(fileName, 5103599, isDir=False) for fileName in listFileNames]
+
+    # _________________________________________________________
+    def writeCaptures(self, captureDir):
+        """Write capture files of the hsi/htar calls of a crawl, to be replayed.
+
+           Production days with isTar are stored as <day>.tar with its index,
+           all others as plain files in <day>/<runnumber>.
+
+           Returns number of picoDsts.
+           """
+
+        nFiles = 0
+        openFiles = {}
+
+        def getCapture(cmdLine):
+            if cmdLine not in openFiles:
+                openFiles[cmdLine] = open(os.path.join(captureDir, getCaptureFileName(cmdLine)), 'w')
+            return openFiles[cmdLine]
+
+        # -- Run folders - the listings of empty ones are empty, but not missing
+        captureRuns = getCapture('hsi -q ls -1 {0}'.format(self._picoFolder))
+        for runyear in sorted(set(dataset[0] for dataset in DATASETS)):
+            captureRuns.write('{0}/{1}\n'.format(self._picoFolder, runyear))
+            getCapture('hsi -q ls -lR {0}/{1}'.format(self._picoFolder, runyear))
+            getCapture('hsi -q ls -P -R {0}/{1}'.format(self._picoFolder, runyear))
+
+        # -- Days of each dataset, for the production block
+        datasetDays = {}
+        for idxDay, dataset, day, isTar in self.iterDayPlan():
+            datasetDays.setdefault(dataset, []).append((day, isTar))
+
+        lastDataset = None
+        for idxDay, (dataset, day, isTar, listRuns) in enumerate(self.iterDays()):
+            runFolder = '{0}/{1}'.format(self._picoFolder, dataset[0])
+            productionPath = '{0}/{1}'.format(self._picoFolder, self.getProductionPath(dataset))
+
+            capture = getCapture('hsi -q ls -lR {0}'.format(runFolder))
+            captureTape = getCapture('hsi -q ls -P -R {0}'.format(runFolder))
+            tapeVolume = 'AG{0:06d}'.format(idxDay // DAYS_PER_TAPE)
+            tapeSection = (idxDay % DAYS_PER_TAPE) * FILES_PER_RUN * self._runsPerDay
+
+            # -- Production block: tar files, their indices and day folders
+            if dataset != lastDataset:
+                listLines = []
+                for dayProduction, isTarProduction in datasetDays[dataset]:
+                    if isTarProduction:
+                        listLines.append(makeLsLine('{0}.tar'.format(dayProduction), 13538711552, isDir=False))
+                        listLines.append(makeLsLine('{0}.tar.idx'.format(dayProduction), 1353, isDir=False))
+                    else:
+                        listLines.append(makeLsLine(str(dayProduction), 512, isDir=True))
+                capture.write('{0}:\n{1}\n\n'.format(productionPath, '\n'.join(listLines)))
+                lastDataset = dataset
+
+            if isTar:
+                tarFile = '{0}/{1}.tar'.format(productionPath, day)
+                projectPath = productionPath.replace(self._picoFolder, PROJECT_BASE_FOLDER)
+
+                with open(os.path.join(captureDir, getCaptureFileName('htar -tf {0}'.format(tarFile))), 'w') as captureTar:
+                    for runnumber, listFileNames in listRuns:
+                        for fileName in listFileNames:
+                            captureTar.write('HTAR: -rw-r--r--  starofl/starprod  5103599 2016-04-29 12:00  {0}/{1}/{2}/{3}\n'.format(projectPath, day, runnumber, fileName))
+                    captureTar.write('HTAR: HTAR SUCCESSFUL\n')
+
+                captureTape.write(makeTapeLine(tarFile, 13538711552, tapeVolume, tapeSection))
+
+            else:
+                capture.write('{0}/{1}:\n{2}\n\n'.format(productionPath, day,
+                                                          '\n'.join([makeLsLine(str(runnumber), 512, isDir=True)
+                                                                     for runnumber, listFileNames in listRuns])))
+                for runnumber, listFileNames in listRuns:
+                    capture.write('{0}/{1}/{2}:\n{3}\n\n'.format(productionPath, day, runnumber,
+                                                                 '\n'.join([makeLsLine(fileName, 5103599, isDir=False)
+                                                                            for fileName in listFileNames])))
+                    for fileName in listFileNames:
+                        captureTape.write(makeTapeLine('{0}/{1}/{2}/{3}'.format(productionPath, day, runnumber, fileName),
+                                                       5103599, tapeVolume, tapeSection))
+                        tapeSection += 1
+
+            nFiles += sum([len(listFileNames) for runnumber, listFileNames in listRuns])
+
+        for capture in openFiles.values():
+            capture.close()
+
+        return nFiles
+
+# ____________________________________________________________________________
+def makeLsLine(name, size, isDir):
+    """Make one line of an "hsi ls -l" listing."""
+
+    return '{0} 1 starofl starprod {1:>12} Apr 29 2016 {2}'.format('drwxr-x---' if isDir else '-rw-r-----', size, name)
+
+# ____________________________________________________________________________
+def makeTapeLine(path, size, tapeVolume, tapeSection):
+    """Make one line of an "hsi ls -P" listing."""
+
+    return 'FILE\t{0}\t{1}\t{1}\t{2}+0\t{3}\t5\t0\t1\t04/29/2016\t12:00:00\t04/29/2016\t12:00:00\n'.format(path, size, tapeSection, tapeVolume)
+
+# ____________________________________________________________________________
+def iterChunks(iterable, chunkSize = CHUNK_SIZE):
+    """Generator of lists of chunkSize elements of iterable."""
+
+    chunk = []
+    for element in iterable:
+        chunk.append(element)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+# ____________________________________________________________________________
+def getBenchDB(mongoUri):
+    """Get empty benchmark database with the indices of the SDMS collections.
+
+       Without mongoUri the in-process memory backend is used.
+       """
+
+    client = pymongo.MongoClient(mongoUri) if mongoUri else mongoMemory.getClient()
+    client.drop_database(BENCH_DB_NAME)
+    db = client[BENCH_DB_NAME]
+
+    ensureIndexes(db, ['HPSS_Files', 'HPSS_PicoDsts', 'HPSS_Duplicates', 'HPSS_Checkpoints'], verbose = False)
+
+    return client, db
+
+# ____________________________________________________________________________
+def benchParseLine(nFiles, args):
+    """Time hpssUtil._parseLine - block by block as in _processBlock."""
+
+    hpss = hpssUtil()
+    generator = starPathGenerator(nFiles)
+
+    elapsed = 0.
+    for chunk in iterChunks(generator.iterLsBlocks(), CHUNK_SIZE // FILES_PER_RUN):
+        listBlocks = [(blockPath, [line.encode('utf-8').split(None, 8) for line in listLines])
+                      for blockPath, listLines in chunk]
+
+        start = time.perf_counter()
+        for blockPath, listBlockLines in listBlocks:
+            hpss._currentBlockPath = blockPath
+            for lineTokenized in listBlockLines:
+                hpss._parseLine(lineTokenized)
+        elapsed += time.perf_counter() - start
+
+    return elapsed
+
+# ____________________________________________________________________________
+def benchMakePicoDstDoc(nFiles, args):
+    """Time hpssUtil._makePicoDstDoc."""
+
+    hpss = hpssUtil()
+    generator = starPathGenerator(nFiles)
+
+    elapsed = 0.
+    for chunk in iterChunks(generator.iterFullPaths()):
+        start = time.perf_counter()
+        for fileFullPath in chunk:
+            hpss._makePicoDstDoc(fileFullPath, 5103599)
+        elapsed += time.perf_counter() - start
+
+    return elapsed
+
+# ____________________________________________________________________________
+def benchInsertPicoDsts(nFiles, args):
+    """Time hpssUtil._insertPicoDsts into an empty collection."""
+
+    client, db = getBenchDB(args.mongoUri)
+
+    hpss = hpssUtil()
+    hpss.setCollections(db['HPSS_Files'], db['HPSS_PicoDsts'], db['HPSS_Duplicates'])
+    generator = starPathGenerator(nFiles)
+
+    elapsed = 0.
+    with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+        for chunk in iterChunks(generator.iterFullPaths(), INSERT_BULK_SIZE):
+            listDocs = [hpss._makePicoDstDoc(fileFullPath, 5103599) for fileFullPath in chunk]
+
+            start = time.perf_counter()
+            hpss._insertPicoDsts(listDocs)
+            elapsed += time.perf_counter() - start
+
+    client.drop_database(BENCH_DB_NAME)
+    client.close()
+
+    return elapsed
+
+# ____________________________________________________________________________
+def benchCrawl(nFiles, args):
+    """Time full crawl, replayed from synthetic captures into an empty database."""
+
+    captureDir = os.path.join(args.workDir, 'capture_{0}'.format(nFiles))
+    shutil.rmtree(captureDir, ignore_errors=True)
+    os.makedirs(captureDir)
+
+    starPathGenerator(nFiles).writeCaptures(captureDir)
+
+    client, db = getBenchDB(args.mongoUri)
+
+    hpss = hpssUtil()
+    hpss.setCollections(db['HPSS_Files'], db['HPSS_PicoDsts'], db['HPSS_Duplicates'], db['HPSS_Checkpoints'])
+    hpss.setReplayMode(captureDir)
+
+    with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+        start = time.perf_counter()
+        hpss.getFileList(args.workers, args.htarWorkers)
+        elapsed = time.perf_counter() - start
+
+    nPicoDsts = db['HPSS_PicoDsts'].count_documents({})
+    if nPicoDsts != nFiles:
+        print("Warning: crawl of {0} files ingested {1} picoDsts".format(nFiles, nPicoDsts))
+
+    client.drop_database(BENCH_DB_NAME)
+    client.close()
+    shutil.rmtree(captureDir, ignore_errors=True)
+
+    return elapsed
+
+# ____________________________________________________________________________
+def runStage(stage, nFiles, args):
+    """Run one stage and print its result as json - called in a fresh process."""
+
+    benchStage = {'parseLine': benchParseLine, 'makePicoDstDoc': benchMakePicoDstDoc,
+                  'insertPicoDsts': benchInsertPicoDsts, 'crawl': benchCrawl}[stage]
+
+    elapsed = benchStage(nFiles, args)
+
+    # -- Peak RSS in kB on linux
+    peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({'stage': stage, 'nFiles': nFiles, 'elapsed': elapsed, 'peakRSS': peakRSS}))
+
+# ____________________________________________________________________________
+def main():
+    """initialize and run"""
+
+    parser = argparse.ArgumentParser(description='Benchmark crawlerHPSS.py on synthetic HPSS listings.')
+    parser.add_argument('--scales', type=int, nargs='+', default=BENCH_SCALES,
+                        help='number of files (default: {0})'.format(' '.join(map(str, BENCH_SCALES))))
+    parser.add_argument('--stages', nargs='+', default=BENCH_STAGES, choices=BENCH_STAGES,
+                        help='stages to time (default: all)')
+    parser.add_argument('--mongoUri',
+                        help='mongoDB for the DB stages, i.e. mongodb://localhost:27017 - database {0} is dropped! '
+                             '(default: in-process memory backend)'.format(BENCH_DB_NAME))
+    parser.add_argument('--workDir', default='/tmp/benchCrawlerHPSS',
+                        help='folder for the capture files of the crawl stage')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of run folders crawled in parallel')
+    parser.add_argument('--htarWorkers', type=int, default=1,
+                        help='number of tar files listed in parallel')
+    parser.add_argument('--runStage', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # -- Worker process
+    if args.runStage:
+        runStage(args.runStage, args.scales[0], args)
+        return
+
+    print("{0:<16} {1:>10} {2:>10} {3:>12} {4:>14}".format('stage', 'files', 'time [s]', 'files/sec', 'peak RSS [MB]'))
+
+    # -- Run every stage in its own process - to get its own peak RSS
+    for nFiles in args.scales:
+        for stage in args.stages:
+            cmd = [sys.executable, os.path.abspath(__file__), '--runStage', stage, '--scales', str(nFiles),
+                   '--workDir', args.workDir, '--workers', str(args.workers), '--htarWorkers', str(args.htarWorkers)]
+            if args.mongoUri:
+                cmd += ['--mongoUri', args.mongoUri]
+
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            if p.returncode != 0:
+                print("{0:<16} {1:>10} failed".format(stage, nFiles))
+                continue
+
+            result = json.loads(p.stdout.splitlines()[-1])
+            print("{0:<16} {1:>10} {2:>10.2f} {3:>12.0f} {4:>14.1f}".format(stage, nFiles, result['elapsed'],
+                                                                            nFiles / result['elapsed'],
+                                                                            result['peakRSS'] / 1024.))
+
+# ____________________________________________________________________________
+if __name__ == "__main__":
+    sys.exit(main())
@@ -60,6 +60,7 @@ class cleanXRD:
                           'picoDstJet': 'PicoDstsJets',
                           'aschmah': 'ASchmah'}
 
+        self._dbUtil = dbUtil
         self._addCollections(dbUtil)
 
     # _________________________________________________________
@@ -128,6 +129,7 @@ class cleanXRD:
         idxBasePath = len(XROOTD_BASE)+1
 
         # -- Delete all filese with size 0
+        writer = self._dbUtil.getBulkWriter('cleanXRD')
         for doc in self._collsXRDCorrupt[target].find({'fileSize': 0}):
             fileFullPath = doc['fileFullPath']
 
@@ -147,12 +149,14 @@ class cleanXRD:
 
             # -- Clean up collection if no error occured
             if not errorCode:
-                self._collsXRDCorrupt[target].delete_one({'_id': doc['_id']})
+                writer.deleteOne(self._collsXRDCorrupt[target], {'_id': doc['_id']})
             else:
                 print("Log: ", "Error deleteing", doc['storage']['detail'], ":", fileFullPath)
                 for text in logList:
                     print("Log:   ", text)
 
+        writer.close()
+
         # -- Look at files sizes larger 0
         for doc in self._collsXRDCorrupt[target].find({'fileSize': {"$gt" : 0}}):
             fileFullPath = doc['fileFullPath']
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+b'This script requires python 3.4'
+
+"""
+Run hsi/htar commands of crawlerHPSS.py and stagerSDMS.py, with replay and
+record mode of their output
+
+In replay mode the output of every command is read from its capture file in
+the replay directory - no HPSS access is needed. In record mode the output
+is written in addition to its capture file in the record directory.
+Capture files are named by the URL-quoted command line, see getCaptureFileName,
+a non-zero exit status is kept next to it in '<capture file>.rc'.
+
+Runners can share a semaphore of sessions: every command holds one from
+its start until its output is closed - this caps the number of concurrent
+hsi/htar sessions of a process.
+"""
+
+import os
+import io
+import hashlib
+import shlex, subprocess
+import urllib.parse
+
+
+##############################################
+# -- GLOBAL CONSTANTS
+
+CAPTURE_NAME_MAX_LENGTH = 200  # longer capture file names are replaced by a hash of the command line
+
+##############################################
+
+# ----------------------------------------------------------------------------------
+class commandRunner:
+    """Run commands and return their output - or replay it from capture files."""
+
+    # _________________________________________________________
+    def __init__(self, replayDir = None, recordDir = None, sessions = None):
+        self.replayDir = replayDir
+        self.recordDir = recordDir
+        self.sessions  = sessions
+
+    # _________________________________________________________
+    def run(self, cmdLine, captureKey = None, cwd = None):
+        """Run command and return its output - stdout and stderr - as commandOutput.
+
+           The capture file is named by captureKey - default: the command line.
+           A missing capture file is replayed as empty output of a failed command.
+
+           With shared sessions, waits for a free session - also in replay
+           mode, to replay the concurrency as well. The session is released
+           when the output is closed.
+           """
+
+        captureName = getCaptureFileName(captureKey or cmdLine)
+
+        if self.sessions:
+            self.sessions.acquire()
+
+        try:
+            if self.replayDir:
+                captureFile = os.path.join(self.replayDir, captureName)
+                try:
+                    stream = open(captureFile, 'rb')
+                except IOError:
+                    print("Warning: no capture file for:", cmdLine)
+                    return commandOutput(io.BytesIO(b''), returncode = -1, sessions = self.sessions)
+
+                return commandOutput(stream, returncode = readCaptureReturnCode(captureFile), sessions = self.sessions)
+
+            cmd = shlex.split(cmdLine)
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+
+            captureFile = os.path.join(self.recordDir, captureName) if self.recordDir else None
+            return commandOutput(p.stdout, process = p, captureFile = captureFile, sessions = self.sessions)
+
+        except:
+            if self.sessions:
+                self.sessions.release()
+            raise
+
+# ----------------------------------------------------------------------------------
+class commandOutput:
+    """Output of a command as iterable of lines (bytes).
+
+       The exit status is known after the end of the output or close():
+       returncode and isSuccessful. A replayed command has the recorded exit
+       status, a missing capture file has -1. In record mode the capture file
+       is written only if the output has been read to the end.
+       """
+
+    # _________________________________________________________
+    def __init__(self, stream, process = None, captureFile = None, returncode = None, sessions = None):
+        self._stream = stream
+        self._process = process
+        self._captureFile = captureFile
+        self._capture = None
+        self._isComplete = False
+        self._sessions = sessions
+
+        self.returncode = returncode
+
+        if captureFile:
+            os.makedirs(os.path.dirname(captureFile), exist_ok=True)
+            self._capture = open(captureFile + '.tmp', 'wb')
+
+    # _________________________________________________________
+    def __iter__(self):
+        for line in self._stream:
+            if self._capture:
+                self._capture.write(line)
+            yield line
+
+        self._isComplete = True
+        self.close()
+
+    # _________________________________________________________
+    def __enter__(self):
+        return self
+
+    # _________________________________________________________
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    # _________________________________________________________
+    @property
+    def isSuccessful(self):
+        return self.returncode == 0
+
+    # _________________________________________________________
+    def close(self):
+        """Close output, wait for the command to exit and release its session."""
+
+        if self._stream is None:
+            return
+
+        self._stream.close()
+        self._stream = None
+
+        if self._process:
+            self.returncode = self._process.wait()
+
+        if self._sessions:
+            self._sessions.release()
+
+        if self._capture:
+            self._capture.close()
+            if self._isComplete:
+                writeCaptureReturnCode(self._captureFile, self.returncode)
+                os.replace(self._captureFile + '.tmp', self._captureFile)
+            else:
+                os.remove(self._captureFile + '.tmp')
+
+# ____________________________________________________________________________
+def getCaptureFileName(cmdLine):
+    """Get file name of the capture file of a command line, i.e.
+       'hsi -q ls -lR /nersc/projects/starofl/picodsts/Run10'
+       -> 'hsi%20-q%20ls%20-lR%20%2Fnersc%2Fprojects%2Fstarofl%2Fpicodsts%2FRun10'
+       Too long ones - file name limit - are replaced by 'cmd_<sha1 of cmdLine>'.
+       """
+
+    captureName = urllib.parse.quote(cmdLine, safe='')
+    if len(captureName) > CAPTURE_NAME_MAX_LENGTH:
+        captureName = 'cmd_' + hashlib.sha1(cmdLine.encode('utf-8')).hexdigest()
+
+    return captureName
+
+# ____________________________________________________________________________
+def readCaptureReturnCode(captureFile):
+    """Get exit status of a captured command - kept in '<captureFile>.rc' if not 0."""
+
+    try:
+        with open(captureFile + '.rc') as rcFile:
+            return int(rcFile.read())
+    except (IOError, ValueError):
+        return 0
+
+# ____________________________________________________________________________
+def writeCaptureReturnCode(captureFile, returncode):
+    """Keep exit status of a captured command in '<captureFile>.rc' if not 0."""
+
+    if returncode:
+        with open(captureFile + '.rc', 'w') as rcFile:
+            rcFile.write(str(returncode))
+    elif os.path.exists(captureFile + '.rc'):
+        os.remove(captureFile + '.rc')
+
+# ____________________________________________________________________________
+def recordStream(stream, captureFile):
+    """Generator of the lines of stream, which writes them also to captureFile.
+
+       The capture file is written to a temporary file first, so that
+       an aborted command leaves no incomplete capture file behind.
+       """
+
+    os.makedirs(os.path.dirname(captureFile), exist_ok=True)
+
+    with open(captureFile + '.tmp', 'wb') as capture:
+        for line in stream:
+            capture.write(line)
+            yield line
+
+    stream.close()
+    os.replace(captureFile + '.tmp', captureFile)
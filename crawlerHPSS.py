@@ -11,19 +11,28 @@ For detailed documentation, see: README_CrawlerHPSS.md
 import sys
 import os
 import re
+import hashlib
+import collections
 
 import logging as log
 import time
 import socket
 import datetime
+import argparse
 import shlex, subprocess
+import io
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
-from mongoUtil import mongoDbUtil
+from mongoUtil import mongoDbUtil, MONGO_BACKENDS, iterChunks
+from commandUtil import commandRunner, getCaptureFileName, recordStream
 import pymongo
 
 from pymongo import results
 from pymongo import errors
 from pymongo import bulk
+from pymongo import UpdateOne
 
 from pprint import pprint
 
@@ -33,6 +42,26 @@ from pprint import pprint
 HPSS_BASE_FOLDER = "/nersc/projects/starofl"
 PICO_FOLDERS     = [ 'picodsts', 'picoDST' ]
 
+HPSS_FILES_BULK_SIZE = 1000
+
+HPSS_MAX_SESSIONS = 4  # max number of concurrent hsi/htar sessions - of all ls workers, htar workers and tape listings
+
+HPSS_WRITER_QUEUE_SIZE = 10  # max number of batches queued for the DB writer
+
+PATH_SCHEMA_CACHE_SIZE = 100000  # max number of cached directory parsers
+
+HTAR_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.sdms', 'htarCache')
+
+HTAR_RETRY_MAX_DAYS = 32  # max days between retries of a failing tar file - doubled after every failure
+
+HPSS_MAX_LOST_PERCENT = 10  # max percentage of the files of a folder marked as lost in one crawl cycle
+
+TAPE_POSITION_PATTERN = re.compile(br'^([0-9]+)\+([0-9]+)$')  # "<section>+<offset>" in "hsi ls -P"
+
+HPSS_TAPE_SWEEP_DAYS = 30  # full re-read of tape positions of a subfolder - catches repacked tapes
+
+HPSS_TAPE_LS_BATCH_SIZE = 100  # files per "hsi ls -P" of files without tape position
+
 ##############################################
 
 # -- Check for a proper Python Version
@@ -50,6 +79,29 @@ class hpssUtil:
         self._today = datetime.datetime.today().strftime('%Y-%m-%d')
 
         self._target           = target
+        self._pathKeysSchema   = pathKeysSchema
+
+        self._collHpssCheckpoints = None
+        self._collHpssCrawls      = None
+        self._collHpssSeen        = None
+        self._epoch        = None
+        self._cycleStarted = ''
+        self._maxLostPercent = HPSS_MAX_LOST_PERCENT
+
+        self._htarPool    = None
+        self._htarSlots   = None
+        self._nHtarWorkers = 1
+        self._htarFutures = []
+
+        self._reindex = False
+
+        self._htarCacheDir = HTAR_CACHE_DIR
+
+        self._replayDir = None
+        self._recordDir = None
+        self._sessions = threading.BoundedSemaphore(HPSS_MAX_SESSIONS)
+        self._runner = commandRunner(sessions = self._sessions)
+
         self._fileSuffix       = '.{0}.root'.format(target)
         self._lengthFileSuffix = len(self._fileSuffix)
 
@@ -60,154 +112,728 @@ class hpssUtil:
             #    string if absent.  i.e.
             #    [['runyear', 's'], ['system', 's'], ['day', 'd'], ['runnumber', 'd']]
             self._typedPathKeys = [k.split('%') if '%' in k else [k, 's'] for k in pathKeys]
-            self._typeMap = {'s': str, 'd': int, 'f': float}
+
+            self._schemas = pathSchemaRegistry(self._typedPathKeys, self._lengthFileSuffix)
 
     # _________________________________________________________
-    def _getTypedPathKeys(self, tokenizedPath):
-        """Get typed path keys for different scenarios."""
+    def setCollections(self, collHpssFiles, collHpssPicoDsts, collHpssDuplicates,
+                       collHpssCheckpoints = None, collHpssCrawls = None):
+        """Get collection from mongoDB."""
 
-        # -- Default case
-        if len(tokenizedPath) == 8:
-            return self._typedPathKeys
+        self._collHpssFiles       = collHpssFiles
+        self._collHpssPicoDsts    = collHpssPicoDsts
+        self._collHpssDuplicates  = collHpssDuplicates
+        self._collHpssCheckpoints = collHpssCheckpoints
+        self._collHpssCrawls      = collHpssCrawls
 
-        elif len(tokenizedPath) == 7:
-            pathKeysSchema = 'runyear/system/energy/trigger/production/day%d/runnumber'
+    # _________________________________________________________
+    def setCrawlMode(self, maxLostPercent = HPSS_MAX_LOST_PERCENT):
+        """Set crawl mode.
 
-            # _________________________________________________________
-            def _getDateIndex(tokenizedPath):
-                """Get index of date field."""
+           A crawl cycle, which would mark more than maxLostPercent of the
+           files as lost, is not finished.
+           """
 
-                for idx in range(len(tokenizedPath)):
-                    isDate = True
-                    try:
-                        date = int(tokenizedPath[idx])
-                        if date > 370:
-                            isDate = False
-                    except ValueError:
-                        isDate = False
-
-                    if isDate:
-                        return idx
-                return -1
+        self._maxLostPercent = maxLostPercent
 
-            dateIdx = _getDateIndex(tokenizedPath)
+    # _________________________________________________________
+    def setReplayMode(self, replayDir = None, recordDir = None):
+        """Set replay or record mode of the hsi/htar output.
 
-            if dateIdx == 4 and "GeV" in tokenizedPath[2]:
-                # ORIG: pathKeysSchema = 'runyear/system/energy/trigger/production/day%d/runnumber'
-                pathKeysSchema = 'runyear/system/energy/trigger/day%d/runnumber'
+           In replay mode, the output of every hsi/htar call is read from
+           a capture file in replayDir - no HPSS access is needed. The htar
+           cache is not used, so that every tar listing is parsed.
 
-                pathKeys = pathKeysSchema.split(os.path.sep)
-                typedPathKeys = [k.split('%') if '%' in k else [k, 's'] for k in pathKeys]
-                return typedPathKeys
+           In record mode, the output of every hsi/htar call is written
+           in addition to a capture file in recordDir.
+           """
 
-            else:
-                print("SCHEMA NOT KNOWN !!! - use Default", tokenizedPath)
-                return self._typedPathKeys
+        self._replayDir = replayDir
+        self._recordDir = recordDir
+        self._runner = commandRunner(replayDir, recordDir, self._sessions)
 
-        else:
-            print("SCHEMA NOT KNOWN !!! - use Default", tokenizedPath)
-            return self._typedPathKeys
+        if replayDir:
+            self._htarCacheDir = None
 
     # _________________________________________________________
-    def setCollections(self, collHpssFiles, collHpssPicoDsts, collHpssDuplicates):
-        """Get collection from mongoDB."""
+    def getFileList(self, nWorkers = 1, nHtarWorkers = 1):
+        """Loop over both folders containing picoDSTs on HPSS.
 
-        self._collHpssFiles      = collHpssFiles
-        self._collHpssPicoDsts   = collHpssPicoDsts
-        self._collHpssDuplicates = collHpssDuplicates
+           With nWorkers > 1, the run subfolders are crawled in parallel.
+           With nHtarWorkers > 1, new tar files are listed by a pool of
+           htar workers, alongside the parsing of the ls output.
 
-    # _________________________________________________________
-    def getFileList(self):
-        """Loop over both folders containing picoDSTs on HPSS."""
+           All hsi/htar calls share HPSS_MAX_SESSIONS sessions, see
+           _getMaxCrawlWorkers for the split between ls and htar workers.
+           """
+
+        self._startHtarPool(nHtarWorkers)
+
+        # -- Retry tar files, which have not been parsed successfully before
+        self._requeueUnparsedTarFiles()
+        self._waitForTarFiles()
 
         for picoFolder in PICO_FOLDERS:
-            self._getFolderContent(picoFolder)
+            self._getFolderContent(picoFolder, nWorkers)
             break
 
+        self._stopHtarPool()
+
+        self._schemas.printReport()
+
+    # _________________________________________________________
+    def _startHtarPool(self, nHtarWorkers):
+        """Start pool of htar workers - one session is left for the ls workers."""
+
+        nHtarWorkers = min(nHtarWorkers, HPSS_MAX_SESSIONS - 1)
+        if nHtarWorkers > 1:
+            self._nHtarWorkers = nHtarWorkers
+            self._htarPool  = ThreadPoolExecutor(max_workers=nHtarWorkers)
+            self._htarSlots = threading.BoundedSemaphore(2*nHtarWorkers)
+
+    # _________________________________________________________
+    def _stopHtarPool(self):
+        """Stop pool of htar workers."""
+
+        if self._htarPool:
+            self._htarPool.shutdown()
+            self._htarPool = None
+            self._nHtarWorkers = 1
+
+    # _________________________________________________________
+    def _getMaxCrawlWorkers(self):
+        """Get max number of ls workers - so that ls and htar calls don't deadlock on the sessions.
+
+           An ls worker holds its session while its tar files are listed:
+           with htar pool, the pool workers need their own sessions, without
+           pool, every ls worker lists them inline in a second session.
+           """
+
+        if self._htarPool:
+            return HPSS_MAX_SESSIONS - self._nHtarWorkers
+
+        return max(HPSS_MAX_SESSIONS // 2, 1)
+
     # _________________________________________________________
-    def _getFolderContent(self, picoFolder):
-        """Get listing of content of picoFolder."""
+    def _getFolderContent(self, picoFolder, nWorkers = 1):
+        """Get listing of content of picoFolder.
+
+           Returns False if a listing failed - the crawl cycle is not finished then.
+           """
+
+        folder = '{0}/{1}'.format(HPSS_BASE_FOLDER, picoFolder)
 
         # -- Get subfolders from HPSS
-        cmdLine = 'hsi -q ls -1 {0}/{1}'.format(HPSS_BASE_FOLDER, picoFolder)
-        cmd = shlex.split(cmdLine)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        cmdLine = 'hsi -q ls -1 {0}'.format(folder)
+        with self._runner.run(cmdLine) as output:
+            listSubFolders = [subFolder.decode("utf-8").rstrip() for subFolder in output
+                              if "Run" in subFolder.decode("utf-8").rstrip()]
+
+        # -- No crawl cycle without listing - otherwise all files would be marked as lost
+        if not output.isSuccessful or not listSubFolders:
+            print("Error: listing of {0} failed or empty (exit status {1}) - crawl aborted".format(folder, output.returncode))
+            return False
+
+        # -- Start or resume crawl cycle and skip subfolders completed already in this cycle
+        if self._collHpssCheckpoints is not None:
+            self._startCrawlCycle(folder)
+
+            completed = set(doc['dirPath'] for doc in self._collHpssCheckpoints.find({'dirPath': {'$in': listSubFolders},
+                                                                                      'lastCompleted': {'$gt': self._cycleStarted}},
+                                                                                     {'dirPath': True, '_id': False}))
+            if completed:
+                print("Resume crawl cycle from {0}: skip {1} completed subfolders".format(self._cycleStarted, len(completed)))
+                listSubFolders = [subFolder for subFolder in listSubFolders if subFolder not in completed]
 
         # -- Loop of the list of subfolders
-        for subFolder in iter(p.stdout.readline, b''):
-            if "Run" in subFolder.decode("utf-8").rstrip():
-                self._parseSubFolder(subFolder.decode("utf-8").rstrip())
+        isSuccessful = True
+        if nWorkers <= 1:
+            for subFolder in listSubFolders:
+                isSuccessful = self._parseSubFolder(subFolder) and isSuccessful
+
+        # -- Crawl subfolders in parallel - capped to not overload the HPSS core server
+        else:
+            nWorkers = min(nWorkers, self._getMaxCrawlWorkers())
+
+            with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+                futures = {pool.submit(self._crawlSubFolder, subFolder): subFolder for subFolder in listSubFolders}
+
+                for future in as_completed(futures):
+                    try:
+                        isSuccessful = future.result() and isSuccessful
+                    except Exception as err:
+                        isSuccessful = False
+                        print("Error: crawling subfolder {0} failed: {1}".format(futures[future], err))
+
+        # -- Close crawl cycle - otherwise the next run resumes it
+        #    Not if a subfolder failed, whose files would be marked as lost
+        if not isSuccessful:
+            print("Error: crawl of {0} incomplete - crawl cycle not finished".format(folder))
+        elif self._collHpssCheckpoints is not None:
+            isSuccessful = self._finishCrawlCycle(folder)
+
+        return isSuccessful
+
+    # _________________________________________________________
+    def _startCrawlCycle(self, folder):
+        """Start a new crawl cycle or resume an unfinished one.
+
+           The cycle state is kept in the checkpoint document of the top folder.
+           """
+
+        now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+
+        cycleDoc = self._collHpssCheckpoints.find_one({'dirPath': folder})
+
+        # -- Resume unfinished cycle
+        if cycleDoc and cycleDoc.get('cycleStarted') and not cycleDoc.get('cycleFinished'):
+            self._cycleStarted = cycleDoc['cycleStarted']
+            self._setCrawlEpoch(cycleDoc.get('cycleEpoch'))
+            return
+
+        # -- Start new cycle
+        self._cycleStarted = now
+
+        self._setCrawlEpoch(self._newCrawlEpoch(folder))
+
+        self._collHpssCheckpoints.find_one_and_update({'dirPath': folder},
+                                                      {'$set': {'cycleStarted': self._cycleStarted,
+                                                                'cycleEpoch': self._epoch,
+                                                                'cycleFinished': None}}, upsert = True)
+
+        print("Start crawl cycle: {0}".format(folder))
+
+    # _________________________________________________________
+    def _finishCrawlCycle(self, folder):
+        """Mark crawl cycle as finished.
+
+           The files not seen in the crawl epoch of this cycle are marked as lost.
+           Returns False if too many files would be lost - the cycle is not finished then.
+           """
+
+        if self._collHpssSeen is not None:
+            nLostFound = self._markLostFiles(folder)
+            if nLostFound is None:
+                return False
+            nLost, nFound = nLostFound
+
+        update = {'cycleFinished': datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}
+
+        self._collHpssCheckpoints.find_one_and_update({'dirPath': folder}, {'$set': update})
+
+        if self._collHpssSeen is not None:
+            self._collHpssCrawls.find_one_and_update({'epoch': self._epoch},
+                                                     {'$set': {'finished': update['cycleFinished'],
+                                                               'nSeen': self._collHpssSeen.count_documents({}),
+                                                               'nLost': nLost, 'nFound': nFound}})
+            self._collHpssSeen.drop()
+
+        return True
+
+    # _________________________________________________________
+    def _newCrawlEpoch(self, folder):
+        """Record a new crawl epoch in HPSS_Crawls and return its id."""
+
+        if self._collHpssCrawls is None:
+            return None
+
+        lastEpochDoc = self._collHpssCrawls.find_one({}, sort=[('epoch', pymongo.DESCENDING)])
+        epoch = lastEpochDoc['epoch'] + 1 if lastEpochDoc else 1
+
+        self._collHpssCrawls.insert_one({'epoch': epoch, 'folder': folder,
+                                         'started': self._cycleStarted, 'finished': None})
+        return epoch
+
+    # _________________________________________________________
+    def _setCrawlEpoch(self, epoch):
+        """Set crawl epoch and its seen-set collection of files."""
+
+        self._epoch = epoch
+        self._collHpssSeen = None
+
+        if self._collHpssCrawls is not None and epoch:
+            self._collHpssSeen = self._collHpssCrawls.database['HPSS_Files_Seen_{0}'.format(epoch)]
+
+    # _________________________________________________________
+    def _markLostFiles(self, folder):
+        """Mark files in folder, which are not in the seen-set of the crawl epoch, as lost.
+
+           Both are iterated sorted by path, so that the set difference is
+           done in one pass. Lost files get lostEpoch and lastSeen - the
+           start of the last finished epoch. Lost files seen again are
+           marked as found.
+
+           If more than maxLostPercent of the files would be lost - i.e. after
+           a broken listing - none is marked and None is returned.
+
+           Returns number of lost and found files.
+           """
+
+        # -- Sanity check - at least the files known, but not seen are lost
+        folderRegex = '^{0}/'.format(re.escape(folder))
+        nKnown = self._collHpssFiles.count_documents({'fileFullPath': {'$regex': folderRegex}, 'lostEpoch': {'$exists': False}})
+        nLostMin = nKnown - self._collHpssSeen.count_documents({})
+        if nKnown and nLostMin * 100 > nKnown * self._maxLostPercent:
+            print("Error: crawl epoch {0}: at least {1} of {2} files of {3} would be marked as lost - more than {4}%,"
+                  " none is marked and the crawl cycle is not finished".format(self._epoch, nLostMin, nKnown,
+                                                                             folder, self._maxLostPercent))
+            return None
+
+        lastEpochDoc = self._collHpssCrawls.find_one({'folder': folder, 'epoch': {'$lt': self._epoch},
+                                                      'finished': {'$ne': None}},
+                                                     sort=[('epoch', pymongo.DESCENDING)])
+        updateLost = {'lostEpoch': self._epoch}
+        if lastEpochDoc:
+            updateLost['lastSeen'] = lastEpochDoc['started'][:10]
+
+        seen = (doc['_id'] for doc in self._collHpssSeen.find({}, {'_id': True}).sort('_id', pymongo.ASCENDING))
+        seenPath = next(seen, None)
+
+        nLost  = 0
+        nFound = 0
+        requests = []
+        for doc in self._collHpssFiles.find({'fileFullPath': {'$regex': folderRegex}},
+                                            {'fileFullPath': True, 'lostEpoch': True, '_id': False}).sort('fileFullPath', pymongo.ASCENDING):
+            while seenPath is not None and seenPath < doc['fileFullPath']:
+                seenPath = next(seen, None)
+
+            isSeen = seenPath == doc['fileFullPath']
+
+            if not isSeen and 'lostEpoch' not in doc:
+                requests.append(UpdateOne({'fileFullPath': doc['fileFullPath']}, {'$set': updateLost}))
+                nLost += 1
+            elif isSeen and 'lostEpoch' in doc:
+                requests.append(UpdateOne({'fileFullPath': doc['fileFullPath']}, {'$unset': {'lostEpoch': ''}}))
+                nFound += 1
+
+            if len(requests) >= HPSS_FILES_BULK_SIZE:
+                self._collHpssFiles.bulk_write(requests, ordered=False)
+                requests = []
+
+        if requests:
+            self._collHpssFiles.bulk_write(requests, ordered=False)
+
+        print("Crawl epoch {0}: {1} files lost, {2} files found again".format(self._epoch, nLost, nFound))
+
+        return nLost, nFound
+
+    # _________________________________________________________
+    def _crawlSubFolder(self, subFolder):
+        """Crawl one subfolder within a worker thread.
+
+           Every worker uses its own hpssUtil instance, so that block state
+           and write buffers are not shared between threads.
+           """
+
+        worker = hpssUtil(self._target, self._pathKeysSchema)
+        worker.setCollections(self._collHpssFiles, self._collHpssPicoDsts, self._collHpssDuplicates,
+                              self._collHpssCheckpoints, self._collHpssCrawls)
+        worker.setCrawlMode(self._maxLostPercent)
+        worker._sessions = self._sessions
+        worker.setReplayMode(self._replayDir, self._recordDir)
+        worker._htarCacheDir = self._htarCacheDir
+        worker._htarPool     = self._htarPool
+        worker._htarSlots    = self._htarSlots
+        worker._schemas      = self._schemas
+        worker._cycleStarted = self._cycleStarted
+        worker._epoch        = self._epoch
+        worker._collHpssSeen = self._collHpssSeen
+
+        return worker._parseSubFolder(subFolder)
 
     # _________________________________________________________
     def _parseSubFolder(self, subFolder):
-        """Get recursive list of folders and files in subFolder ... as "ls" output."""
+        """Get recursive list of folders and files in subFolder ... as "ls" output.
+
+           The entries are collected per block (= directory) of the ls output.
+
+           Parsing and writing to the DB are split in two stages, joined by
+           a bounded queue: the parsed records are handed over in batches
+           to a DB writer thread. If the writer falls behind, the parsing
+           waits for it.
+
+           Returns False if the listing failed - the subfolder is not completed then.
+           """
 
         cmdLine = 'hsi -q ls -lR {0}'.format(subFolder)
-        cmd = shlex.split(cmdLine)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stream = self._runner.run(cmdLine)
+
+        # -- Start DB writer stage
+        self._writerError = None
+        queueWriter = queue.Queue(maxsize=HPSS_WRITER_QUEUE_SIZE)
+        writer = threading.Thread(target=self._writeHpssFiles, args=(queueWriter,))
+        writer.start()
+
+        # -- Parse ls output block-by-block -> utilizing output blocks in ls
+        listHpssDocs = []
+        listSeen     = []
+        try:
+            for blockPath, listBlockLines in self._iterListing(stream, subFolder):
+                self._currentBlockPath = blockPath
+                self._processBlock(listBlockLines, listHpssDocs, listSeen)
+
+                if len(listHpssDocs) >= HPSS_FILES_BULK_SIZE or len(listSeen) >= HPSS_FILES_BULK_SIZE:
+                    if self._writerError:
+                        break
+                    queueWriter.put((listHpssDocs, listSeen))
+                    listHpssDocs = []
+                    listSeen     = []
+
+            # -- Remaining HPSS files
+            queueWriter.put((listHpssDocs, listSeen))
+
+        finally:
+            queueWriter.put(None)
+            writer.join()
+            stream.close()
+
+        if self._writerError:
+            raise self._writerError
+
+        # -- Wait for queued tar files of this subfolder
+        self._waitForTarFiles()
+
+        if not stream.isSuccessful:
+            print("Error: listing of {0} failed (exit status {1})".format(subFolder, stream.returncode))
+            return False
+
+        # -- Tape positions - of all files in a periodic tape sweep (i.e. after a repack),
+        #    else only of the files without - new or migrated from disk cache since
+        update = {'lastCompleted': datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}
+        if self._isTapeSweepDue(subFolder):
+            if self._updateTapePositions(subFolder) is not None:
+                update['lastTapeSweep'] = self._today
+        else:
+            self._updateMissingTapePositions(subFolder)
+
+        # -- Subfolder completed in this crawl cycle
+        if self._collHpssCheckpoints is not None:
+            self._collHpssCheckpoints.find_one_and_update({'dirPath': subFolder}, {'$set': update}, upsert = True)
+
+        return True
+
+    # _________________________________________________________
+    def _iterListing(self, stream, subFolder):
+        """Generator of the blocks of the ls output.
+
+           Works on the raw bytes of the stream. Yields the path of the block
+           and the list of its tokenized lines (fileName is the last token).
+           """
+
+        subFolderBytes = subFolder.encode('utf-8')
+
+        blockPath = None
+        listBlockLines = []
+
+        for line in stream:
+            line = line.rstrip()
+
+            if line.startswith(subFolderBytes):
+                if blockPath is not None:
+                    yield blockPath, listBlockLines
+                blockPath = line.rstrip(b':').decode('utf-8')
+                listBlockLines = []
+
+            elif not line:
+                if blockPath is not None:
+                    yield blockPath, listBlockLines
+                blockPath = None
+                listBlockLines = []
+
+            elif blockPath is not None:
+                lineTokenized = line.split(None, 8)
+                if len(lineTokenized) == 9:
+                    listBlockLines.append(lineTokenized)
+
+        # -- Last block
+        if blockPath is not None:
+            yield blockPath, listBlockLines
+
+    # _________________________________________________________
+    def _writeHpssFiles(self, queueWriter):
+        """DB writer stage: write batches of HPSS files from the queue.
+
+           Runs in its own thread until None is received. After an error,
+           the queue is only drained and the error is raised by the parser.
+           """
 
-        # -- Parse ls output line-by-line -> utilizing output blocks in ls
-        inBlock = 0
         listPicoDsts = []
-        for lineTerminated in iter(p.stdout.readline, b''):
-            line = lineTerminated.decode("utf-8").rstrip('\t\n')
-            lineCleaned = ' '.join(line.split())
 
-            if lineCleaned.startswith(subFolder):
-                inBlock = 1
-                self._currentBlockPath = line.rstrip(':')
-            else:
-                if not lineCleaned:
-                    inBlock = 0
-                    self._currentBlockPath = ""
-                else:
-                    if inBlock and not lineCleaned.startswith('d'):
-                        doc = self._parseLine(lineCleaned)
-
-                        # -- update lastSeen and insert if not in yet
-                        ret = self._collHpssFiles.find_one_and_update({'fileFullPath': doc['fileFullPath']},
-                                                                      {'$set': {'lastSeen': self._today},
-                                                                       '$setOnInsert' : doc},
-                                                                       upsert = True)
-
-                        # -- document already there - do nothing
-                        if ret:
-                            continue
-
-                        # -- new document inserted - add the picoDst(s)
-                        if doc['fileType'] == "tar":
-                            # -- get picoDsts within tar files
-                            nDocsInTar = self._parseTarFile(doc)
-                            if nDocsInTar == -1:
-                                print("Error: reading tar file {0} - fix manually, file has \
-                                       not been added to HPSS_Files collection.".format(doc['fileFullPath']))
-                            else:
-                                self._collHpssFiles.find_one_and_update({'fileFullPath': doc['fileFullPath']},
-                                                                        {'$set': {'filesInTar': nDocsInTar}})
-                            continue
-
-                        if doc['fileType'] == "picoDst":
-                            listPicoDsts.append(self._makePicoDstDoc(doc['fileFullPath'], doc['fileSize']))
-
-                            if len(listPicoDsts) >= 10000:
-                                self._insertPicoDsts(listPicoDsts)
-                                listPicoDsts[:] = []
-
-        # -- Insert picoDsts in collection
+        while True:
+            item = queueWriter.get()
+            if item is None:
+                break
+
+            if self._writerError:
+                continue
+
+            try:
+                listHpssDocs, listSeen = item
+                self._flush(listHpssDocs, listPicoDsts, listSeen)
+            except Exception as err:
+                self._writerError = err
+
+    # _________________________________________________________
+    def _processBlock(self, listBlockLines, listHpssDocs, listSeen):
+        """Process one block (= directory) of the ls output."""
+
+        listFileLines = [lineTokenized for lineTokenized in listBlockLines if not lineTokenized[0].startswith(b'd')]
+
+        # -- Files seen in this crawl epoch
+        if self._collHpssSeen is not None:
+            listSeen.extend("{0}/{1}".format(self._currentBlockPath, lineTokenized[8].decode('utf-8'))
+                            for lineTokenized in listFileLines)
+
+        listHpssDocs.extend(self._parseLine(lineTokenized) for lineTokenized in listFileLines)
+
+    # _________________________________________________________
+    def _flush(self, listHpssDocs, listPicoDsts, listSeen):
+        """Write buffered HPSS files, picoDsts and seen files."""
+
+        self._upsertHpssFiles(listHpssDocs, listPicoDsts)
+        listHpssDocs[:] = []
+
         self._insertPicoDsts(listPicoDsts)
+        listPicoDsts[:] = []
+
+        self._insertSeenFiles(listSeen)
+        listSeen[:] = []
+
+    # _________________________________________________________
+    def _insertSeenFiles(self, listSeen):
+        """Insert files in the seen-set of the crawl epoch.
+
+           Files already in - from an interrupted run of the epoch - are ignored.
+           """
+
+        if not listSeen:
+            return
+
+        try:
+            self._collHpssSeen.insert_many([{'_id': fileFullPath} for fileFullPath in listSeen], ordered=False)
+        except errors.BulkWriteError as err:
+            if any(error['code'] != 11000 for error in err.details['writeErrors']):
+                raise
+
+    # _________________________________________________________
+    def _upsertHpssFiles(self, listHpssDocs, listPicoDsts):
+        """Bulk upsert list of HPSS files in HPSS_Files collection.
+
+           Insert the ones not in yet and process only the newly inserted
+           documents. Documents already in are not written - their liveness
+           is kept in the seen-set of the crawl epoch.
+           """
+
+        # -- Empty list
+        if not listHpssDocs:
+            return
+
+        # -- insert if not in yet
+        for doc in listHpssDocs:
+            doc['lastSeen'] = self._today
+
+        requests = [UpdateOne({'fileFullPath': doc['fileFullPath']},
+                              {'$setOnInsert' : doc}, upsert = True)
+                    for doc in listHpssDocs]
+
+        # -- Keep mtime and size of documents already in current - written only if changed
+        #    (after the upserts, only those have indices < len(listHpssDocs))
+        requests.extend(self._makeChangedFileRequests(listHpssDocs))
+
+        try:
+            ret = self._collHpssFiles.bulk_write(requests, ordered=False)
+            upsertedIndices = ret.upserted_ids.keys()
+        except errors.BulkWriteError as err:
+            print("Error: bulk upsert in HPSS_Files - {0} write errors".format(len(err.details['writeErrors'])))
+            upsertedIndices = [item['index'] for item in err.details['upserted']]
+
+        # -- documents already there - do nothing
+        #    new documents inserted - add the picoDst(s)
+        for idx in sorted(upsertedIndices):
+            doc = listHpssDocs[idx]
+
+            if doc['fileType'] == "tar":
+                # -- get picoDsts within tar files
+                self._queueTarFile(doc)
+                continue
+
+            if doc['fileType'] == "picoDst":
+                listPicoDsts.append(self._makePicoDstDoc(doc['fileFullPath'], doc['fileSize']))
+
+                if len(listPicoDsts) >= 10000:
+                    self._insertPicoDsts(listPicoDsts)
+                    listPicoDsts[:] = []
+
+    # _________________________________________________________
+    def _isTapeSweepDue(self, subFolder):
+        """Check if the tape positions of all files in subFolder are to be re-read.
+
+           Due every HPSS_TAPE_SWEEP_DAYS - tracked by lastTapeSweep in the
+           checkpoint document of subFolder - and always without checkpoints.
+           """
+
+        if self._collHpssCheckpoints is None:
+            return True
+
+        tapeSweepDaysAgo = (datetime.date.today() - datetime.timedelta(days=HPSS_TAPE_SWEEP_DAYS)).strftime('%Y-%m-%d')
+
+        checkpoint = self._collHpssCheckpoints.find_one({'dirPath': subFolder}, {'lastTapeSweep': True, '_id': False})
+        return not checkpoint or checkpoint.get('lastTapeSweep', '') < tapeSweepDaysAgo
+
+    # _________________________________________________________
+    def _updateTapePositions(self, subFolder):
+        """Set tape volume and position of all files in subFolder in HPSS_Files.
+
+           Parsed from the "hsi ls -P -R" output, one line per file:
+             FILE  <path>  <size>  <size>  <section>+<offset>  <volume>  ...
+           Files only on disk cache have no tape volume and are skipped.
+           Only changed tape volumes and positions are written.
+
+           Returns number of written files - None if the listing failed.
+           """
+
+        cmdLine = 'hsi -q ls -P -R {0}'.format(subFolder)
+        stream = self._runner.run(cmdLine)
+
+        subFolderBytes = subFolder.encode('utf-8')
+        blockPath = subFolder
+
+        nFiles = 0
+        tapeInfos = {}
+        try:
+            for line in stream:
+                lineTokenized = line.split()
+                if not lineTokenized:
+                    continue
+
+                # -- Block header of the recursive listing - for relative paths
+                if len(lineTokenized) == 1 and line.startswith(subFolderBytes):
+                    blockPath = line.rstrip().rstrip(b':').decode('utf-8')
+                    continue
+
+                tapeInfo = parseTapeLine(lineTokenized)
+                if not tapeInfo:
+                    continue
+
+                filePath, tapeVolume, tapePosition = tapeInfo
+                if not filePath.startswith('/'):
+                    filePath = "{0}/{1}".format(blockPath, filePath)
+
+                tapeInfos[filePath] = (tapeVolume, tapePosition)
+
+                if len(tapeInfos) >= HPSS_FILES_BULK_SIZE:
+                    nFiles += self._writeTapePositions(tapeInfos)
+                    tapeInfos = {}
+        finally:
+            stream.close()
+
+        nFiles += self._writeTapePositions(tapeInfos)
+
+        # -- Positions listed are written, but the sweep is repeated
+        if not stream.isSuccessful:
+            print("Warning: tape listing of {0} failed (exit status {1})".format(subFolder, stream.returncode))
+            return None
+
+        return nFiles
+
+    # _________________________________________________________
+    def _updateMissingTapePositions(self, subFolder):
+        """Set tape volume and position of the files in subFolder without in HPSS_Files.
+
+           Only tar and picoDst files - the ones staged - which are not lost
+           are listed, by "hsi ls -P" of HPSS_TAPE_LS_BATCH_SIZE files per call.
+           """
+
+        cursor = self._collHpssFiles.find({'fileFullPath': {'$regex': '^{0}/'.format(re.escape(subFolder))},
+                                           'fileType': {'$in': ['tar', 'picoDst']},
+                                           'tapeVolume': {'$exists': False}, 'lostEpoch': {'$exists': False}},
+                                          {'fileFullPath': True, '_id': False})
+
+        nFiles = 0
+        for listDocs in iterChunks(cursor, HPSS_TAPE_LS_BATCH_SIZE):
+            cmdLine = 'hsi -q ls -P {0}'.format(' '.join(shlex.quote(doc['fileFullPath']) for doc in listDocs))
+            stream = self._runner.run(cmdLine)
+
+            tapeInfos = {}
+            try:
+                for line in stream:
+                    tapeInfo = parseTapeLine(line.split())
+                    if tapeInfo:
+                        filePath, tapeVolume, tapePosition = tapeInfo
+                        tapeInfos[filePath] = (tapeVolume, tapePosition)
+            finally:
+                stream.close()
+
+            # -- Files not found are reported, the others listed
+            if not stream.isSuccessful:
+                print("Warning: tape listing of {0} files in {1} failed (exit status {2})".format(len(listDocs), subFolder,
+                                                                                                  stream.returncode))
+
+            nFiles += self._writeTapePositions(tapeInfos)
+
+        return nFiles
+
+    # _________________________________________________________
+    def _writeTapePositions(self, tapeInfos):
+        """Write tape volume and position of files - {path: (volume, position)} - which changed.
+
+           Returns number of written files.
+           """
+
+        if not tapeInfos:
+            return 0
+
+        requests = []
+        for doc in self._collHpssFiles.find({'fileFullPath': {'$in': list(tapeInfos.keys())}},
+                                            {'fileFullPath': True, 'tapeVolume': True, 'tapePosition': True, '_id': False}):
+            tapeVolume, tapePosition = tapeInfos[doc['fileFullPath']]
+            if doc.get('tapeVolume') == tapeVolume and doc.get('tapePosition') == tapePosition:
+                continue
+
+            requests.append(UpdateOne({'fileFullPath': doc['fileFullPath']},
+                                      {'$set': {'tapeVolume': tapeVolume, 'tapePosition': tapePosition}}))
+
+        if requests:
+            self._collHpssFiles.bulk_write(requests, ordered=False)
+
+        return len(requests)
 
     # _________________________________________________________
-    def _parseLine(self, line):
+    def _parseMTime(self, listTokens):
+        """Get modification date YYYY-MM-DD from the mtime tokens of an ls line.
+
+           ls shows 'Apr 29 16:37' for recent files and 'Apr 29 2016' for
+           older ones. The time is dropped, so that the date of a file
+           doesn't change when it gets older. Unparsable mtimes are kept as is.
+           """
+
+        month, day, yearOrTime = (token.decode('utf-8') for token in listTokens)
+        try:
+            mdate = datetime.datetime.strptime('{0} {1}'.format(month, day), '%b %d')
+        except ValueError:
+            return ' '.join((month, day, yearOrTime))
+
+        if ':' not in yearOrTime:
+            year = int(yearOrTime)
+        else:
+            # -- Recent file: this year, or last year if the date is still to come
+            today = datetime.date.today()
+            year = today.year if (mdate.month, mdate.day) <= (today.month, today.day) else today.year - 1
+
+        return '{0:04d}-{1:02d}-{2:02d}'.format(year, mdate.month, mdate.day)
+
+    # _________________________________________________________
+    def _parseLine(self, lineTokenized):
         """Parse one entry in HPSS subfolder.
 
            Get every file with full path, size, and details
+           from the tokenized ls line (as bytes).
            """
 
-        lineTokenized = line.split(' ', 9)
-
-        fileName     = lineTokenized[8]
+        fileName     = lineTokenized[8].decode('utf-8')
         fileFullPath = "{0}/{1}".format(self._currentBlockPath, fileName)
         fileSize     = int(lineTokenized[4])
+        fileMTime    = self._parseMTime(lineTokenized[5:8])
         fileType     = "other"
 
         if fileName.endswith(".tar"):
@@ -218,7 +844,196 @@ class hpssUtil:
             fileType = "picoDst"
 
         # -- return record
-        return { 'fileFullPath': fileFullPath, 'fileSize': fileSize, 'fileType': fileType}
+        return { 'fileFullPath': fileFullPath, 'fileSize': fileSize, 'fileMTime': fileMTime, 'fileType': fileType}
+
+    # _________________________________________________________
+    def _makeChangedFileRequests(self, listHpssDocs):
+        """Get update requests for documents in HPSS_Files with changed mtime or size.
+
+           A changed tar file gets filesInTar unset, so that it is listed
+           again - with the cache key of its new mtime and size - by
+           _requeueUnparsedTarFiles. Documents without fileMTime (from
+           before it was recorded) get it set only.
+           """
+
+        requests = []
+        for doc in listHpssDocs:
+            requests.append(UpdateOne({'fileFullPath': doc['fileFullPath'], 'fileMTime': {'$exists': False}},
+                                      {'$set': {'fileMTime': doc['fileMTime']}}))
+
+            update = {'$set': {'fileMTime': doc['fileMTime'], 'fileSize': doc['fileSize']}}
+            if doc['fileType'] == 'tar':
+                update['$unset'] = {'filesInTar': '', 'htarFailures': '', 'htarNextRetry': ''}
+
+            requests.append(UpdateOne({'fileFullPath': doc['fileFullPath'], 'fileMTime': {'$exists': True},
+                                       '$or': [{'fileMTime': {'$ne': doc['fileMTime']}},
+                                               {'fileSize': {'$ne': doc['fileSize']}}]}, update))
+        return requests
+
+    # _________________________________________________________
+    def _queueTarFile(self, hpssDoc):
+        """Queue new tar file to the pool of htar workers.
+
+           Without pool, the tar file is processed right away. The number
+           of queued tar files is bounded, so the ls parsing waits for free
+           htar workers.
+           """
+
+        if not self._htarPool:
+            self._processTarFile(hpssDoc)
+            return
+
+        self._htarSlots.acquire()
+        future = self._htarPool.submit(self._processTarFile, hpssDoc)
+        future.add_done_callback(lambda f: self._htarSlots.release())
+        self._htarFutures.append(future)
+
+    # _________________________________________________________
+    def _waitForTarFiles(self):
+        """Wait for all queued tar files."""
+
+        if not self._htarFutures:
+            return
+
+        wait(self._htarFutures)
+        for future in self._htarFutures:
+            if future.exception():
+                print("Error: processing tar file failed:", future.exception())
+        self._htarFutures[:] = []
+
+    # _________________________________________________________
+    def _processTarFile(self, hpssDoc):
+        """Get picoDsts within tar file and set filesInTar of HPSS_Files document."""
+
+        nDocsInTar = self._parseTarFile(hpssDoc)
+        if nDocsInTar == -1:
+            self._setTarFileFailed(hpssDoc)
+            return
+
+        self._collHpssFiles.find_one_and_update({'fileFullPath': hpssDoc['fileFullPath']},
+                                                {'$set': {'filesInTar': nDocsInTar},
+                                                 '$unset': {'htarFailures': '', 'htarNextRetry': ''}})
+
+    # _________________________________________________________
+    def _setTarFileFailed(self, hpssDoc):
+        """Record failed listing of tar file and the day of its next retry.
+
+           The retries back off: the days until the next one are doubled
+           after every failure, up to HTAR_RETRY_MAX_DAYS.
+           """
+
+        nFailures = hpssDoc.get('htarFailures', 0) + 1
+        nDays = min(2 ** (nFailures - 1), HTAR_RETRY_MAX_DAYS)
+        nextRetry = (datetime.date.today() + datetime.timedelta(days=nDays)).strftime('%Y-%m-%d')
+
+        self._collHpssFiles.find_one_and_update({'fileFullPath': hpssDoc['fileFullPath']},
+                                                {'$set': {'htarFailures': nFailures, 'htarNextRetry': nextRetry}})
+
+        print("Error: reading tar file {0} failed {1} time(s) - will be retried on {2}, "
+              "fix manually if it persists.".format(hpssDoc['fileFullPath'], nFailures, nextRetry))
+
+    # _________________________________________________________
+    def _requeueUnparsedTarFiles(self):
+        """Queue tar files without filesInTar again.
+
+           Those tar files failed or were interrupted in previous runs. Failed
+           ones only once their next retry is due, lost ones not at all.
+           Already inserted picoDsts and duplicates of those tar files are
+           removed first, so that they don't show up as duplicates.
+           """
+
+        query = {'fileType': 'tar', 'filesInTar': {'$exists': False}, 'lostEpoch': {'$exists': False},
+                 '$or': [{'htarNextRetry': {'$exists': False}}, {'htarNextRetry': {'$lte': self._today}}]}
+
+        for hpssDoc in self._collHpssFiles.find(query, {'_id': False}):
+            self._collHpssPicoDsts.delete_many({'fileFullPathTar': hpssDoc['fileFullPath']})
+            self._collHpssDuplicates.delete_many({'fileFullPathTar': hpssDoc['fileFullPath']})
+            self._queueTarFile(hpssDoc)
+
+    # _________________________________________________________
+    def reindexTarFiles(self, nHtarWorkers = 1):
+        """Rebuild picoDsts of all tar files in HPSS_PicoDsts.
+
+           The tar listings are read from the local cache, htar is only
+           called for tar files not in the cache. The picoDsts are updated
+           to the listings - see _reindexPicoDsts.
+           """
+
+        self._reindex = True
+        self._startHtarPool(nHtarWorkers)
+
+        for hpssDoc in self._collHpssFiles.find({'fileType': 'tar'}, {'_id': False}):
+            self._queueTarFile(hpssDoc)
+
+        self._waitForTarFiles()
+        self._stopHtarPool()
+        self._reindex = False
+
+        self._schemas.printReport()
+
+    # _________________________________________________________
+    def _getTarListingCacheFile(self, hpssDoc):
+        """Get file name in cache of tar listing.
+
+           Keyed by tar path, size and HPSS mtime - a changed tar file gets a new entry.
+           """
+
+        key = '{0}|{1}|{2}'.format(hpssDoc['fileFullPath'], hpssDoc['fileSize'], hpssDoc.get('fileMTime', ''))
+        return os.path.join(self._htarCacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.toc')
+
+    # _________________________________________________________
+    def _getTarListing(self, hpssDoc):
+        """Get listing of tar file as list of lines - None if htar failed.
+
+           Read it from the local cache or get it via htar. A successful
+           htar listing is added to the cache.
+           """
+
+        cmdLine = 'htar -tf {0}'.format(hpssDoc['fileFullPath'])
+
+        if not self._htarCacheDir:
+            return self._runHtarListing(cmdLine)
+
+        cacheFile = self._getTarListingCacheFile(hpssDoc)
+
+        try:
+            with open(cacheFile, 'rb') as cache:
+                listLines = cache.readlines()
+
+            # -- Record cached listing as well - the replay doesn't use the cache
+            if self._recordDir:
+                listLines = list(recordStream(io.BytesIO(b''.join(listLines)),
+                                              os.path.join(self._recordDir, getCaptureFileName(cmdLine))))
+            return listLines
+        except IOError:
+            pass
+
+        listLines = self._runHtarListing(cmdLine)
+
+        # -- Cache only successful listings - write to temporary file first
+        if listLines is not None and b'HTAR: HTAR SUCCESSFUL' in (line.strip() for line in listLines):
+            try:
+                os.makedirs(self._htarCacheDir, exist_ok=True)
+                with open(cacheFile + '.tmp', 'wb') as cache:
+                    cache.writelines(listLines)
+                os.replace(cacheFile + '.tmp', cacheFile)
+            except OSError as err:
+                print("Warning: tar listing not cached:", err)
+
+        return listLines
+
+    # _________________________________________________________
+    def _runHtarListing(self, cmdLine):
+        """Run htar listing - list of lines, None if htar failed."""
+
+        with self._runner.run(cmdLine) as output:
+            listLines = list(output)
+
+        if not output.isSuccessful:
+            print("Error: {0} failed (exit status {1})".format(cmdLine, output.returncode))
+            return None
+
+        return listLines
 
     # _________________________________________________________
     def _parseTarFile(self, hpssDoc):
@@ -229,13 +1044,13 @@ class hpssUtil:
                 - -1 if error reading tar file
            """
 
-        cmdLine = 'htar -tf {0}'.format(hpssDoc['fileFullPath'])
-        cmd = shlex.split(cmdLine)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
         listDocs = []
 
-        for lineTerminated in iter(p.stdout.readline, b''):
+        listLines = self._getTarListing(hpssDoc)
+        if listLines is None:
+            return -1
+
+        for lineTerminated in listLines:
             line = lineTerminated.decode("utf-8").rstrip('\t\n')
             lineCleaned = ' '.join(line.split())
 
@@ -274,8 +1089,11 @@ class hpssUtil:
 
         nDocsInTar = len(listDocs)
 
-        # -- Insert picoDsts in collection
-        self._insertPicoDsts(listDocs)
+        # -- Insert picoDsts in collection - or update them to the listing
+        if self._reindex:
+            self._reindexPicoDsts(hpssDoc, listDocs)
+        else:
+            self._insertPicoDsts(listDocs)
 
         return nDocsInTar
 
@@ -299,36 +1117,11 @@ class hpssUtil:
         if isInTarFile:
             doc['fileFullPathTar'] = hpssDoc['fileFullPath']
 
-        # -- Strip basePath of fileName and tokenize it
-        cleanPathTokenized = doc['filePath'].split(os.path.sep)
-
-        # -- Get TypedKeys for tokenized path
-        typedPathKeys = self._getTypedPathKeys(cleanPathTokenized)
-
-        # -- Create STAR details sub document
-        docStarDetails = dict([(keys[0], self._typeMap[keys[1]](value))
-                               for keys, value in zip(typedPathKeys, cleanPathTokenized)])
-
-        # -- Create a regex pattern to get the stream from the fileName
-        regexStream = re.compile('(st_.*)_{}'.format(docStarDetails.get('runnumber', '')))
-
-        fileNameParts = re.split(regexStream, cleanPathTokenized[-1])
-        if len(fileNameParts) == 3 and len(fileNameParts[0]) == 0:
-            docStarDetails['stream'] = fileNameParts[1]
-
-            strippedSuffix = fileNameParts[-1][1:-self._lengthFileSuffix]
-            strippedSuffixParts = strippedSuffix.split('_')
-
-            docStarDetails['picoType'] = strippedSuffixParts[0] \
-                if len(strippedSuffixParts) == 2 \
-                else strippedSuffix
-        else:
-            print('xxx: ', fileNameParts, docStarDetails)
-            docStarDetails['stream'] = 'xx'
-            docStarDetails['picoType'] = 'xx'
+        # -- Split filePath in directory and fileName
+        dirPath, fileName = os.path.split(doc['filePath'])
 
-        # -- Add STAR details to document
-        doc['starDetails'] = docStarDetails
+        # -- Create STAR details sub document, using the cached parser of the directory
+        doc['starDetails'] = self._schemas.getParser(dirPath).parse(fileName)
 
         # -- return picoDst document
         return doc
@@ -346,18 +1139,35 @@ class hpssUtil:
             return
 
         # -- Clean listDocs with duplicate entries and move them on extra list: listDuplicates
+        #    - hash index of batch on filePath, duplicates within the batch go to listDuplicates
+        dictDocs = {}
         listDuplicates = []
 
-        for entry in self._collHpssPicoDsts.find({'starDetails.runyear': listDocs[0]['starDetails']['runyear']}, {'filePath': True, '_id': False}):
-            element = next((item for item in listDocs if item['filePath'] == entry['filePath']), None)
+        for doc in listDocs:
+            if doc['filePath'] in dictDocs:
+                listDuplicates.append(doc)
+            else:
+                dictDocs[doc['filePath']] = doc
+
+        #    - lookup only the filePaths of the batch in the collection
+        for entry in self._collHpssPicoDsts.find({'filePath': {'$in': list(dictDocs.keys())}},
+                                                 {'filePath': True, '_id': False}):
+            element = dictDocs.pop(entry['filePath'], None)
             if element:
                 listDuplicates.append(element)
-                listDocs.remove(element)
+
+        listDocs = list(dictDocs.values())
 
         # -- Insert list of picoDsts in to HpssPicoDsts collection
+        #    - a picoDst inserted meanwhile by another htar worker is a duplicate as well
         if listDocs:
             print("Insert List: Add {0} picoDsts".format(len(listDocs)))
-            self._collHpssPicoDsts.insert_many(listDocs, ordered=False)
+            try:
+                self._collHpssPicoDsts.insert_many(listDocs, ordered=False)
+            except errors.BulkWriteError as err:
+                if any(error['code'] != 11000 for error in err.details['writeErrors']):
+                    raise
+                listDuplicates.extend(listDocs[error['index']] for error in err.details['writeErrors'])
 
         # -- Insert list of duplicate picoDsts in to HpssDuplicates collection
         if listDuplicates:
@@ -365,6 +1175,238 @@ class hpssUtil:
             self._collHpssDuplicates.insert_many(listDuplicates, ordered=False)
 
 
+    # _________________________________________________________
+    def _reindexPicoDsts(self, hpssDoc, listDocs):
+        """Update picoDsts of tar file in HPSS_PicoDsts to its re-read listing.
+
+           Only new picoDsts are inserted, the ones not in the listing anymore
+           removed and changed ones updated - the staging fields are kept, a
+           picoDst of another file stays the original. The duplicates of the
+           tar file are recorded anew.
+           """
+
+        self._collHpssDuplicates.delete_many({'fileFullPathTar': hpssDoc['fileFullPath']})
+
+        existingDocs = {doc['filePath']: doc for doc in
+                        self._collHpssPicoDsts.find({'fileFullPathTar': hpssDoc['fileFullPath']}, {'staging': False})}
+
+        setOfFilePaths = set()
+        listNewDocs    = []
+        listDuplicates = []
+        requests       = []
+
+        for doc in listDocs:
+            if doc['filePath'] in setOfFilePaths:
+                listDuplicates.append(doc)
+                continue
+            setOfFilePaths.add(doc['filePath'])
+
+            existingDoc = existingDocs.pop(doc['filePath'], None)
+            if not existingDoc:
+                listNewDocs.append(doc)
+                continue
+
+            update = {key: value for key, value in doc.items() if key != 'staging' and existingDoc.get(key) != value}
+            if update:
+                requests.append(UpdateOne({'_id': existingDoc['_id']}, {'$set': update}))
+
+        if requests:
+            self._collHpssPicoDsts.bulk_write(requests, ordered=False)
+
+        if existingDocs:
+            self._collHpssPicoDsts.delete_many({'_id': {'$in': [doc['_id'] for doc in existingDocs.values()]}})
+
+        # -- New ones - picoDsts of other files go to the duplicates
+        self._insertPicoDsts(listNewDocs)
+
+        if listDuplicates:
+            self._collHpssDuplicates.insert_many(listDuplicates, ordered=False)
+
+        print("Reindex {0}: {1} new, {2} updated, {3} removed picoDsts".format(hpssDoc['fileFullPath'], len(listNewDocs),
+                                                                               len(requests), len(existingDocs)))
+
+
+# ----------------------------------------------------------------------------------
+class pathSchemaRegistry:
+    """Registry of path schemas of picoDst paths.
+
+       The schema of a path is detected once per directory and a parser
+       for the directory is cached. Unknown schemas and file names are
+       counted and reported at the end.
+       """
+
+    # _________________________________________________________
+    def __init__(self, typedPathKeys, lengthFileSuffix):
+        self._typedPathKeys = typedPathKeys
+        self._lengthFileSuffix = lengthFileSuffix
+
+        self._typeMap = {'s': str, 'd': int, 'f': float}
+
+        # -- Schema for 7 tokens, without production
+        pathKeysSchema = 'runyear/system/energy/trigger/day%d/runnumber'
+        self._typedPathKeysNoProduction = [k.split('%') if '%' in k else [k, 's'] for k in pathKeysSchema.split(os.path.sep)]
+
+        self._parsers = {}
+        self._lock = threading.Lock()
+
+        self._unknownSchemas   = collections.Counter()
+        self._unknownFileNames = collections.Counter()
+
+    # _________________________________________________________
+    def getParser(self, dirPath):
+        """Get cached parser for directory or create it."""
+
+        parser = self._parsers.get(dirPath)
+        if parser:
+            return parser
+
+        # -- Keep the cache bounded
+        if len(self._parsers) >= PATH_SCHEMA_CACHE_SIZE:
+            self._parsers.clear()
+
+        parser = pathParser(self, dirPath.split(os.path.sep))
+        self._parsers[dirPath] = parser
+        return parser
+
+    # _________________________________________________________
+    def getTypedPathKeys(self, tokenizedPath):
+        """Get typed path keys for different scenarios.
+
+           tokenizedPath includes the fileName.
+           """
+
+        # -- Default case
+        if len(tokenizedPath) == 8:
+            return self._typedPathKeys
+
+        elif len(tokenizedPath) == 7:
+            dateIdx = self._getDateIndex(tokenizedPath)
+
+            if dateIdx == 4 and "GeV" in tokenizedPath[2]:
+                return self._typedPathKeysNoProduction
+
+        # -- Schema not known - use default
+        self.countUnknownSchema(len(tokenizedPath))
+        return self._typedPathKeys
+
+    # _________________________________________________________
+    def _getDateIndex(self, tokenizedPath):
+        """Get index of date field."""
+
+        for idx in range(len(tokenizedPath)):
+            try:
+                if int(tokenizedPath[idx]) <= 370:
+                    return idx
+            except ValueError:
+                pass
+        return -1
+
+    # _________________________________________________________
+    def countUnknownSchema(self, nTokens):
+        """Count directories with unknown schema, by number of path tokens."""
+
+        with self._lock:
+            self._unknownSchemas[nTokens] += 1
+
+    # _________________________________________________________
+    def countUnknownFileName(self, dirPath):
+        """Count files with unknown file name schema, by directory."""
+
+        with self._lock:
+            self._unknownFileNames[dirPath] += 1
+
+    # _________________________________________________________
+    def printReport(self):
+        """Print report of unknown schemas."""
+
+        if self._unknownSchemas:
+            print("SCHEMA NOT KNOWN !!! - used default schema for directories with:")
+            for nTokens, nDirs in sorted(self._unknownSchemas.items()):
+                print("   {0} path tokens: {1} directories".format(nTokens, nDirs))
+
+        if self._unknownFileNames:
+            print("FILE NAME SCHEMA NOT KNOWN !!! - stream and picoType set to 'xx' for {0} files in:".format(sum(self._unknownFileNames.values())))
+            for dirPath, nFiles in self._unknownFileNames.most_common():
+                print("   {0}: {1} files".format(dirPath, nFiles))
+
+# ----------------------------------------------------------------------------------
+class pathParser:
+    """Parser of picoDst file names in one directory.
+
+       The typed STAR details of the directory and the regex to get the
+       stream from the fileName are created once.
+       """
+
+    # _________________________________________________________
+    def __init__(self, registry, tokenizedDir):
+        self._registry = registry
+        self._dirPath = os.path.sep.join(tokenizedDir)
+        self._lengthFileSuffix = registry._lengthFileSuffix
+        self._typeMap = registry._typeMap
+
+        # -- Get TypedKeys for tokenized path - incl. a placeholder for the fileName
+        typedPathKeys = registry.getTypedPathKeys(tokenizedDir + [''])
+
+        # -- STAR details of the directory
+        self._dirStarDetails = dict([(keys[0], self._typeMap[keys[1]](value))
+                                     for keys, value in zip(typedPathKeys, tokenizedDir)])
+
+        # -- Key of fileName token, only for unknown schemas with less tokens than keys
+        self._fileNameKey = typedPathKeys[len(tokenizedDir)] if len(typedPathKeys) > len(tokenizedDir) else None
+
+        # -- Create a regex pattern to get the stream from the fileName
+        self._regexStream = None
+        if not self._fileNameKey or self._fileNameKey[0] != 'runnumber':
+            self._regexStream = re.compile('(st_.*)_{}'.format(self._dirStarDetails.get('runnumber', '')))
+
+    # _________________________________________________________
+    def parse(self, fileName):
+        """Create STAR details sub document for fileName."""
+
+        docStarDetails = dict(self._dirStarDetails)
+
+        if self._fileNameKey:
+            docStarDetails[self._fileNameKey[0]] = self._typeMap[self._fileNameKey[1]](fileName)
+
+        regexStream = self._regexStream
+        if not regexStream:
+            regexStream = re.compile('(st_.*)_{}'.format(docStarDetails.get('runnumber', '')))
+
+        fileNameParts = regexStream.split(fileName)
+        if len(fileNameParts) == 3 and len(fileNameParts[0]) == 0:
+            docStarDetails['stream'] = fileNameParts[1]
+
+            strippedSuffix = fileNameParts[-1][1:-self._lengthFileSuffix]
+            strippedSuffixParts = strippedSuffix.split('_')
+
+            docStarDetails['picoType'] = strippedSuffixParts[0] \
+                if len(strippedSuffixParts) == 2 \
+                else strippedSuffix
+        else:
+            self._registry.countUnknownFileName(self._dirPath)
+            docStarDetails['stream'] = 'xx'
+            docStarDetails['picoType'] = 'xx'
+
+        return docStarDetails
+
+# ____________________________________________________________________________
+def parseTapeLine(lineTokenized):
+    """Parse tokenized line (as bytes) of "hsi ls -P" output.
+
+       Returns path, tape volume and position [section, offset] of a file on
+       tape - None for other lines.
+       """
+
+    if len(lineTokenized) < 6 or lineTokenized[0] != b'FILE':
+        return None
+
+    matchPosition = TAPE_POSITION_PATTERN.match(lineTokenized[4])
+    if not matchPosition:
+        return None
+
+    return lineTokenized[1].decode('utf-8'), lineTokenized[5].decode('utf-8'), \
+        [int(matchPosition.group(1)), int(matchPosition.group(2))]
+
 # ____________________________________________________________________________
 def checkForHPSSTransfer():
     """Check for ongoing transfer of files into HPSS"""
@@ -386,21 +1428,52 @@ def checkForHPSSTransfer():
 def main():
     """initialize and run"""
 
+    parser = argparse.ArgumentParser(description='Crawl over HPSS picoDst folders and populate mongoDB collections.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of run folders crawled in parallel (max: {0} minus htar workers)'.format(HPSS_MAX_SESSIONS))
+    parser.add_argument('--htarWorkers', type=int, default=1,
+                        help='number of new tar files listed in parallel (max: {0})'.format(HPSS_MAX_SESSIONS - 1))
+    parser.add_argument('--reindex', action='store_true',
+                        help='rebuild picoDsts of all tar files from cached listings - no crawl')
+    parser.add_argument('--maxLostPercent', type=float, default=HPSS_MAX_LOST_PERCENT,
+                        help='max percentage of files marked as lost in one crawl cycle (default: {0})'.format(HPSS_MAX_LOST_PERCENT))
+    parser.add_argument('--replay', metavar='DIR',
+                        help='read hsi/htar output from capture files in DIR instead of HPSS')
+    parser.add_argument('--record', metavar='DIR',
+                        help='write hsi/htar output to capture files in DIR')
+    parser.add_argument('--mongoUri',
+                        help='connect to this mongoDB (i.e. mongodb://localhost:27017) instead of the NERSC mongoDB')
+    parser.add_argument('--backend', choices=MONGO_BACKENDS,
+                        help='mongoDB backend, memory for tests with --replay (default: env SDMS_MONGO_BACKEND or nersc)')
+    args = parser.parse_args()
+
+    if args.replay and args.record:
+        print ("Abort - Replay and record mode exclude each other")
+        return
+
     # -- Check for ongoing transfer into HPSS
-    if checkForHPSSTransfer():
+    if not args.replay and checkForHPSSTransfer():
         print ("Abort - Data is currently moved to HPSS")
         return
 
     # -- Connect to mongoDB
-    dbUtil = mongoDbUtil("", "admin")
+    dbUtil = mongoDbUtil(args, "admin")
 
     collHpssFiles      = dbUtil.getCollection("HPSS_Files")
     collHpssPicoDsts   = dbUtil.getCollection("HPSS_PicoDsts")
     collHpssDuplicates = dbUtil.getCollection("HPSS_Duplicates")
+    collHpssCheckpoints = dbUtil.getCollection("HPSS_Checkpoints")
+    collHpssCrawls     = dbUtil.getCollection("HPSS_Crawls")
 
     hpss = hpssUtil()
-    hpss.setCollections(collHpssFiles, collHpssPicoDsts, collHpssDuplicates)
-    hpss.getFileList()
+    hpss.setCollections(collHpssFiles, collHpssPicoDsts, collHpssDuplicates, collHpssCheckpoints, collHpssCrawls)
+    hpss.setCrawlMode(args.maxLostPercent)
+    hpss.setReplayMode(args.replay, args.record)
+
+    if args.reindex:
+        hpss.reindexTarFiles(args.htarWorkers)
+    else:
+        hpss.getFileList(args.workers, args.htarWorkers)
 
     dbUtil.close()
 
@@ -114,7 +114,8 @@ class crawlerXRD:
         if self._collDataServer.find({'nodeName': self._nodeName, 'isDataServerXRD': True}).count() == 0:
             # -- Add files to DB as missing - if there are some
             if listOfFilesOnNode:
-                self._insertMissingFilePaths(listOfFilesOnNode, target)
+                with self._dbUtil.getBulkWriter('crawlerXRD') as writer:
+                    self._insertMissingFilePaths(listOfFilesOnNode, target, writer)
             self._crawlerWasRun = True
             return
 
@@ -125,7 +126,8 @@ class crawlerXRD:
         if not os.path.isdir(self._workDir):
             # -- Add missing files to DB - if there are some
             if listOfFilesOnNode:
-                self._insertMissingFilePaths(listOfFilesOnNode, target)
+                with self._dbUtil.getBulkWriter('crawlerXRD') as writer:
+                    self._insertMissingFilePaths(listOfFilesOnNode, target, writer)
             self._crawlerWasRun = True
             return
 
@@ -137,7 +139,7 @@ class crawlerXRD:
                       if os.path.isdir(os.path.join(self._workDir, name))
                       and os.path.join(self._workDir, name) not in ignoreList]
 
-        listOfNewFiles = []
+        writer = self._dbUtil.getBulkWriter('crawlerXRD')
 
         # -- Run over folders for target
         for folder in folderList:
@@ -159,10 +161,7 @@ class crawlerXRD:
                     except OSError as e:
                         doc['issue'] = 'brokenLink'
                         doc['nodeFilePath'] = '{0}_{1}'.format(self._nodeName, doc['filePath'])
-                        try:
-                            self._collsNoLink[target].insert(doc)
-                        except:
-                            pass
+                        writer.insert(self._collsNoLink[target], doc)
                         continue
 
                     doc['fileSize'] = fstat.st_size
@@ -174,22 +173,20 @@ class crawlerXRD:
                         listOfFilesOnNode.remove(doc['filePath'])
                         continue
 
-                    # -- New file add to list of files to be added
-                    listOfNewFiles.append(doc)
-
-        # -- Add new files to DB
-        if listOfNewFiles:
-            self._collsNew[target].insert_many(listOfNewFiles, ordered=False)
+                    # -- New file add to DB
+                    writer.insert(self._collsNew[target], doc)
 
         # -- Add missing files to DB
         if listOfFilesOnNode:
-            self._insertMissingFilePaths(listOfFilesOnNode, target)
+            self._insertMissingFilePaths(listOfFilesOnNode, target, writer)
+
+        writer.close()
 
         self._crawlerWasRun = True
 
     # _________________________________________________________
-    def _insertMissingFilePaths(self, filePathList, target):
-        """insert list of filePaths to missing collection"""
+    def _insertMissingFilePaths(self, filePathList, target, writer):
+        """insert list of filePaths to missing collection - via bulk writer"""
 
         for filePath in filePathList:
             doc = {'fileFullPath': "",
@@ -201,7 +198,7 @@ class crawlerXRD:
                 'fileSize': -1,
                 'issue': 'missing'}
 
-            self._collsMiss[target].insert(doc)
+            writer.insert(self._collsMiss[target], doc)
 
     # _________________________________________________________
     def updateServerInfo(self):
@@ -38,7 +38,7 @@ done
 
 pushd ~/SDMS > /dev/null
 
-python crawlerHPSS.py
+python crawlerHPSS.py --workers 4 --htarWorkers 4
 
 python reportSDMS.py
 
@@ -37,12 +37,13 @@ class hpssInspectUtil:
                              5: 'isInTarFile'}
 
     # _________________________________________________________
-    def setCollections(self, collHpssFiles, collHpssPicoDsts, collHpssDuplicates):
+    def setCollections(self, collHpssFiles, collHpssPicoDsts, collHpssDuplicates, collHpssCrawls):
         """Get collection from mongoDB."""
 
         self._collHpssFiles      = collHpssFiles
         self._collHpssPicoDsts   = collHpssPicoDsts
         self._collHpssDuplicates = collHpssDuplicates
+        self._collHpssCrawls     = collHpssCrawls
 
     # ____________________________________________________________________________
     def generalInfo(self):
@@ -60,20 +61,28 @@ class hpssInspectUtil:
 
     # ____________________________________________________________________________
     def inspector(self):
-        """Check if all files are still on HPSS."""
+        """Check if all files are still on HPSS.
+
+           Files not seen in a finished crawl epoch are marked as lost by the crawler.
+           """
 
         print('\n==---------------------------------------------------------==')
-        print('Inspector - check for files, changed within the last {0} days'.format(self._nDaysAgo))
+        print('Inspector - check for files, lost in the finished crawl epochs')
         print('==---------------------------------------------------------==')
 
         nDaysAgo = (datetime.date.today() - datetime.timedelta(days=self._nDaysAgo)).strftime('%Y-%m-%d')
 
-        lostPicoDsts = list(self._collHpssFiles.find({'lastSeen': {"$lt" : nDaysAgo}}))
+        # -- The marks are only up to date, if a crawl epoch has been finished recently
+        lastEpochDoc = self._collHpssCrawls.find_one({'finished': {'$ne': None}}, sort=[('epoch', -1)])
+        if not lastEpochDoc or lastEpochDoc['finished'] < nDaysAgo:
+            print("No crawl epoch has been finished within the last", self._nDaysAgo, "days!")
+
+        lostPicoDsts = list(self._collHpssFiles.find({'lostEpoch': {'$exists': True}}))
         if lostPicoDsts:
-            print("These files (", len(lostPicoDsts),") have not been seen for the last", self._nDaysAgo,"days!")
+            print("These files (", len(lostPicoDsts),") have not been seen on HPSS anymore!")
 
             for entry in lostPicoDsts:
-                print("  ", entry['fileFullPath'], "- last seen:", entry['lastSeen'])
+                print("  ", entry['fileFullPath'], "- last seen:", entry.get('lastSeen'), "- lost in crawl epoch:", entry['lostEpoch'])
 
     # ____________________________________________________________________________
     def printOverviewPicoDst(self):
@@ -197,9 +206,10 @@ def main():
     collHpssFiles      = dbUtil.getCollection("HPSS_Files")
     collHpssPicoDsts   = dbUtil.getCollection("HPSS_PicoDsts")
     collHpssDuplicates = dbUtil.getCollection("HPSS_Duplicates")
+    collHpssCrawls     = dbUtil.getCollection("HPSS_Crawls")
 
     inspect = hpssInspectUtil(N_DAYS_AGO)
-    inspect.setCollections(collHpssFiles, collHpssPicoDsts, collHpssDuplicates)
+    inspect.setCollections(collHpssFiles, collHpssPicoDsts, collHpssDuplicates, collHpssCrawls)
 
     # -- Print General Info
 #    inspect.generalInfo()
@@ -0,0 +1,1496 @@
+#!/usr/bin/env python
+b'This script requires python 3.4'
+
+"""
+In-process stand-in for the mongoDB server, used by mongoDbUtil with the
+'memory' backend for tests, load tests and benchmarks without a server.
+
+It implements the subset of the pymongo client, database, collection and
+cursor API and of the query, update and aggregation operators used by SDMS.
+Indices are kept as hash maps: equality and $in queries on indexed fields
+are lookups, all other queries scan the collection.
+
+The semantics SDMS relies on are checked against the expected mongod
+results - and against a real mongod, if given - by
+    python mongoMemory.py [--mongoUri mongodb://localhost:27017]
+
+For detailed documentation, see: README.md
+"""
+
+import sys
+import re
+import datetime
+import argparse
+import threading
+import collections
+
+from bson import ObjectId
+from pymongo import results
+from pymongo import errors
+from pymongo import ReturnDocument
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+
+##############################################
+# -- GLOBAL CONSTANTS
+
+# -- BSON type order used for sorting and comparisons
+TYPE_ORDER_NULL     = 1
+TYPE_ORDER_NUMBER   = 2
+TYPE_ORDER_STRING   = 3
+TYPE_ORDER_OBJECT   = 4
+TYPE_ORDER_ARRAY    = 5
+TYPE_ORDER_OBJECTID = 7
+TYPE_ORDER_BOOL     = 8
+TYPE_ORDER_DATE     = 9
+TYPE_ORDER_OTHER    = 10
+
+DUPLICATE_KEY_ERROR = 11000
+
+##############################################
+
+# -- Check for a proper Python Version
+if sys.version[0:3] < '3.0':
+    print ('Python version 3.0 or greater required (found: {0}).'.format(sys.version[0:5]))
+    sys.exit(-1)
+
+# -- Shared client of this process
+_client = None
+_clientLock = threading.Lock()
+
+# ____________________________________________________________________________
+def getClient():
+    """Get the shared memoryClient of this process."""
+
+    global _client
+
+    with _clientLock:
+        if not _client:
+            _client = memoryClient()
+        return _client
+
+# ----------------------------------------------------------------------------------
+class memoryClient:
+    """In-process stand-in of pymongo.MongoClient."""
+
+    # _________________________________________________________
+    def __init__(self):
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    # _________________________________________________________
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = memoryDatabase(self, name)
+            return self._databases[name]
+
+    # _________________________________________________________
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    # _________________________________________________________
+    def get_database(self, name):
+        return self[name]
+
+    # _________________________________________________________
+    def list_database_names(self):
+        return list(self._databases.keys())
+
+    # _________________________________________________________
+    def drop_database(self, name):
+        if not isinstance(name, str):
+            name = name.name
+
+        # -- Handles of the database and its collections see empty collections afterwards
+        with self._lock:
+            database = self._databases.get(name)
+        if database:
+            for collectionName in list(database._collections.keys()):
+                database.drop_collection(collectionName)
+
+    # _________________________________________________________
+    def server_info(self):
+        return {'version': 'memory'}
+
+    # _________________________________________________________
+    def close(self):
+        """Nothing to close - the data is kept for the lifetime of the process."""
+
+        pass
+
+# ----------------------------------------------------------------------------------
+class memoryDatabase:
+    """In-process stand-in of pymongo.database.Database."""
+
+    # _________________________________________________________
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    # _________________________________________________________
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = memoryCollection(self, name)
+            return self._collections[name]
+
+    # _________________________________________________________
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    # _________________________________________________________
+    def get_collection(self, name):
+        return self[name]
+
+    # _________________________________________________________
+    def list_collection_names(self):
+        with self._lock:
+            return [name for name, collection in self._collections.items() if collection._isCreated]
+
+    # _________________________________________________________
+    def collection_names(self, include_system_collections = True):
+        return self.list_collection_names()
+
+    # _________________________________________________________
+    def drop_collection(self, name):
+        if not isinstance(name, str):
+            name = name.name
+
+        # -- Handles of the collection see an empty collection afterwards - as with pymongo
+        with self._lock:
+            collection = self._collections.get(name)
+        if collection:
+            collection._reset()
+
+# ----------------------------------------------------------------------------------
+class memoryCollection:
+    """In-process stand-in of pymongo.collection.Collection.
+
+       Documents are stored by _id in insertion order. Every index keeps a
+       hash map of the values of its first field, unique indices also a map
+       of their full key.
+       """
+
+    # _________________________________________________________
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '{0}.{1}'.format(database.name, name)
+
+        self._lock = threading.RLock()
+        self._reset()
+
+    # _________________________________________________________
+    def _reset(self):
+        """Reset to an empty, not created collection - used by drop."""
+
+        with self._lock:
+            self._isCreated = False
+
+            self._docs = collections.OrderedDict()
+            self._seq = {}
+            self._nextSeq = 0
+            self._indexes = {}
+            self._valueMaps = {}
+
+            self._addIndex('_id_', [('_id', 1)], unique=True, sparse=False)
+
+    # _________________________________________________________
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    # _________________________________________________________
+    def with_options(self, **kwargs):
+        return self
+
+    # ---------------------------------------------------------
+    # -- Indices
+    # ---------------------------------------------------------
+
+    # _________________________________________________________
+    def create_index(self, keys, **kwargs):
+        """Create index - keys as field name or list of (field, direction)."""
+
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+
+        name = kwargs.get('name') or '_'.join(['{0}_{1}'.format(field, direction) for field, direction in keys])
+        with self._lock:
+            self._isCreated = True
+            if name not in self._indexes:
+                self._addIndex(name, list(keys), unique=kwargs.get('unique', False), sparse=kwargs.get('sparse', False))
+        return name
+
+    # _________________________________________________________
+    def create_indexes(self, indexes):
+        """Create indices from list of pymongo.IndexModel."""
+
+        names = []
+        for index in indexes:
+            document = dict(index.document)
+            keys = list(document.pop('key').items())
+            names.append(self.create_index(keys, **document))
+        return names
+
+    # _________________________________________________________
+    def index_information(self):
+        with self._lock:
+            info = {}
+            for name, index in self._indexes.items():
+                info[name] = {'key': list(index['key'])}
+                if index['unique'] and name != '_id_':
+                    info[name]['unique'] = True
+                if index['sparse']:
+                    info[name]['sparse'] = True
+            return info
+
+    # _________________________________________________________
+    def drop_index(self, name):
+        with self._lock:
+            index = self._indexes.pop(name)
+            field = index['key'][0][0]
+            if not any(other['key'][0][0] == field for other in self._indexes.values()):
+                self._valueMaps.pop(field, None)
+
+    # _________________________________________________________
+    def _addIndex(self, name, keys, unique, sparse):
+        """Add index and fill it with the existing documents."""
+
+        index = {'key': keys, 'unique': unique, 'sparse': sparse, 'map': {}}
+
+        if unique:
+            for idKey, doc in self._docs.items():
+                indexKey = self._getIndexKey(index, doc)
+                if indexKey is None:
+                    continue
+                if indexKey in index['map']:
+                    raise errors.DuplicateKeyError('E11000 duplicate key error collection: {0} index: {1}'.format(self.full_name, name),
+                                                   DUPLICATE_KEY_ERROR)
+                index['map'][indexKey] = idKey
+
+        self._indexes[name] = index
+
+        field = keys[0][0]
+        if field not in self._valueMaps:
+            valueMap = {}
+            for idKey, doc in self._docs.items():
+                for value in _getIndexValues(doc, field):
+                    valueMap.setdefault(value, set()).add(idKey)
+            self._valueMaps[field] = valueMap
+
+    # _________________________________________________________
+    def _getIndexKey(self, index, doc):
+        """Get key of unique index for document - None if not indexed (sparse)."""
+
+        indexKey = []
+        isMissing = True
+        for field, direction in index['key']:
+            values, exists = _resolvePath(doc, field)
+            isMissing = isMissing and not exists
+            indexKey.append(_hashable(values[0]) if exists and values else None)
+
+        if index['sparse'] and isMissing:
+            return None
+        return tuple(indexKey)
+
+    # _________________________________________________________
+    def _checkUniqueIndexes(self, doc, idKey):
+        """Raise DuplicateKeyError if document violates a unique index."""
+
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            indexKey = self._getIndexKey(index, doc)
+            if indexKey is None:
+                continue
+            other = index['map'].get(indexKey)
+            if other is not None and other != idKey:
+                raise errors.DuplicateKeyError('E11000 duplicate key error collection: {0} index: {1} dup key: {2}'.format(self.full_name, name, indexKey),
+                                               DUPLICATE_KEY_ERROR)
+
+    # _________________________________________________________
+    def _indexDoc(self, doc, idKey):
+        for index in self._indexes.values():
+            if index['unique']:
+                indexKey = self._getIndexKey(index, doc)
+                if indexKey is not None:
+                    index['map'][indexKey] = idKey
+
+        for field, valueMap in self._valueMaps.items():
+            for value in _getIndexValues(doc, field):
+                valueMap.setdefault(value, set()).add(idKey)
+
+    # _________________________________________________________
+    def _unindexDoc(self, doc, idKey):
+        for index in self._indexes.values():
+            if index['unique']:
+                indexKey = self._getIndexKey(index, doc)
+                if indexKey is not None and index['map'].get(indexKey) == idKey:
+                    del index['map'][indexKey]
+
+        for field, valueMap in self._valueMaps.items():
+            for value in _getIndexValues(doc, field):
+                ids = valueMap.get(value)
+                if ids:
+                    ids.discard(idKey)
+                    if not ids:
+                        del valueMap[value]
+
+    # ---------------------------------------------------------
+    # -- Internal storage
+    # ---------------------------------------------------------
+
+    # _________________________________________________________
+    def _insertDoc(self, doc):
+        """Insert copy of document, sets _id in document."""
+
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+
+        stored = _copyDoc(doc)
+        idKey = _hashable(stored['_id'])
+
+        if idKey in self._docs:
+            raise errors.DuplicateKeyError('E11000 duplicate key error collection: {0} index: _id_ dup key: {1}'.format(self.full_name, stored['_id']),
+                                           DUPLICATE_KEY_ERROR)
+        self._checkUniqueIndexes(stored, idKey)
+
+        self._isCreated = True
+        self._docs[idKey] = stored
+        self._seq[idKey] = self._nextSeq
+        self._nextSeq += 1
+        self._indexDoc(stored, idKey)
+
+        return stored['_id']
+
+    # _________________________________________________________
+    def _replaceDoc(self, idKey, newDoc):
+        """Replace stored document, checking unique indices first."""
+
+        oldDoc = self._docs[idKey]
+        self._unindexDoc(oldDoc, idKey)
+        try:
+            self._checkUniqueIndexes(newDoc, idKey)
+        except errors.DuplicateKeyError:
+            self._indexDoc(oldDoc, idKey)
+            raise
+
+        self._docs[idKey] = newDoc
+        self._indexDoc(newDoc, idKey)
+
+    # _________________________________________________________
+    def _deleteDoc(self, idKey):
+        doc = self._docs.pop(idKey)
+        del self._seq[idKey]
+        self._unindexDoc(doc, idKey)
+
+    # _________________________________________________________
+    def _getCandidates(self, query):
+        """Get ids of candidate documents for query, using the index maps."""
+
+        bestIds = None
+
+        for field, cond in query.items():
+            if field.startswith('$') or field not in self._valueMaps:
+                continue
+
+            if _isOperatorDict(cond):
+                if list(cond.keys()) != ['$in']:
+                    continue
+                listValues = cond['$in']
+            elif isinstance(cond, (dict, list)) or cond is None or _isRegex(cond):
+                continue
+            else:
+                listValues = [cond]
+
+            if any(value is None or isinstance(value, (dict, list)) or _isRegex(value) for value in listValues):
+                continue
+
+            ids = set()
+            for value in listValues:
+                ids.update(self._valueMaps[field].get(_hashable(value), ()))
+
+            if bestIds is None or len(ids) < len(bestIds):
+                bestIds = ids
+
+        if bestIds is None:
+            return list(self._docs.keys())
+
+        # -- Keep insertion order
+        return sorted(bestIds, key=self._seq.get)
+
+    # _________________________________________________________
+    def _findIds(self, query, sort = None, skip = 0, limit = 0):
+        """Get ids of matching documents, sorted, skipped and limited."""
+
+        query = query or {}
+
+        idKeys = [idKey for idKey in self._getCandidates(query) if _matchDoc(self._docs[idKey], query)]
+
+        if sort:
+            for field, direction in reversed(sort):
+                idKeys.sort(key=lambda idKey: _sortKey(_resolveSortValue(self._docs[idKey], field, direction)),
+                            reverse=direction < 0)
+
+        if skip:
+            idKeys = idKeys[skip:]
+        if limit:
+            idKeys = idKeys[:limit]
+
+        return idKeys
+
+    # ---------------------------------------------------------
+    # -- Read
+    # ---------------------------------------------------------
+
+    # _________________________________________________________
+    def find(self, filter = None, projection = None, **kwargs):
+        return memoryCursor(self, filter, projection, sort=kwargs.get('sort'),
+                            skip=kwargs.get('skip', 0), limit=kwargs.get('limit', 0))
+
+    # _________________________________________________________
+    def find_one(self, filter = None, projection = None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+
+        for doc in self.find(filter, projection, **kwargs).limit(1):
+            return doc
+        return None
+
+    # _________________________________________________________
+    def count(self, filter = None, **kwargs):
+        with self._lock:
+            if not filter:
+                return len(self._docs)
+            return len(self._findIds(filter))
+
+    # _________________________________________________________
+    def count_documents(self, filter, **kwargs):
+        with self._lock:
+            return len(self._findIds(filter, skip=kwargs.get('skip', 0), limit=kwargs.get('limit', 0)))
+
+    # _________________________________________________________
+    def estimated_document_count(self, **kwargs):
+        with self._lock:
+            return len(self._docs)
+
+    # _________________________________________________________
+    def distinct(self, key, filter = None, **kwargs):
+        with self._lock:
+            return _distinct([self._docs[idKey] for idKey in self._findIds(filter)], key)
+
+    # _________________________________________________________
+    def aggregate(self, pipeline, **kwargs):
+        """Run aggregation pipeline: $match, $group, $sort, $skip, $limit, $project, $unwind, $count."""
+
+        with self._lock:
+            listDocs = [_copyDoc(doc) for doc in self._docs.values()]
+
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+
+            if operator == '$match':
+                listDocs = [doc for doc in listDocs if _matchDoc(doc, spec)]
+            elif operator == '$group':
+                listDocs = _group(listDocs, spec)
+            elif operator == '$sort':
+                for field, direction in reversed(list(spec.items())):
+                    listDocs.sort(key=lambda doc: _sortKey(_resolveSortValue(doc, field, direction)), reverse=direction < 0)
+            elif operator == '$skip':
+                listDocs = listDocs[spec:]
+            elif operator == '$limit':
+                listDocs = listDocs[:spec]
+            elif operator == '$project':
+                listDocs = [_project(doc, spec) for doc in listDocs]
+            elif operator == '$unwind':
+                listDocs = _unwind(listDocs, spec)
+            elif operator == '$count':
+                listDocs = [{spec: len(listDocs)}]
+            else:
+                raise errors.OperationFailure('Unsupported aggregation stage: {0}'.format(operator))
+
+        return iter(listDocs)
+
+    # ---------------------------------------------------------
+    # -- Write
+    # ---------------------------------------------------------
+
+    # _________________________________________________________
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            return results.InsertOneResult(self._insertDoc(document), True)
+
+    # _________________________________________________________
+    def insert_many(self, documents, ordered = True, **kwargs):
+        insertedIds = []
+        writeErrors = []
+
+        with self._lock:
+            for idx, doc in enumerate(documents):
+                try:
+                    insertedIds.append(self._insertDoc(doc))
+                except errors.DuplicateKeyError as err:
+                    writeErrors.append({'index': idx, 'code': DUPLICATE_KEY_ERROR, 'errmsg': str(err), 'op': doc})
+                    if ordered:
+                        break
+
+        if writeErrors:
+            raise errors.BulkWriteError(_bulkResult(nInserted=len(insertedIds), writeErrors=writeErrors))
+
+        return results.InsertManyResult(insertedIds, True)
+
+    # _________________________________________________________
+    def insert(self, doc_or_docs, **kwargs):
+        """Legacy insert of document or list of documents."""
+
+        if isinstance(doc_or_docs, list):
+            return self.insert_many(doc_or_docs).inserted_ids
+        return self.insert_one(doc_or_docs).inserted_id
+
+    # _________________________________________________________
+    def _update(self, filter, update, upsert, multi, isReplace = False):
+        """Update one or all matching documents.
+
+           Returns number of matched and modified documents and the upserted _id.
+           """
+
+        with self._lock:
+            idKeys = self._findIds(filter, limit=0 if multi else 1)
+
+            nModified = 0
+            for idKey in idKeys:
+                oldDoc = self._docs[idKey]
+                newDoc = _replacementDoc(oldDoc, update) if isReplace else _applyUpdate(_copyDoc(oldDoc), update, False)
+                if newDoc != oldDoc:
+                    self._replaceDoc(idKey, newDoc)
+                    nModified += 1
+
+            if idKeys or not upsert:
+                return len(idKeys), nModified, None
+
+            # -- Upsert: new document from the equality fields of the filter
+            if isReplace:
+                newDoc = _copyDoc(update)
+            else:
+                newDoc = _applyUpdate(_upsertDocFromFilter(filter), update, True)
+            if '_id' in filter and not _isOperatorDict(filter['_id']):
+                newDoc['_id'] = filter['_id']
+
+            return 0, 0, self._insertDoc(newDoc)
+
+    # _________________________________________________________
+    def update_one(self, filter, update, upsert = False, **kwargs):
+        _checkUpdate(update)
+        nMatched, nModified, upsertedId = self._update(filter, update, upsert, multi=False)
+        return results.UpdateResult(_updateRawResult(nMatched, nModified, upsertedId), True)
+
+    # _________________________________________________________
+    def update_many(self, filter, update, upsert = False, **kwargs):
+        _checkUpdate(update)
+        nMatched, nModified, upsertedId = self._update(filter, update, upsert, multi=True)
+        return results.UpdateResult(_updateRawResult(nMatched, nModified, upsertedId), True)
+
+    # _________________________________________________________
+    def replace_one(self, filter, replacement, upsert = False, **kwargs):
+        nMatched, nModified, upsertedId = self._update(filter, replacement, upsert, multi=False, isReplace=True)
+        return results.UpdateResult(_updateRawResult(nMatched, nModified, upsertedId), True)
+
+    # _________________________________________________________
+    def delete_one(self, filter, **kwargs):
+        with self._lock:
+            idKeys = self._findIds(filter, limit=1)
+            for idKey in idKeys:
+                self._deleteDoc(idKey)
+        return results.DeleteResult({'n': len(idKeys), 'ok': 1.0}, True)
+
+    # _________________________________________________________
+    def delete_many(self, filter, **kwargs):
+        with self._lock:
+            idKeys = self._findIds(filter)
+            for idKey in idKeys:
+                self._deleteDoc(idKey)
+        return results.DeleteResult({'n': len(idKeys), 'ok': 1.0}, True)
+
+    # _________________________________________________________
+    def find_one_and_update(self, filter, update, projection = None, sort = None, upsert = False,
+                            return_document = ReturnDocument.BEFORE, **kwargs):
+        _checkUpdate(update)
+        return self._findOneAndModify(filter, update, projection, sort, upsert, return_document)
+
+    # _________________________________________________________
+    def find_one_and_replace(self, filter, replacement, projection = None, sort = None, upsert = False,
+                             return_document = ReturnDocument.BEFORE, **kwargs):
+        return self._findOneAndModify(filter, replacement, projection, sort, upsert, return_document, isReplace=True)
+
+    # _________________________________________________________
+    def find_one_and_delete(self, filter, projection = None, sort = None, **kwargs):
+        with self._lock:
+            idKeys = self._findIds(filter, sort=_normalizeSort(sort), limit=1)
+            if not idKeys:
+                return None
+            doc = self._docs[idKeys[0]]
+            self._deleteDoc(idKeys[0])
+            return _project(doc, projection)
+
+    # _________________________________________________________
+    def _findOneAndModify(self, filter, update, projection, sort, upsert, returnDocument, isReplace = False):
+        """Atomically modify the first matching document and return it."""
+
+        with self._lock:
+            idKeys = self._findIds(filter, sort=_normalizeSort(sort), limit=1)
+
+            if idKeys:
+                oldDoc = self._docs[idKeys[0]]
+                newDoc = _replacementDoc(oldDoc, update) if isReplace else _applyUpdate(_copyDoc(oldDoc), update, False)
+                if newDoc != oldDoc:
+                    self._replaceDoc(idKeys[0], newDoc)
+                return _project(newDoc if returnDocument == ReturnDocument.AFTER else oldDoc, projection)
+
+            if not upsert:
+                return None
+
+            nMatched, nModified, upsertedId = self._update(filter, update, True, multi=False, isReplace=isReplace)
+            if returnDocument == ReturnDocument.AFTER:
+                return _project(self._docs[_hashable(upsertedId)], projection)
+            return None
+
+    # _________________________________________________________
+    def bulk_write(self, requests, ordered = True, **kwargs):
+        """Bulk write of pymongo operations: InsertOne, UpdateOne, UpdateMany,
+           ReplaceOne, DeleteOne and DeleteMany.
+           """
+
+        bulkResult = _bulkResult()
+
+        with self._lock:
+            for idx, request in enumerate(requests):
+                try:
+                    if isinstance(request, InsertOne):
+                        self._insertDoc(request._doc)
+                        bulkResult['nInserted'] += 1
+
+                    elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                        isReplace = isinstance(request, ReplaceOne)
+                        if not isReplace:
+                            _checkUpdate(request._doc)
+                        nMatched, nModified, upsertedId = self._update(request._filter, request._doc, request._upsert,
+                                                                       multi=isinstance(request, UpdateMany),
+                                                                       isReplace=isReplace)
+                        bulkResult['nMatched']  += nMatched
+                        bulkResult['nModified'] += nModified
+                        if upsertedId is not None:
+                            bulkResult['nUpserted'] += 1
+                            bulkResult['upserted'].append({'index': idx, '_id': upsertedId})
+
+                    elif isinstance(request, (DeleteOne, DeleteMany)):
+                        if isinstance(request, DeleteOne):
+                            bulkResult['nRemoved'] += self.delete_one(request._filter).deleted_count
+                        else:
+                            bulkResult['nRemoved'] += self.delete_many(request._filter).deleted_count
+
+                    else:
+                        raise TypeError('{0} is not a valid request'.format(request))
+
+                except errors.DuplicateKeyError as err:
+                    bulkResult['writeErrors'].append({'index': idx, 'code': DUPLICATE_KEY_ERROR,
+                                                      'errmsg': str(err), 'op': request})
+                    if ordered:
+                        break
+
+        if bulkResult['writeErrors']:
+            raise errors.BulkWriteError(bulkResult)
+
+        return results.BulkWriteResult(bulkResult, True)
+
+# ----------------------------------------------------------------------------------
+class memoryCursor:
+    """In-process stand-in of pymongo.cursor.Cursor.
+
+       The query is evaluated at the first iteration, on a snapshot of the
+       matching documents.
+       """
+
+    # _________________________________________________________
+    def __init__(self, collection, filter, projection, sort = None, skip = 0, limit = 0):
+        self.collection = collection
+
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort = _normalizeSort(sort)
+        self._skip = skip
+        self._limit = limit
+
+        self._iterDocs = None
+
+    # _________________________________________________________
+    def sort(self, key_or_list, direction = 1):
+        self._sort = _normalizeSort(key_or_list, direction)
+        return self
+
+    # _________________________________________________________
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    # _________________________________________________________
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    # _________________________________________________________
+    def batch_size(self, batchSize):
+        return self
+
+    # _________________________________________________________
+    def hint(self, index):
+        return self
+
+    # _________________________________________________________
+    def max_time_ms(self, maxTimeMS):
+        return self
+
+    # _________________________________________________________
+    def count(self, with_limit_and_skip = False):
+        with self.collection._lock:
+            if with_limit_and_skip:
+                return len(self.collection._findIds(self._filter, skip=self._skip, limit=self._limit))
+            return len(self.collection._findIds(self._filter))
+
+    # _________________________________________________________
+    def distinct(self, key):
+        with self.collection._lock:
+            return _distinct([self.collection._docs[idKey] for idKey in self.collection._findIds(self._filter)], key)
+
+    # _________________________________________________________
+    def rewind(self):
+        self._iterDocs = None
+        return self
+
+    # _________________________________________________________
+    def clone(self):
+        return memoryCursor(self.collection, self._filter, self._projection, self._sort, self._skip, self._limit)
+
+    # _________________________________________________________
+    def close(self):
+        self._iterDocs = iter([])
+
+    # _________________________________________________________
+    def __iter__(self):
+        return self
+
+    # _________________________________________________________
+    def __next__(self):
+        if self._iterDocs is None:
+            with self.collection._lock:
+                idKeys = self.collection._findIds(self._filter, self._sort, self._skip, self._limit)
+                listDocs = [_project(self.collection._docs[idKey], self._projection) for idKey in idKeys]
+            self._iterDocs = iter(listDocs)
+
+        return next(self._iterDocs)
+
+    next = __next__
+
+# ____________________________________________________________________________
+# -- Helper: documents and values
+# ____________________________________________________________________________
+
+# ____________________________________________________________________________
+def _copyDoc(value):
+    """Copy of document - faster than deepcopy for plain documents."""
+
+    if isinstance(value, dict):
+        return {key: _copyDoc(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copyDoc(item) for item in value]
+    return value
+
+# ____________________________________________________________________________
+def _hashable(value):
+    """Hashable representation of value, for the index maps."""
+
+    if isinstance(value, dict):
+        return ('__dict__', tuple((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return ('__list__', tuple(_hashable(item) for item in value))
+    if isinstance(value, bool):
+        return ('__bool__', value)
+    return value
+
+# ____________________________________________________________________________
+def _isRegex(value):
+    return hasattr(value, 'pattern') and hasattr(value, 'search')
+
+# ____________________________________________________________________________
+def _isOperatorDict(value):
+    return isinstance(value, dict) and len(value) > 0 and all(key.startswith('$') for key in value.keys())
+
+# ____________________________________________________________________________
+def _resolvePath(doc, path):
+    """Get values of dotted path in document.
+
+       Arrays on the way are expanded. Returns the list of values and
+       whether the path exists.
+       """
+
+    values = [doc]
+    for part in path.split('.'):
+        nextValues = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    nextValues.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    nextValues.append(value[int(part)])
+                else:
+                    nextValues.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = nextValues
+
+    return values, len(values) > 0
+
+# ____________________________________________________________________________
+def _expandArrays(values):
+    """Values with arrays and their elements - as matched by queries."""
+
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+# ____________________________________________________________________________
+def _getIndexValues(doc, field):
+    """Hashable values of field in document, for the index maps - arrays are multikey."""
+
+    values, exists = _resolvePath(doc, field)
+    if not exists:
+        return [None]
+    return set(_hashable(value) for value in _expandArrays(values))
+
+# ____________________________________________________________________________
+def _typeOrder(value):
+    if value is None:
+        return TYPE_ORDER_NULL
+    if isinstance(value, bool):
+        return TYPE_ORDER_BOOL
+    if isinstance(value, (int, float)):
+        return TYPE_ORDER_NUMBER
+    if isinstance(value, str):
+        return TYPE_ORDER_STRING
+    if isinstance(value, dict):
+        return TYPE_ORDER_OBJECT
+    if isinstance(value, list):
+        return TYPE_ORDER_ARRAY
+    if isinstance(value, ObjectId):
+        return TYPE_ORDER_OBJECTID
+    if isinstance(value, datetime.datetime):
+        return TYPE_ORDER_DATE
+    return TYPE_ORDER_OTHER
+
+# ____________________________________________________________________________
+def _sortKey(value):
+    """Sort key following the BSON type order."""
+
+    order = _typeOrder(value)
+    if order in (TYPE_ORDER_OBJECT, TYPE_ORDER_ARRAY, TYPE_ORDER_OTHER):
+        return (order, repr(value))
+    if order == TYPE_ORDER_NULL:
+        return (order, 0)
+    return (order, value)
+
+# ____________________________________________________________________________
+def _resolveSortValue(doc, field, direction):
+    """Sort value of field - for arrays the smallest (ascending) or largest element."""
+
+    values, exists = _resolvePath(doc, field)
+    if not exists:
+        return None
+
+    values = [item for value in values for item in (value if isinstance(value, list) and value else [value])]
+    if len(values) == 1:
+        return values[0]
+
+    return (min if direction > 0 else max)(values, key=_sortKey)
+
+# ____________________________________________________________________________
+def _normalizeSort(keyOrList, direction = 1):
+    """Sort as list of (field, direction)."""
+
+    if not keyOrList:
+        return None
+    if isinstance(keyOrList, str):
+        return [(keyOrList, direction)]
+    return list(keyOrList)
+
+# ____________________________________________________________________________
+def _compare(value, other):
+    """Compare values of the same BSON type - None if not comparable."""
+
+    if _typeOrder(value) != _typeOrder(other):
+        return None
+    try:
+        return (value > other) - (value < other)
+    except TypeError:
+        return None
+
+# ____________________________________________________________________________
+# -- Helper: queries
+# ____________________________________________________________________________
+
+# ____________________________________________________________________________
+def _matchDoc(doc, query):
+    """Check if document matches query."""
+
+    for key, cond in query.items():
+        if key == '$and':
+            if not all(_matchDoc(doc, subQuery) for subQuery in cond):
+                return False
+        elif key == '$or':
+            if not any(_matchDoc(doc, subQuery) for subQuery in cond):
+                return False
+        elif key == '$nor':
+            if any(_matchDoc(doc, subQuery) for subQuery in cond):
+                return False
+        elif key == '$where':
+            raise errors.OperationFailure('$where is not supported')
+        elif not _matchField(doc, key, cond):
+            return False
+
+    return True
+
+# ____________________________________________________________________________
+def _matchField(doc, path, cond):
+    """Check if field at path in document matches condition."""
+
+    values, exists = _resolvePath(doc, path)
+
+    if _isOperatorDict(cond):
+        options = cond.get('$options', '')
+        return all(_matchOperator(values, exists, operator, argument, options)
+                   for operator, argument in cond.items() if operator != '$options')
+
+    return _matchOperator(values, exists, '$eq', cond, '')
+
+# ____________________________________________________________________________
+def _matchOperator(values, exists, operator, argument, options):
+    """Check if values match one query operator."""
+
+    expanded = _expandArrays(values)
+
+    if operator == '$eq':
+        if _isRegex(argument):
+            return any(isinstance(value, str) and argument.search(value) for value in expanded)
+        if argument is None:
+            return not exists or any(value is None for value in expanded)
+        return any(_isEqual(value, argument) for value in expanded)
+
+    if operator == '$ne':
+        return not _matchOperator(values, exists, '$eq', argument, options)
+
+    if operator in ('$gt', '$gte', '$lt', '$lte'):
+        for value in expanded:
+            result = _compare(value, argument)
+            if result is None:
+                continue
+            if (operator == '$gt' and result > 0) or (operator == '$gte' and result >= 0) or \
+               (operator == '$lt' and result < 0) or (operator == '$lte' and result <= 0):
+                return True
+        return False
+
+    if operator == '$in':
+        return any(_matchOperator(values, exists, '$eq', item, options) for item in argument)
+
+    if operator == '$nin':
+        return not _matchOperator(values, exists, '$in', argument, options)
+
+    if operator == '$exists':
+        return exists == bool(argument)
+
+    if operator == '$regex':
+        flags = (re.IGNORECASE if 'i' in options else 0) | (re.MULTILINE if 'm' in options else 0) | \
+                (re.DOTALL if 's' in options else 0) | (re.VERBOSE if 'x' in options else 0)
+        regex = argument if _isRegex(argument) else re.compile(argument, flags)
+        return any(isinstance(value, str) and regex.search(value) for value in expanded)
+
+    if operator == '$not':
+        if _isRegex(argument):
+            return not _matchOperator(values, exists, '$regex', argument, options)
+        return not all(_matchOperator(values, exists, subOperator, subArgument, argument.get('$options', ''))
+                       for subOperator, subArgument in argument.items() if subOperator != '$options')
+
+    if operator == '$size':
+        return any(isinstance(value, list) and len(value) == argument for value in values)
+
+    if operator == '$all':
+        return all(_matchOperator(values, exists, '$eq', item, options) for item in argument)
+
+    if operator == '$elemMatch':
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for element in value:
+                if _isOperatorDict(argument):
+                    if _matchField({'element': element}, 'element', argument):
+                        return True
+                elif isinstance(element, dict) and _matchDoc(element, argument):
+                    return True
+        return False
+
+    if operator == '$mod':
+        divisor, remainder = argument
+        return any(isinstance(value, (int, float)) and not isinstance(value, bool) and value % divisor == remainder
+                   for value in expanded)
+
+    raise errors.OperationFailure('Unsupported query operator: {0}'.format(operator))
+
+# ____________________________________________________________________________
+def _isEqual(value, other):
+    """Equality of values - booleans are not equal to numbers."""
+
+    if isinstance(value, bool) != isinstance(other, bool):
+        return False
+    return value == other
+
+# ____________________________________________________________________________
+def _distinct(listDocs, key):
+    """Distinct values of key in documents - arrays are expanded."""
+
+    distinct = []
+    seen = set()
+    for doc in listDocs:
+        values, exists = _resolvePath(doc, key)
+        for value in values:
+            for item in (value if isinstance(value, list) else [value]):
+                hashKey = _hashable(item)
+                if hashKey not in seen:
+                    seen.add(hashKey)
+                    distinct.append(_copyDoc(item))
+    return distinct
+
+# ____________________________________________________________________________
+def _project(doc, projection):
+    """Copy of document with projection applied."""
+
+    if not projection:
+        return _copyDoc(doc)
+
+    if isinstance(projection, (list, tuple)):
+        projection = {field: True for field in projection}
+
+    includeId = projection.get('_id', True)
+    fields = {field: flag for field, flag in projection.items() if field != '_id'}
+
+    # -- Exclusion projection
+    if not any(fields.values()):
+        projected = _copyDoc(doc)
+        for field in fields:
+            _unsetPath(projected, field)
+        if not includeId:
+            projected.pop('_id', None)
+        return projected
+
+    # -- Inclusion projection
+    projected = {}
+    if includeId and '_id' in doc:
+        projected['_id'] = _copyDoc(doc['_id'])
+
+    for field, flag in fields.items():
+        if not flag:
+            continue
+        values, exists = _resolvePath(doc, field)
+        if exists and '.' not in field:
+            projected[field] = _copyDoc(values[0])
+        elif exists:
+            _setPath(projected, field, _copyDoc(values[0]))
+
+    return projected
+
+# ____________________________________________________________________________
+# -- Helper: updates
+# ____________________________________________________________________________
+
+# ____________________________________________________________________________
+def _checkUpdate(update):
+    if not _isOperatorDict(update):
+        raise ValueError('update only works with $ operators')
+
+# ____________________________________________________________________________
+def _replacementDoc(oldDoc, replacement):
+    if _isOperatorDict(replacement):
+        raise ValueError('replacement can not include $ operators')
+
+    newDoc = _copyDoc(replacement)
+    newDoc['_id'] = oldDoc['_id']
+    return newDoc
+
+# ____________________________________________________________________________
+def _upsertDocFromFilter(filter):
+    """New document for an upsert from the equality conditions of the filter."""
+
+    doc = {}
+    for key, cond in (filter or {}).items():
+        if key == '$and':
+            for subQuery in cond:
+                doc.update(_upsertDocFromFilter(subQuery))
+        elif key.startswith('$'):
+            continue
+        elif _isOperatorDict(cond):
+            if '$eq' in cond:
+                _setPath(doc, key, _copyDoc(cond['$eq']))
+        elif not _isRegex(cond):
+            _setPath(doc, key, _copyDoc(cond))
+    return doc
+
+# ____________________________________________________________________________
+def _getParent(doc, path, create):
+    """Get parent document and last key of path - None if not existing and not create."""
+
+    parts = path.split('.')
+    current = doc
+    for part in parts[:-1]:
+        if isinstance(current, list) and part.isdigit():
+            index = int(part)
+            if index >= len(current):
+                return None, None
+            current = current[index]
+            continue
+
+        if not isinstance(current, dict):
+            return None, None
+
+        if part not in current or current[part] is None:
+            if not create:
+                return None, None
+            current[part] = {}
+        current = current[part]
+
+    if not isinstance(current, (dict, list)):
+        return None, None
+    return current, parts[-1]
+
+# ____________________________________________________________________________
+def _getPath(doc, path):
+    parent, key = _getParent(doc, path, create=False)
+    if parent is None:
+        return None, False
+    if isinstance(parent, list):
+        index = int(key)
+        return (parent[index], True) if index < len(parent) else (None, False)
+    return parent.get(key), key in parent
+
+# ____________________________________________________________________________
+def _setPath(doc, path, value):
+    parent, key = _getParent(doc, path, create=True)
+    if parent is None:
+        raise errors.WriteError('Cannot create field in element along path {0}'.format(path))
+    if isinstance(parent, list):
+        parent[int(key)] = value
+    else:
+        parent[key] = value
+
+# ____________________________________________________________________________
+def _unsetPath(doc, path):
+    parent, key = _getParent(doc, path, create=False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+    elif isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+        parent[int(key)] = None
+
+# ____________________________________________________________________________
+def _applyUpdate(doc, update, isInsert):
+    """Apply update operators to document - in place, returns document."""
+
+    for operator, fields in update.items():
+        if operator == '$setOnInsert' and not isInsert:
+            continue
+
+        for path, argument in fields.items():
+            if operator in ('$set', '$setOnInsert'):
+                _setPath(doc, path, _copyDoc(argument))
+
+            elif operator == '$unset':
+                _unsetPath(doc, path)
+
+            elif operator in ('$inc', '$mul'):
+                value, exists = _getPath(doc, path)
+                if not exists or value is None:
+                    value = 0
+                _setPath(doc, path, value + argument if operator == '$inc' else value * argument)
+
+            elif operator in ('$min', '$max'):
+                value, exists = _getPath(doc, path)
+                result = _compare(argument, value) if exists else None
+                if not exists or (result is not None and ((operator == '$min' and result < 0) or
+                                                          (operator == '$max' and result > 0))):
+                    _setPath(doc, path, _copyDoc(argument))
+
+            elif operator in ('$push', '$addToSet'):
+                value, exists = _getPath(doc, path)
+                if not exists or value is None:
+                    value = []
+                    _setPath(doc, path, value)
+                if not isinstance(value, list):
+                    raise errors.WriteError('The field {0} must be an array'.format(path))
+
+                items = argument['$each'] if isinstance(argument, dict) and '$each' in argument else [argument]
+                for item in items:
+                    if operator == '$push' or not any(_isEqual(element, item) for element in value):
+                        value.append(_copyDoc(item))
+
+            elif operator in ('$pull', '$pullAll'):
+                value, exists = _getPath(doc, path)
+                if not exists or not isinstance(value, list):
+                    continue
+
+                if operator == '$pullAll':
+                    value[:] = [element for element in value if not any(_isEqual(element, item) for item in argument)]
+                elif _isOperatorDict(argument):
+                    value[:] = [element for element in value if not _matchField({'element': element}, 'element', argument)]
+                elif isinstance(argument, dict):
+                    value[:] = [element for element in value if not (isinstance(element, dict) and _matchDoc(element, argument))]
+                else:
+                    value[:] = [element for element in value if not _isEqual(element, argument)]
+
+            elif operator == '$rename':
+                value, exists = _getPath(doc, path)
+                if exists:
+                    _unsetPath(doc, path)
+                    _setPath(doc, argument, value)
+
+            elif operator == '$currentDate':
+                _setPath(doc, path, datetime.datetime.utcnow())
+
+            else:
+                raise errors.WriteError('Unsupported update operator: {0}'.format(operator))
+
+    return doc
+
+# ____________________________________________________________________________
+def _updateRawResult(nMatched, nModified, upsertedId):
+    rawResult = {'n': nMatched, 'nModified': nModified, 'ok': 1.0, 'updatedExisting': nMatched > 0}
+    if upsertedId is not None:
+        rawResult['n'] = 1
+        rawResult['upserted'] = upsertedId
+    return rawResult
+
+# ____________________________________________________________________________
+def _bulkResult(nInserted = 0, writeErrors = None):
+    return {'writeErrors': writeErrors or [], 'writeConcernErrors': [], 'nInserted': nInserted,
+            'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+
+# ____________________________________________________________________________
+# -- Helper: aggregation
+# ____________________________________________________________________________
+
+# ____________________________________________________________________________
+def _evalExpression(doc, expression):
+    """Evaluate aggregation expression: '$field', constant or dict of expressions."""
+
+    if isinstance(expression, str) and expression.startswith('$'):
+        values, exists = _resolvePath(doc, expression[1:])
+        return values[0] if exists else None
+    if isinstance(expression, dict) and not _isOperatorDict(expression):
+        return {key: _evalExpression(doc, item) for key, item in expression.items()}
+    return expression
+
+# ____________________________________________________________________________
+def _group(listDocs, spec):
+    """$group stage with $sum, $avg, $min, $max, $first, $last, $push and $addToSet."""
+
+    groups = collections.OrderedDict()
+    for doc in listDocs:
+        groupId = _evalExpression(doc, spec['_id'])
+        groups.setdefault(_hashable(groupId), (groupId, []))[1].append(doc)
+
+    listGroups = []
+    for groupId, groupDocs in groups.values():
+        result = {'_id': groupId}
+
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (operator, expression), = accumulator.items()
+            values = [_evalExpression(doc, expression) for doc in groupDocs]
+            numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+            if operator == '$sum':
+                result[field] = sum(numbers)
+            elif operator == '$avg':
+                result[field] = sum(numbers) / len(numbers) if numbers else None
+            elif operator in ('$min', '$max'):
+                values = [value for value in values if value is not None]
+                result[field] = (min if operator == '$min' else max)(values, key=_sortKey) if values else None
+            elif operator == '$first':
+                result[field] = values[0]
+            elif operator == '$last':
+                result[field] = values[-1]
+            elif operator == '$push':
+                result[field] = values
+            elif operator == '$addToSet':
+                result[field] = _distinct([{'value': value} for value in values], 'value')
+            else:
+                raise errors.OperationFailure('Unsupported accumulator: {0}'.format(operator))
+
+        listGroups.append(result)
+
+    return listGroups
+
+# ____________________________________________________________________________
+def _unwind(listDocs, spec):
+    path = (spec['path'] if isinstance(spec, dict) else spec)[1:]
+
+    unwound = []
+    for doc in listDocs:
+        value, exists = _getPath(doc, path)
+        if not exists or not isinstance(value, list):
+            if exists:
+                unwound.append(doc)
+            continue
+        for element in value:
+            newDoc = _copyDoc(doc)
+            _setPath(newDoc, path, _copyDoc(element))
+            unwound.append(newDoc)
+    return unwound
+
+# ____________________________________________________________________________
+def runSelfCheck(db):
+    """Run the checks of the semantics SDMS relies on in database db.
+
+       Returns dict of check name -> observed result.
+       """
+
+    observed = {}
+
+    def getDocs(collection, query = None):
+        return [{key: value for key, value in doc.items() if key != '_id'}
+                for doc in collection.find(query or {}).sort('seq', 1)]
+
+    # -- Upsert with $setOnInsert: equality fields of the filter are inserted,
+    #    an existing document is not changed
+    coll = db['selfCheck_setOnInsert']
+    coll.drop()
+    first = coll.update_one({'path': '/a', 'seq': 1}, {'$setOnInsert': {'size': 1}}, upsert = True)
+    second = coll.update_one({'path': '/a', 'seq': 1}, {'$setOnInsert': {'size': 2}}, upsert = True)
+    observed['setOnInsert'] = {'first': [first.matched_count, first.modified_count, first.upserted_id is not None],
+                               'second': [second.matched_count, second.modified_count, second.upserted_id is not None],
+                               'docs': getDocs(coll)}
+
+    # -- BulkWriteError: indices of writeErrors and upserted - unordered and ordered
+    coll = db['selfCheck_bulk']
+    for ordered in (False, True):
+        coll.drop()
+        coll.create_index('key', unique = True)
+        coll.insert_one({'key': 1, 'seq': 0})
+        try:
+            coll.bulk_write([InsertOne({'key': 2, 'seq': 1}),
+                             InsertOne({'key': 1, 'seq': 2}),
+                             UpdateOne({'key': 3}, {'$setOnInsert': {'seq': 3}}, upsert = True),
+                             InsertOne({'key': 1, 'seq': 4})], ordered = ordered)
+            details = {}
+        except errors.BulkWriteError as err:
+            details = err.details
+
+        observed['bulkWriteError_{0}'.format('ordered' if ordered else 'unordered')] = \
+            {'writeErrors': [[item['index'], item['code']] for item in details.get('writeErrors', [])],
+             'upserted': [item['index'] for item in details.get('upserted', [])],
+             'nInserted': details.get('nInserted'), 'nUpserted': details.get('nUpserted'),
+             'docs': getDocs(coll)}
+
+    # -- Candidate selection of $in and $regex on an indexed field - None matches missing fields
+    coll = db['selfCheck_candidates']
+    coll.drop()
+    coll.create_index('path', unique = True, sparse = True)
+    coll.insert_many([{'path': '/a/1', 'seq': 1}, {'path': '/a/2', 'seq': 2},
+                      {'path': '/b/1', 'seq': 3, 'tapeVolume': 'AG01'}, {'seq': 4}])
+    observed['candidates'] = \
+        {'in': [doc['seq'] for doc in getDocs(coll, {'path': {'$in': ['/a/2', '/b/1', '/c/1']}})],
+         'inNone': [doc['seq'] for doc in getDocs(coll, {'path': {'$in': ['/a/1', None]}})],
+         'inRegex': [doc['seq'] for doc in getDocs(coll, {'path': {'$in': [re.compile('^/b/')]}})],
+         'regex': [doc['seq'] for doc in getDocs(coll, {'path': {'$regex': '^{0}/'.format(re.escape('/a'))}})],
+         'regexExists': [doc['seq'] for doc in getDocs(coll, {'path': {'$regex': '^/'},
+                                                              'tapeVolume': {'$exists': False}})]}
+
+    # -- Lock upsert: held by another holder -> DuplicateKeyError, expired -> taken over
+    coll = db['selfCheck_locks']
+    coll.drop()
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    coll.insert_one({'_id': 'lock', 'holder': 'A', 'leaseUntil': now + datetime.timedelta(seconds=600)})
+
+    def takeLock(holder):
+        try:
+            coll.find_one_and_update({'_id': 'lock', '$or': [{'holder': holder},
+                                                            {'leaseUntil': {'$ne': None, '$lt': now}}]},
+                                     {'$set': {'holder': holder}}, upsert = True)
+            return True
+        except errors.DuplicateKeyError:
+            return False
+
+    isTakenHeld = takeLock('B')
+    coll.update_one({'_id': 'lock'}, {'$set': {'leaseUntil': now - datetime.timedelta(seconds=1)}})
+    isTakenExpired = takeLock('B')
+    observed['lockUpsert'] = {'held': isTakenHeld, 'expired': isTakenExpired,
+                              'holder': coll.find_one({'_id': 'lock'})['holder']}
+
+    for name in ('selfCheck_setOnInsert', 'selfCheck_bulk', 'selfCheck_candidates', 'selfCheck_locks'):
+        db[name].drop()
+
+    return observed
+
+# -- Results of mongod for runSelfCheck
+SELF_CHECK_EXPECTED = {
+    'setOnInsert': {'first': [0, 0, True], 'second': [1, 0, False],
+                    'docs': [{'path': '/a', 'seq': 1, 'size': 1}]},
+    'bulkWriteError_unordered': {'writeErrors': [[1, DUPLICATE_KEY_ERROR], [3, DUPLICATE_KEY_ERROR]],
+                                 'upserted': [2], 'nInserted': 1, 'nUpserted': 1,
+                                 'docs': [{'key': 1, 'seq': 0}, {'key': 2, 'seq': 1}, {'key': 3, 'seq': 3}]},
+    'bulkWriteError_ordered': {'writeErrors': [[1, DUPLICATE_KEY_ERROR]],
+                               'upserted': [], 'nInserted': 1, 'nUpserted': 0,
+                               'docs': [{'key': 1, 'seq': 0}, {'key': 2, 'seq': 1}]},
+    'candidates': {'in': [2, 3], 'inNone': [1, 4], 'inRegex': [3], 'regex': [1, 2], 'regexExists': [1, 2]},
+    'lockUpsert': {'held': False, 'expired': True, 'holder': 'B'}}
+
+# ____________________________________________________________________________
+def main():
+    """Check the memory backend - against the expected results and a real mongod."""
+
+    parser = argparse.ArgumentParser(description='Self-check of the in-process mongoDB stand-in.')
+    parser.add_argument('--mongoUri',
+                        help='compare also with this mongoDB (i.e. mongodb://localhost:27017) - '
+                             'uses and drops the database sdmsSelfCheck')
+    args = parser.parse_args()
+
+    results = {'memory': runSelfCheck(memoryClient()['sdmsSelfCheck'])}
+
+    if args.mongoUri:
+        from pymongo import MongoClient
+
+        client = MongoClient(args.mongoUri)
+        results['mongod'] = runSelfCheck(client['sdmsSelfCheck'])
+        client.drop_database('sdmsSelfCheck')
+        client.close()
+
+    nMismatches = 0
+    for name, expected in sorted(SELF_CHECK_EXPECTED.items()):
+        for backend, observed in sorted(results.items()):
+            if observed[name] == expected:
+                print("OK       {0:<26} {1}".format(name, backend))
+            else:
+                nMismatches += 1
+                print("MISMATCH {0:<26} {1}: {2} - expected: {3}".format(name, backend, observed[name], expected))
+
+    return 1 if nMismatches else 0
+
+# ----------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    """Call main."""
+
+    sys.exit(main())
@@ -5,13 +5,32 @@ b'This script requires python 3.4'
 Connect to NERSC mongoDB sever and returns handles to the
 different collections
 
+The backend is selected by --backend or the env SDMS_MONGO_BACKEND:
+  nersc  - NERSC mongoDB, with user and password (default)
+  local  - mongoDB at --mongoUri / SDMS_MONGO_URI, without authentication
+  memory - in-process stand-in of mongoDB for tests and benchmarks (mongoMemory.py)
+
+Command metrics are recorded if --mongoMetrics or the env SDMS_MONGO_METRICS is set:
+  summary    - print latency summary per collection and operation at exit
+  collection - in addition, append the summary to the collection Mongo_Metrics
+
 
 Author: Jochen Thaeder <jmthader@lbl.gov>
 """
 
-import sys, os, datetime
+import sys, os, re, datetime
+import time
+import atexit
+import socket
+import uuid
+import bisect
+import threading
+import argparse
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, ASCENDING
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo import errors
+from pymongo import monitoring
 
 
 ##############################################
@@ -23,12 +42,77 @@ MONGO_DB_NAME = 'STAR_XROOTD'
 ADMIN_USER    = 'STAR_XROOTD_admin'
 READONLY_USER = 'STAR_XROOTD_ro'
 
-COLLECTION_INDICES = {'HPSS_Files': 'fileFullPath', 'HPSS_PicoDsts': 'filePath', 'XRD_DataServers': 'nodeName',
+MONGO_BACKENDS  = ['nersc', 'local', 'memory']
+MONGO_LOCAL_URI = 'mongodb://localhost:27017'
+
+MONGO_METRICS_MODES      = ['summary', 'collection']
+MONGO_METRICS_COLLECTION = 'Mongo_Metrics'
+
+# -- Upper bounds of the latency histogram buckets in ms, the last bucket is open
+METRICS_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+COLLECTION_INDICES = {'HPSS_Files': 'fileFullPath', 'HPSS_PicoDsts': 'filePath', 'HPSS_Checkpoints': 'dirPath',
+                      'HPSS_Crawls': 'epoch',
+                      'XRD_DataServers': 'nodeName',
                       'XRD_PicoDsts': 'filePath', 'XRD_PicoDsts_brokenLink': 'nodeFilePath',
                       'XRD_PicoDsts_corrupt': 'nodeFilePath', 'XRD_PicoDsts_noHPSS': 'nodeFilePath',
                       'Stage_From_HPSS': 'fileFullPath', 'Stage_To_XRD': 'fileFullPath'
                       }
 
+# -- Additional indices for the queries run on the collections: collection -> [(keys, options)]
+#    Created, with the unique ones of COLLECTION_INDICES, by: python mongoUtil.py ensure-indexes
+STAR_DETAILS_KEYS = [('starDetails.runyear', ASCENDING), ('starDetails.system', ASCENDING),
+                     ('starDetails.energy', ASCENDING), ('starDetails.trigger', ASCENDING),
+                     ('starDetails.production', ASCENDING), ('starDetails.day', ASCENDING)]
+
+COLLECTION_INDEX_SPEC = {
+    'HPSS_Files':      [([('lostEpoch', ASCENDING)], {'sparse': True}),
+                        ([('lastSeen', ASCENDING)], {}),
+                        ([('fileType', ASCENDING), ('filesInTar', ASCENDING)], {})],
+    'HPSS_PicoDsts':   [(STAR_DETAILS_KEYS, {}),
+                        ([('fileFullPathTar', ASCENDING)], {'sparse': True}),
+                        ([('target', ASCENDING), ('staging.stageMarkerXRD', ASCENDING), ('filePath', ASCENDING)], {})],
+    'HPSS_Duplicates': [(STAR_DETAILS_KEYS, {}),
+                        ([('filePath', ASCENDING)], {}),
+                        ([('fileFullPathTar', ASCENDING)], {'sparse': True})],
+    'HPSS_Crawls':     [([('folder', ASCENDING), ('epoch', ASCENDING)], {})],
+    'XRD_DataServers': [([('roles', ASCENDING)], {}),
+                        ([('isDataServerXRD', ASCENDING), ('newFilesStaged', ASCENDING)], {})],
+    'XRD_PicoDsts':    [([('storage.details', ASCENDING)], {}),
+                        (STAR_DETAILS_KEYS, {})],
+    'XRD_PicoDsts_new':     [([('storage.location', ASCENDING), ('target', ASCENDING), ('filePath', ASCENDING)], {})],
+    'XRD_PicoDsts_missing': [([('storage.location', ASCENDING), ('target', ASCENDING), ('filePath', ASCENDING)], {})],
+    'XRD_PicoDsts_brokenLink': [([('storage.detail', ASCENDING)], {})],
+    'XRD_PicoDsts_corrupt':    [([('fileSize', ASCENDING)], {})],
+    'Stage_From_HPSS': [([('stageStatus', ASCENDING), ('stageGroup', ASCENDING), ('orderIdx', ASCENDING)], {}),
+                        ([('stageStatus', ASCENDING), ('timeStamp', ASCENDING)], {})],
+    'Stage_To_XRD':    [([('stageStatusHPSS', ASCENDING), ('stageStatusTarget', ASCENDING)], {}),
+                        ([('stageStatusTarget', ASCENDING), ('timeStamp', ASCENDING)], {})],
+    'Mongo_Metrics':   [([('script', ASCENDING), ('started', ASCENDING)], {})],
+    }
+
+# -- Options of the pooled MongoClient - can be overwritten per mongoDbUtil
+MONGO_CLIENT_OPTIONS = {'maxPoolSize': 10,
+                        'minPoolSize': 0,
+                        'maxIdleTimeMS': 60000,
+                        'waitQueueTimeoutMS': 60000,
+                        'connectTimeoutMS': 10000,
+                        'socketTimeoutMS': 300000,
+                        'serverSelectionTimeoutMS': 30000,
+                        'retryWrites': True,
+                        'compressors': 'zlib'}
+
+# -- Process locks: lease of a lock and interval of its renewal by the heartbeat thread
+LOCK_LEASE_SECONDS     = 600
+LOCK_HEARTBEAT_SECONDS = 60
+LOCK_LEGACY_HOLDER     = 'legacy'  # holder of the locks migrated from the legacy lock document
+
+# -- bulkWriter: flush a collection at this number of queued operations or age of its oldest one
+BULK_WRITE_SIZE    = 1000
+BULK_WRITE_SECONDS = 10
+
+DUPLICATE_KEY_ERROR = 11000
+
 ##############################################
 
 # -- Check for a proper Python Version
@@ -39,17 +123,355 @@ if pymongo.__version__[0:3] < '3.0':
     print ('pymongo version 3.0 or greater required (found: {0}).'.format(pymongo.__version__[0:5]))
     sys.exit(-1)
 
+# -- Shared MongoClients of this process: key -> [client, number of users]
+_sharedClients = {}
+_sharedClientsLock = threading.Lock()
+
+# -- Command metrics of this process, see getCommandMetrics
+_commandMetrics = None
+_commandMetricsLock = threading.Lock()
+
+# ----------------------------------------------------------------------------------
+class commandMetrics(monitoring.CommandListener):
+    """pymongo command listener recording count, latency histogram and
+       number of returned documents per collection and operation.
+
+       getMore is recorded as its own operation.
+       """
+
+    # _________________________________________________________
+    def __init__(self):
+        self.startTime = datetime.datetime.now()
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stats = {}
+
+    # _________________________________________________________
+    def started(self, event):
+        commandName = event.command_name
+        collectionName = event.command.get('collection' if commandName == 'getMore' else commandName)
+
+        # -- Only commands on collections, no handshakes, authentication, ...
+        if not isinstance(collectionName, str):
+            return
+
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (collectionName, commandName)
+
+    # _________________________________________________________
+    def succeeded(self, event):
+        self._record(event, getReturnedDocs(event.command_name, event.reply), False)
+
+    # _________________________________________________________
+    def failed(self, event):
+        self._record(event, 0, True)
+
+    # _________________________________________________________
+    def _record(self, event, nDocs, isFailed):
+        durationMS = event.duration_micros / 1000.
+
+        with self._lock:
+            key = self._pending.pop((event.connection_id, event.request_id), None)
+            if not key:
+                return
+
+            stats = self._stats.get(key)
+            if not stats:
+                stats = {'count': 0, 'failed': 0, 'totalMS': 0., 'maxMS': 0., 'nDocs': 0,
+                         'histogram': [0] * (len(METRICS_BUCKETS_MS) + 1)}
+                self._stats[key] = stats
+
+            stats['count']   += 1
+            stats['failed']  += isFailed
+            stats['totalMS'] += durationMS
+            stats['maxMS']    = max(stats['maxMS'], durationMS)
+            stats['nDocs']   += nDocs
+            stats['histogram'][bisect.bisect_left(METRICS_BUCKETS_MS, durationMS)] += 1
+
+    # _________________________________________________________
+    def getSummary(self):
+        """Get summary as list of dicts - sorted by total time."""
+
+        with self._lock:
+            items = [(key, dict(stats, histogram=list(stats['histogram']))) for key, stats in self._stats.items()]
+
+        summary = []
+        for (collectionName, commandName), stats in sorted(items, key=lambda item: -item[1]['totalMS']):
+            stats['histogram'] = {getBucketLabel(idx): n for idx, n in enumerate(stats['histogram']) if n}
+            summary.append(dict(stats, collection=collectionName, operation=commandName))
+        return summary
+
+    # _________________________________________________________
+    def getSummaryDoc(self):
+        """Get summary as document for the metrics collection."""
+
+        return {'script': os.path.basename(sys.argv[0]), 'args': sys.argv[1:],
+                'host': socket.gethostname(), 'pid': os.getpid(),
+                'started': self.startTime, 'finished': datetime.datetime.now(),
+                'commands': self.getSummary()}
+
+    # _________________________________________________________
+    def printSummary(self):
+        """Print summary - sorted by total time."""
+
+        summary = self.getSummary()
+        if not summary:
+            return
+
+        print("mongoDB commands of {0} - {1}".format(os.path.basename(sys.argv[0]), self.startTime.strftime('%Y-%m-%d-%H-%M')))
+        print("  {0:<40} {1:>8} {2:>6} {3:>10} {4:>9} {5:>9} {6:>10}  {7}".format('collection.operation', 'count', 'failed',
+                                                                             'total [s]', 'mean [ms]', 'max [ms]',
+                                                                             'docs', 'histogram [ms]'))
+        for stats in summary:
+            histogram = ' '.join('{0}:{1}'.format(label, n) for label, n in stats['histogram'].items())
+            print("  {0:<40} {1:>8} {2:>6} {3:>10.2f} {4:>9.2f} {5:>9.1f} {6:>10}  {7}".format(
+                '{0}.{1}'.format(stats['collection'], stats['operation']), stats['count'], stats['failed'],
+                stats['totalMS'] / 1000., stats['totalMS'] / stats['count'], stats['maxMS'], stats['nDocs'], histogram))
+
+
+# ----------------------------------------------------------------------------------
+class bulkWriter:
+    """Queue of write operations per collection, written with bulk_write.
+
+       A collection is flushed when bulkSize operations are queued or its
+       oldest queued operation is older than flushSeconds - checked when
+       queueing and by a flusher thread, so that a quiet writer doesn't
+       hold them - and by flush() / close(). Operations are written unordered,
+       each bulk in one submit - set ordered for queues with operations
+       depending on each other, e.g. several updates of the same document.
+       Duplicate key errors are ignored - as by a try/except around single
+       inserts - and the rest of the bulk is written. If a bulk fails
+       otherwise (i.e. AutoReconnect), its operations are queued again -
+       an operation written before the failure may be written twice.
+
+       Use as context manager, which flushes and prints the summary at exit:
+         with dbUtil.getBulkWriter('processXRD') as writer:
+             writer.insert(coll, doc)
+       """
+
+    # _________________________________________________________
+    def __init__(self, name = 'bulkWriter', bulkSize = BULK_WRITE_SIZE, flushSeconds = BULK_WRITE_SECONDS,
+                 ignoreDuplicates = True, ordered = False, verbose = False):
+        self.name = name
+
+        self._bulkSize = bulkSize
+        self._flushSeconds = flushSeconds
+        self._ignoreDuplicates = ignoreDuplicates
+        self._ordered = ordered
+        self._verbose = verbose
+
+        self._lock = threading.RLock()
+
+        # -- collection full name -> [collection, [operations], time of oldest operation]
+        self._queues = {}
+
+        # -- collection full name -> summed stats of all flushes
+        self.stats = {}
+
+        self._flusher = None
+        self._flusherStop = threading.Event()
+
+    # _________________________________________________________
+    def __enter__(self):
+        return self
+
+    # _________________________________________________________
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    # _________________________________________________________
+    def insert(self, collection, doc):
+        self._queue(collection, InsertOne(doc))
+
+    # _________________________________________________________
+    def updateOne(self, collection, filter, update, upsert = False):
+        self._queue(collection, UpdateOne(filter, update, upsert = upsert))
+
+    # _________________________________________________________
+    def updateMany(self, collection, filter, update, upsert = False):
+        self._queue(collection, UpdateMany(filter, update, upsert = upsert))
+
+    # _________________________________________________________
+    def replaceOne(self, collection, filter, doc, upsert = False):
+        self._queue(collection, ReplaceOne(filter, doc, upsert = upsert))
+
+    # _________________________________________________________
+    def deleteOne(self, collection, filter):
+        self._queue(collection, DeleteOne(filter))
+
+    # _________________________________________________________
+    def deleteMany(self, collection, filter):
+        self._queue(collection, DeleteMany(filter))
+
+    # _________________________________________________________
+    def _queue(self, collection, operation):
+        with self._lock:
+            queue = self._queues.get(collection.full_name)
+            if not queue:
+                queue = [collection, [], time.monotonic()]
+                self._queues[collection.full_name] = queue
+
+            queue[1].append(operation)
+
+            if len(queue[1]) >= self._bulkSize or time.monotonic() - queue[2] >= self._flushSeconds:
+                self._flushQueue(collection.full_name)
+
+            self._startFlusher()
+
+    # _________________________________________________________
+    def _startFlusher(self):
+        """Start flusher thread writing the queues older than flushSeconds."""
+
+        if self._flusher and self._flusher.is_alive():
+            return
+
+        self._flusherStop.clear()
+        self._flusher = threading.Thread(target=self._runFlusher, name='bulkFlusher', daemon=True)
+        self._flusher.start()
+
+    # _________________________________________________________
+    def _stopFlusher(self):
+        self._flusherStop.set()
+        if self._flusher:
+            self._flusher.join()
+            self._flusher = None
+
+    # _________________________________________________________
+    def _runFlusher(self):
+        while not self._flusherStop.wait(max(self._flushSeconds / 2., 0.1)):
+            with self._lock:
+                now = time.monotonic()
+                for fullName in [fullName for fullName, queue in self._queues.items()
+                                 if now - queue[2] >= self._flushSeconds]:
+                    try:
+                        self._flushQueue(fullName)
+                    except errors.PyMongoError as err:
+                        print("Error: {0} write to {1} failed: {2} - queued again".format(self.name, fullName, err))
+
+    # _________________________________________________________
+    def flush(self, collection = None):
+        """Write queued operations - of collection or of all collections."""
+
+        with self._lock:
+            fullNames = [collection.full_name] if collection else list(self._queues.keys())
+            for fullName in fullNames:
+                if fullName in self._queues:
+                    self._flushQueue(fullName)
+
+    # _________________________________________________________
+    def _flushQueue(self, fullName):
+        """Write queued operations of one collection, resume after write errors in ordered mode."""
+
+        collection, operations, timeQueued = self._queues.pop(fullName)
+
+        flushStats = {'nOps': len(operations), 'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0,
+                      'nRemoved': 0, 'nDuplicates': 0, 'nErrors': 0}
+        start = time.monotonic()
+
+        while operations:
+            try:
+                result = collection.bulk_write(operations, ordered = self._ordered).bulk_api_result
+                operations = []
+            except errors.BulkWriteError as err:
+                result = err.details
+
+                # -- Unordered: all failed operations are reported, the rest is written
+                #    Ordered: writing stops at the first failed operation
+                for writeError in result['writeErrors']:
+                    if writeError['code'] == DUPLICATE_KEY_ERROR and self._ignoreDuplicates:
+                        flushStats['nDuplicates'] += 1
+                    else:
+                        flushStats['nErrors'] += 1
+                        print("Error: {0} write to {1} failed: {2}".format(self.name, fullName, writeError['errmsg']))
+
+                # -- Continue after the failed operation
+                operations = operations[result['writeErrors'][-1]['index']+1:] if self._ordered else []
+
+            except errors.PyMongoError:
+                # -- Not written: queue again, for the next flush
+                queue = self._queues.get(fullName)
+                if queue:
+                    operations.extend(queue[1])
+                self._queues[fullName] = [collection, operations, timeQueued]
+                raise
+
+            for key in ['nInserted', 'nUpserted', 'nMatched', 'nModified', 'nRemoved']:
+                flushStats[key] += result.get(key, 0)
+
+        flushStats['seconds'] = time.monotonic() - start
+
+        stats = self.stats.setdefault(fullName, dict.fromkeys(flushStats.keys(), 0))
+        stats['nFlushes'] = stats.get('nFlushes', 0) + 1
+        for key, value in flushStats.items():
+            stats[key] += value
+
+        if self._verbose:
+            print("{0} flush {1}: {2}".format(self.name, fullName, formatBulkStats(flushStats)))
+
+    # _________________________________________________________
+    def printSummary(self):
+        """Print stats summed over all flushes per collection."""
+
+        for fullName, stats in sorted(self.stats.items()):
+            print("{0} {1} - {2} flushes: {3}".format(self.name, fullName, stats['nFlushes'], formatBulkStats(stats)))
+
+    # _________________________________________________________
+    def close(self):
+        """Stop flusher thread, flush all collections and print summary."""
+
+        self._stopFlusher()
+        self.flush()
+        self.printSummary()
 
 # ----------------------------------------------------------------------------------
 class mongoDbUtil:
-    """Class to connect to mongoDB and perform actions."""
+    """Class to connect to mongoDB and perform actions.
+
+       All instances within a process with the same connection share one
+       pooled MongoClient.
+
+       The backend is taken from args.backend or the env SDMS_MONGO_BACKEND,
+       the URI of the local backend from args.mongoUri or SDMS_MONGO_URI.
+
+       Process locks are documents in Process_Locks with the lock name as
+       _id, the holder and the end of its lease. They are taken by one
+       atomic upsert - see acquireLock.
+       """
 
     # _________________________________________________________
-    def __init__(self, args, userSwitch = 'user'):
+    def __init__(self, args, userSwitch = 'user', clientOptions = None):
         self.args = args
 
+        self._userSwitch = userSwitch
+
+        self._clientOptions = dict(MONGO_CLIENT_OPTIONS)
+        if clientOptions:
+            self._clientOptions.update(clientOptions)
+
+        # -- Local mongoDB (i.e. for replay and benchmarks) - no authentication
+        self.mongoUri = getattr(args, 'mongoUri', None) or os.getenv('SDMS_MONGO_URI')
+
+        self.backend = getattr(args, 'backend', None) or os.getenv('SDMS_MONGO_BACKEND', 'nersc')
+        if self.backend not in MONGO_BACKENDS:
+            print("Unknown mongoDB backend {0} - use one of {1}".format(self.backend, MONGO_BACKENDS))
+            sys.exit(-1)
+        if self.backend == 'nersc' and self.mongoUri:
+            self.backend = 'local'
+        if self.backend == 'local' and not self.mongoUri:
+            self.mongoUri = MONGO_LOCAL_URI
+
+        # -- Command metrics - not recorded for the memory backend
+        self.metricsMode = getattr(args, 'mongoMetrics', None) or os.getenv('SDMS_MONGO_METRICS')
+        if self.metricsMode and self.metricsMode not in MONGO_METRICS_MODES:
+            print("Unknown mongoDB metrics mode {0} - use one of {1}".format(self.metricsMode, MONGO_METRICS_MODES))
+            sys.exit(-1)
+
         # -- Get the password form env
-        if userSwitch == "admin":
+        if self.backend != 'nersc':
+            self.user = None
+            self.password = None
+        elif userSwitch == "admin":
             self.user = ADMIN_USER
             self.password = os.getenv('STAR_XROOTD_ad', 'empty')
         else:
@@ -62,38 +484,172 @@ class mongoDbUtil:
 
         self.today = datetime.datetime.today().strftime('%Y-%m-%d')
 
+        self._collections = {}
+
+        # -- Holder identity for process locks - unique per instance
+        self.lockHolder = '{0}:{1}:{2}:{3}'.format(socket.gethostname(), os.getpid(),
+                                                   os.path.basename(sys.argv[0]), uuid.uuid4().hex[:8])
+        self._heldLocks = {}
+        self._heldLocksLock = threading.Lock()
+        self._heartbeat = None
+        self._heartbeatStop = threading.Event()
+
         # -- Connect
         self._connectDB()
 
     # _________________________________________________________
     def _connectDB(self):
-        """Connect to the NERSC mongoDB using pymongo."""
+        """Connect to the NERSC mongoDB using pymongo.
+
+           Reuse the shared client of this process, if there is one.
+           """
+
+        # -- In-process backend - a fresh database, create the indices
+        if self.backend == 'memory':
+            import mongoMemory
+
+            self._clientKey = None
+            self.client = mongoMemory.getClient()
+            self.db = self.client[MONGO_DB_NAME]
+            if not self.db.list_collection_names():
+                ensureIndexes(self.db, verbose = False)
+            return
+
+        if self.mongoUri:
+            uri = self.mongoUri
+        else:
+            uri = 'mongodb://{0}:{1}@{2}/{3}'.format(self.user, self.password, MONGO_SERVER, MONGO_DB_NAME)
+
+        self._clientKey = (uri, tuple(sorted(self._clientOptions.items())), self.metricsMode)
+
+        eventListeners = [getCommandMetrics()] if self.metricsMode else []
+
+        with _sharedClientsLock:
+            if self._clientKey in _sharedClients:
+                _sharedClients[self._clientKey][1] += 1
+            else:
+                client = MongoClient(uri, event_listeners = eventListeners,
+                                     appname = os.path.basename(sys.argv[0]), **self._clientOptions)
+                _sharedClients[self._clientKey] = [client, 1]
+
+            self.client = _sharedClients[self._clientKey][0]
 
-        self.client = MongoClient('mongodb://{0}:{1}@{2}/{3}'.format(self.user, self.password,
-                                                                     MONGO_SERVER, MONGO_DB_NAME))
         self.db = self.client[MONGO_DB_NAME]
 #        print ("Existing collections:", self.db.collection_names(include_system_collections = False))
 
     # _________________________________________________________
     def close(self):
-        """Close conenction to the NERSC mongoDB using pymongo."""
+        """Close conenction to the NERSC mongoDB using pymongo.
+
+           The shared client is closed, when its last user closes it.
+           Leased locks still held are released. A second call does nothing.
+           """
+
+        if self.client is None:
+            return
 
-        self.client.close()
+        self._stopHeartbeat()
+        for lockName in list(self._heldLocks.keys()):
+            self.releaseLock(lockName)
+
+        with _sharedClientsLock:
+            entry = _sharedClients.get(self._clientKey)
+            if entry and entry[0] is self.client:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del _sharedClients[self._clientKey]
+                    if self.metricsMode == 'collection':
+                        self.storeCommandMetrics()
+                    self.client.close()
+
+        self.client = None
         self.db = ""
+        self._collections = {}
+
+    # _________________________________________________________
+    def clone(self):
+        """Get new instance on the same shared client - with its own lock holder.
+
+           To be used by worker threads, which take process locks each.
+           """
+
+        return mongoDbUtil(self.args, self._userSwitch, self._clientOptions)
 
     # _________________________________________________________
     def getCollection(self, collectionName = 'HPSS_Files'):
-        """Get collection and set index."""
+        """Get collection - a local lookup, the indices are created by ensureIndexes."""
 
-        collection = self.db[collectionName]
         try:
-            collection.create_index([(COLLECTION_INDICES[collectionName], pymongo.ASCENDING)], unique=True)
+            return self._collections[collectionName]
         except KeyError:
-            #print ("Warning: Collection", collectionName, "not known. Index not created.")
-            pass
+            collection = self.db[collectionName]
+            self._collections[collectionName] = collection
+            return collection
 
+    # _________________________________________________________
+    def ensureIndexes(self, collectionNames = None):
+        """Create indices of COLLECTION_INDICES and COLLECTION_INDEX_SPEC.
+
+           To be run once at deploy time, existing indices are not changed.
+           The process locks of the legacy lock document are migrated.
+           """
+
+        ensureIndexes(self.db, collectionNames)
 
-        return collection
+        if not collectionNames or "Process_Locks" in collectionNames:
+            self.migrateLegacyLocks()
+
+    # _________________________________________________________
+    def migrateLegacyLocks(self):
+        """Migrate the legacy lock document {'unique': 'unique', <lockName>: <bool>, ...}.
+
+           Every active lock of it becomes a lock document held by
+           LOCK_LEGACY_HOLDER without lease - kept until released, as before.
+           A lock taken meanwhile by a new holder is kept. The legacy
+           document is deleted afterwards.
+
+           Returns list of migrated lock names.
+           """
+
+        collLock = self.getCollection("Process_Locks")
+        docLegacy = collLock.find_one({'unique': 'unique'})
+        if not docLegacy:
+            return []
+
+        now = datetime.datetime.utcnow()
+        listMigrated = []
+        for lockName, state in docLegacy.items():
+            if lockName in ('_id', 'unique') or state is not True:
+                continue
+
+            try:
+                collLock.insert_one({'_id': lockName, 'holder': LOCK_LEGACY_HOLDER, 'leaseUntil': None,
+                                     'acquired': now, 'heartbeat': now})
+                listMigrated.append(lockName)
+            except errors.DuplicateKeyError:
+                print("Warning: legacy lock {0} not migrated - held already by a new holder".format(lockName))
+
+        collLock.delete_one({'_id': docLegacy['_id']})
+
+        for lockName in listMigrated:
+            print("Migrated legacy lock {0} - held until released".format(lockName))
+
+        return listMigrated
+
+    # _________________________________________________________
+    def getBulkWriter(self, name = 'bulkWriter', **kwargs):
+        """Get new bulkWriter - see bulkWriter for the options."""
+
+        return bulkWriter(name, **kwargs)
+
+    # _________________________________________________________
+    def storeCommandMetrics(self):
+        """Append the command metrics of this process to the metrics collection."""
+
+        try:
+            self.getCollection(MONGO_METRICS_COLLECTION).insert_one(getCommandMetrics().getSummaryDoc())
+        except errors.PyMongoError as err:
+            print("Error: command metrics not stored: {0}".format(err))
 
     # _________________________________________________________
     def dropCollection(self, collectionName):
@@ -102,62 +658,331 @@ class mongoDbUtil:
         self.db[collectionName].drop()
 
     # _________________________________________________________
-    def checkProcessLock(self, fieldName):
-        """Check process lock."""
+    def acquireLock(self, lockName, leaseSeconds = LOCK_LEASE_SECONDS, force = False):
+        """Acquire lock - atomic compare-and-set.
+
+           Taken if free, expired or already held by this instance. The lease
+           of a held lock is renewed by the heartbeat thread until released.
+           leaseSeconds = None: lock without lease, kept until released
+           (i.e. across cron runs). force: take over the lock from any holder.
+
+           Returns True if acquired.
+           """
+
+        now = datetime.datetime.utcnow()
+        leaseUntil = now + datetime.timedelta(seconds=leaseSeconds) if leaseSeconds else None
+
+        query = {'_id': lockName}
+        if not force:
+            query['$or'] = [{'holder': self.lockHolder},
+                            {'leaseUntil': {'$ne': None, '$lt': now}}]
 
         collLock = self.getCollection("Process_Locks")
-        docLock = collLock.find_one({'unique': 'unique'})
-        if not docLock:
+        try:
+            collLock.find_one_and_update(query, {'$set': {'holder': self.lockHolder, 'leaseUntil': leaseUntil,
+                                                          'acquired': now, 'heartbeat': now}},
+                                         upsert = True)
+        except errors.DuplicateKeyError:
+            # -- Held by another holder, the upsert collided with its document
             return False
 
-        if not fieldName in docLock.keys():
+        if leaseSeconds:
+            with self._heldLocksLock:
+                self._heldLocks[lockName] = leaseSeconds
+            self._startHeartbeat()
+
+        return True
+
+    # _________________________________________________________
+    def releaseLock(self, lockName):
+        """Release lock, if held by this instance.
+
+           Returns True if released.
+           """
+
+        with self._heldLocksLock:
+            self._heldLocks.pop(lockName, None)
+
+        collLock = self.getCollection("Process_Locks")
+        return collLock.delete_one({'_id': lockName, 'holder': self.lockHolder}).deleted_count > 0
+
+    # _________________________________________________________
+    def renewLock(self, lockName, leaseSeconds = LOCK_LEASE_SECONDS):
+        """Renew lease of lock held by this instance.
+
+           Returns False if the lock has been lost, i.e. taken over after
+           its lease expired.
+           """
+
+        now = datetime.datetime.utcnow()
+
+        collLock = self.getCollection("Process_Locks")
+        result = collLock.update_one({'_id': lockName, 'holder': self.lockHolder},
+                                     {'$set': {'leaseUntil': now + datetime.timedelta(seconds=leaseSeconds),
+                                               'heartbeat': now}})
+        return result.matched_count > 0
+
+    # _________________________________________________________
+    def isLockHeld(self, lockName):
+        """Check if this instance still holds the leased lock - to be polled by long running work."""
+
+        with self._heldLocksLock:
+            return lockName in self._heldLocks
+
+    # _________________________________________________________
+    def acquireSlotLock(self, lockName, nSlots, leaseSeconds = LOCK_LEASE_SECONDS):
+        """Acquire one of nSlots slots of counting lock.
+
+           The slots are locks <lockName>.<slot>. The slot number can be
+           used as partition, i.e. to process every nSlots-th entry. An
+           instance already holding a slot gets the same slot again.
+
+           Returns slot number or None if all slots are taken.
+           """
+
+        for slot in range(nSlots):
+            if self.acquireLock(getSlotLockName(lockName, slot), leaseSeconds):
+                return slot
+        return None
+
+    # _________________________________________________________
+    def releaseSlotLock(self, lockName, slot):
+        """Release slot of counting lock."""
+
+        return self.releaseLock(getSlotLockName(lockName, slot))
+
+    # _________________________________________________________
+    def countSlotLocks(self, lockName):
+        """Get number of taken slots of counting lock."""
+
+        collLock = self.getCollection("Process_Locks")
+        return collLock.count_documents({'_id': {'$regex': '^{0}\\.[0-9]+$'.format(re.escape(lockName))},
+                                         '$or': [{'leaseUntil': None},
+                                                 {'leaseUntil': {'$gte': datetime.datetime.utcnow()}}]})
+
+    # _________________________________________________________
+    def _startHeartbeat(self):
+        """Start heartbeat thread renewing the leases of the held locks."""
+
+        with self._heldLocksLock:
+            if self._heartbeat and self._heartbeat.is_alive():
+                return
+
+            self._heartbeatStop.clear()
+            self._heartbeat = threading.Thread(target=self._runHeartbeat, name='lockHeartbeat', daemon=True)
+            self._heartbeat.start()
+
+    # _________________________________________________________
+    def _stopHeartbeat(self):
+        self._heartbeatStop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    # _________________________________________________________
+    def _runHeartbeat(self):
+        while not self._heartbeatStop.wait(LOCK_HEARTBEAT_SECONDS):
+            with self._heldLocksLock:
+                heldLocks = list(self._heldLocks.items())
+
+            for lockName, leaseSeconds in heldLocks:
+                try:
+                    isRenewed = self.renewLock(lockName, leaseSeconds)
+                except errors.PyMongoError as err:
+                    print("Error: lease of lock {0} not renewed: {1}".format(lockName, err))
+                    continue
+
+                if not isRenewed:
+                    print("Error: lock {0} has been lost by {1}".format(lockName, self.lockHolder))
+                    with self._heldLocksLock:
+                        self._heldLocks.pop(lockName, None)
+
+    # _________________________________________________________
+    def checkProcessLock(self, fieldName):
+        """Check process lock - True if held by anyone and its lease not expired."""
+
+        collLock = self.getCollection("Process_Locks")
+        docLock = collLock.find_one({'_id': fieldName})
+        if not docLock:
             return False
 
-        return docLock[fieldName]
+        return not docLock.get('leaseUntil') or docLock['leaseUntil'] >= datetime.datetime.utcnow()
 
     # _________________________________________________________
-    def checkSetProcessLock(self, fieldName):
-        """Check process lock and set if False.
+    def checkSetProcessLock(self, fieldName, leaseSeconds = LOCK_LEASE_SECONDS):
+        """Check process lock and set if False - atomic.
 
            Returns True if already locked.
            """
 
-        if self.checkProcessLock(fieldName):
-            return True
-        else:
-            self.setProcessLock(fieldName)
-            return False
+        return not self.acquireLock(fieldName, leaseSeconds)
 
     # _________________________________________________________
-    def _setProcessLock(self, fieldName, state):
-        """Set process lock state."""
+    def setProcessLock(self, fieldName, leaseSeconds = LOCK_LEASE_SECONDS):
+        """Set process lock - active, taken over from any holder."""
 
-        collLock = self.getCollection("Process_Locks")
-        collLock.find_one_and_update({'unique': 'unique'},
-                                    {'$set': {fieldName: state}})
+        self.acquireLock(fieldName, leaseSeconds, force = True)
         return
 
     # _________________________________________________________
-    def setProcessLock(self, fieldName):
-        """Set process lock - active."""
+    def unsetProcessLock(self, fieldName):
+        """Set process lock - inactive, independent of its holder."""
 
-        self._setProcessLock(fieldName, True)
+        with self._heldLocksLock:
+            self._heldLocks.pop(fieldName, None)
+
+        collLock = self.getCollection("Process_Locks")
+        collLock.delete_one({'_id': fieldName})
         return
 
     # _________________________________________________________
-    def unsetProcessLock(self, fieldName):
-        """Set process lock - inactive."""
+    def unsetProcessLocks(self, prefix):
+        """Set all process locks starting with prefix - inactive, independent of their holders."""
+
+        with self._heldLocksLock:
+            for lockName in [lockName for lockName in self._heldLocks if lockName.startswith(prefix)]:
+                del self._heldLocks[lockName]
 
-        self._setProcessLock(fieldName, False)
+        collLock = self.getCollection("Process_Locks")
+        collLock.delete_many({'_id': {'$regex': '^{0}'.format(re.escape(prefix))}})
         return
 
+    # _________________________________________________________
+    def listProcessLocks(self):
+        """Get all process locks."""
+
+        collLock = self.getCollection("Process_Locks")
+        return list(collLock.find({'holder': {'$exists': True}}).sort('_id', ASCENDING))
+
 # ----------------------------------------------------------------------------------
 
+# ____________________________________________________________________________
+def getCommandMetrics():
+    """Get the command metrics of this process - its summary is printed at exit."""
+
+    global _commandMetrics
+
+    with _commandMetricsLock:
+        if not _commandMetrics:
+            _commandMetrics = commandMetrics()
+            atexit.register(_commandMetrics.printSummary)
+        return _commandMetrics
+
+# ____________________________________________________________________________
+def getReturnedDocs(commandName, reply):
+    """Get number of documents returned or written by a command from its reply."""
+
+    if commandName in ('find', 'aggregate', 'getMore'):
+        cursor = reply.get('cursor', {})
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if commandName == 'findAndModify':
+        return 1 if reply.get('value') else 0
+    if commandName == 'distinct':
+        return len(reply.get('values', []))
+    if commandName in ('count', 'insert', 'update', 'delete'):
+        return reply.get('n', 0)
+    return 0
+
+# ____________________________________________________________________________
+def getBucketLabel(idx):
+    """Get label of histogram bucket, i.e. '<=10' or '>10000'."""
+
+    if idx < len(METRICS_BUCKETS_MS):
+        return '<={0}'.format(METRICS_BUCKETS_MS[idx])
+    return '>{0}'.format(METRICS_BUCKETS_MS[-1])
+
+# ____________________________________________________________________________
+def iterChunks(iterable, chunkSize):
+    """Iterate over lists of up to chunkSize items of iterable, i.e. of a cursor."""
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+# ____________________________________________________________________________
+def formatBulkStats(stats):
+    """Format stats of bulkWriter flushes."""
+
+    return "{0} ops in {1:.2f}s - inserted {2}, upserted {3}, matched {4}, modified {5}, " \
+           "removed {6}, duplicates {7}, errors {8}".format(stats['nOps'], stats['seconds'], stats['nInserted'],
+                                                            stats['nUpserted'], stats['nMatched'], stats['nModified'],
+                                                            stats['nRemoved'], stats['nDuplicates'], stats['nErrors'])
+
+# ____________________________________________________________________________
+def getSlotLockName(lockName, slot):
+    """Get name of slot of counting lock."""
+
+    return '{0}.{1}'.format(lockName, slot)
+
+# ____________________________________________________________________________
+def ensureIndexes(db, collectionNames = None, verbose = True):
+    """Create indices of COLLECTION_INDICES and COLLECTION_INDEX_SPEC in database db."""
+
+    if not collectionNames:
+        collectionNames = sorted(set(COLLECTION_INDICES.keys()) | set(COLLECTION_INDEX_SPEC.keys()))
+
+    for collectionName in collectionNames:
+        indexModels = []
+        if collectionName in COLLECTION_INDICES:
+            indexModels.append(IndexModel([(COLLECTION_INDICES[collectionName], ASCENDING)], unique=True))
+
+        for keys, options in COLLECTION_INDEX_SPEC.get(collectionName, []):
+            indexModels.append(IndexModel(keys, **options))
+
+        # -- One by one, a failing index doesn't stop the others
+        for indexModel in indexModels:
+            try:
+                indexName = db[collectionName].create_indexes([indexModel])[0]
+                if verbose:
+                    print("Index {0}.{1}".format(collectionName, indexName))
+            except errors.OperationFailure as err:
+                print("Error: index on {0} {1} not created: {2}".format(collectionName, indexModel.document['key'], err))
+
 # ____________________________________________________________________________
 def main():
     """Initialize and run,"""
 
-    print("mongoDbUtil main")
+    parser = argparse.ArgumentParser(description='Management of the SDMS mongoDB.')
+    parser.add_argument('command', choices=['ensure-indexes', 'list-locks', 'release-lock'],
+                        help='ensure-indexes: create indices of all SDMS collections - once at deploy time, '
+                             'list-locks: list process locks and their holders, '
+                             'release-lock: release process lock --lockName of any holder')
+    parser.add_argument('--lockName', help='name of process lock for release-lock')
+    parser.add_argument('--mongoUri',
+                        help='connect to this mongoDB (i.e. mongodb://localhost:27017) instead of the NERSC mongoDB')
+    parser.add_argument('--backend', choices=MONGO_BACKENDS,
+                        help='mongoDB backend (default: env SDMS_MONGO_BACKEND or nersc)')
+    parser.add_argument('--mongoMetrics', choices=MONGO_METRICS_MODES,
+                        help='record mongoDB command metrics (default: env SDMS_MONGO_METRICS or none)')
+    args = parser.parse_args()
+
+    dbUtil = mongoDbUtil(args, "admin")
+
+    # -- The lock commands see the locks of the legacy lock document as well
+    if args.command in ('list-locks', 'release-lock'):
+        dbUtil.migrateLegacyLocks()
+
+    if args.command == 'ensure-indexes':
+        dbUtil.ensureIndexes()
+
+    elif args.command == 'list-locks':
+        for docLock in dbUtil.listProcessLocks():
+            print("{0:<32} {1:<48} lease until: {2}".format(docLock['_id'], docLock['holder'],
+                                                            docLock['leaseUntil'] or 'released by holder'))
+
+    elif args.command == 'release-lock':
+        if not args.lockName:
+            print("release-lock needs --lockName")
+        else:
+            dbUtil.unsetProcessLock(args.lockName)
+
+    dbUtil.close()
 
 
 # ----------------------------------------------------------------------------------
@@ -24,8 +24,9 @@ import socket
 import datetime
 import shlex, subprocess
 import errno
+import itertools
 
-from mongoUtil import mongoDbUtil
+from mongoUtil import mongoDbUtil, iterChunks
 import pymongo
 
 from pymongo import results
@@ -40,6 +41,8 @@ from pprint import pprint
 XROOTD_PREFIX = '/export/data/xrd/ns/star'
 DISK_LIST = ['data', 'data1', 'data2', 'data3', 'data4']
 
+PROCESS_CHUNK_SIZE = 1000  # filePaths resolved with one $in query
+
 ##############################################
 
 # -- Check for a proper Python Version
@@ -64,6 +67,7 @@ class processXRD:
                           'picoDstJet': 'PicoDstsJets',
                           'aschmah': 'ASchmah'}
 
+        self._dbUtil = dbUtil
         self._addCollections(dbUtil)
 
     # _________________________________________________________
@@ -89,24 +93,47 @@ class processXRD:
 
     # _________________________________________________________
     def processNew(self, target):
-        """process target"""
+        """process target
+
+           Loop over the new documents grouped by filePath, resolve the
+           existing XRD and HPSS documents of a chunk of filePaths at once
+           and write the results in bulk.
+           """
 
         if target not in self._listOfTargets:
             print('Process Target: Unknown "target"', target, 'for processing')
             return
 
-        # -- Loop over all documents in the new collection
-        while True:
+        # -- Loop over all documents in the new collection - grouped by filePath
+        cursor = self._collsXRDNew[target].find({'storage.location': 'XRD', 'target': target}).sort('filePath', pymongo.ASCENDING)
+        iterGroups = (list(xrdDocs) for filePath, xrdDocs in itertools.groupby(cursor, key=lambda doc: doc['filePath']))
+
+        with self._dbUtil.getBulkWriter('processXRD new', ordered = True) as writer:
+            for listGroups in iterChunks(iterGroups, PROCESS_CHUNK_SIZE):
+                listFilePaths = [xrdDocs[0]['filePath'] for xrdDocs in listGroups]
+
+                existDocs = {doc['filePath']: doc for doc in self._collsXRD[target].find({'storage.location': 'XRD', 'target': target,
+                                                                                         'filePath': {'$in': listFilePaths}})}
+                hpssDocs = {doc['filePath']: doc for doc in self._collsHPSS[target].find({'target': target,
+                                                                                         'filePath': {'$in': listFilePaths}})}
+
+                for xrdDocs in listGroups:
+                    filePath = xrdDocs[0]['filePath']
+                    self._processNewFilePath(target, xrdDocs, existDocs.get(filePath), hpssDocs.get(filePath), writer)
+
+    # _________________________________________________________
+    def _processNewFilePath(self, target, xrdDocsOfFilePath, existDoc, hpssDoc, writer):
+        """Process all new documents of one filePath.
+
+           Documents moved to an extra collection are removed one by one,
+           the remaining ones are processed again.
+           """
 
-            # - Get first new document of target
-            xrdDocNew = self._collsXRDNew[target].find_one({'storage.location': 'XRD', 'target': target})
-            if not xrdDocNew:
-                break
+        while xrdDocsOfFilePath:
 
-            # - Get all new documents of same file (filePath)
-            xrdDocs = list(self._collsXRDNew[target].find({'storage.location': 'XRD',
-                                                           'target': target,
-                                                           'filePath': xrdDocNew['filePath']}))
+            # - First new document of filePath and all new documents of same file (filePath)
+            xrdDocNew = xrdDocsOfFilePath[0]
+            xrdDocs = xrdDocsOfFilePath
 
             # -- Assure that all documents have the same fileSize.
             #    If not, use only the one file: xrdDocNew
@@ -131,20 +158,16 @@ class processXRD:
             #      - remove document from new collection
             #    - update the the storage fields
             #    - remove document from new collection
-            existDoc = self._collsXRD[target].find_one({'storage.location': 'XRD', 'target': target,
-                                                        'filePath': xrdDocNew['filePath']})
             if existDoc:
                 # -- Check if the fileSizes match
                 #    - if not move new document to extra collection : Corrupt
                 if existDoc['fileSize'] != xrdDocNew['fileSize']:
                     xrdDocNew['nodeFilePath'] = "{0}_{1}".format(xrdDocNew['storage']['detail'], xrdDocNew['filePath'])
 
-                    try:
-                        self._collsXRDCorrupt[target].insert(xrdDocNew)
-                    except:
-                        pass
+                    writer.insert(self._collsXRDCorrupt[target], xrdDocNew)
+                    writer.deleteOne(self._collsXRDNew[target], {'_id': xrdDocNew['_id']})
 
-                    self._collsXRDNew[target].delete_one({'_id': xrdDocNew['_id']})
+                    xrdDocsOfFilePath = xrdDocsOfFilePath[1:]
                     continue
 
                 # -- Update the set of all nodes where the file is stored
@@ -155,37 +178,28 @@ class processXRD:
                 newNodeDiskDict.update(nodeDiskDict)
 
                 # -- Update existing document
-                self._collsXRD[target].find_one_and_update({'storage.location': 'XRD', 'target': target,
-                                                            'filePath': xrdDocNew['filePath']},
-                                                           {'$set': {'storage.nCopies': len(detailsSet),
-                                                                     'storage.details': list(detailsSet),
-                                                                     'storage.disks': newNodeDiskDict}})
+                writer.updateOne(self._collsXRD[target], {'storage.location': 'XRD', 'target': target,
+                                                          'filePath': xrdDocNew['filePath']},
+                                 {'$set': {'storage.nCopies': len(detailsSet),
+                                           'storage.details': list(detailsSet),
+                                           'storage.disks': newNodeDiskDict}})
 
                 # -- Remove entries from new collection
-                self._collsXRDNew[target].delete_many({'storage.location': 'XRD', 'target': target,
-                                                       'filePath': xrdDocNew['filePath']})
-
-                continue
+                writer.deleteMany(self._collsXRDNew[target], {'storage.location': 'XRD', 'target': target,
+                                                              'filePath': xrdDocNew['filePath']})
+                return
 
             # -----------------------------------------------
-            # -- Get corresponding HPSS Document
-            #    - if not move new document to extra collection
-            #    - remove document from new collection
-            #    - create new document
-            hpssDoc = self._collsHPSS[target].find_one({'target': target,
-                                                        'filePath': xrdDocNew['filePath'] })
-
-            # -- Check if HPSS doc exists
+            # -- Check corresponding HPSS Document
             #    - if not move new document to extra collection : NoHPSS
+            #    - remove document from new collection
             if not hpssDoc:
                 xrdDocNew['nodeFilePath'] = "{0}_{1}".format(xrdDocNew['storage']['detail'], xrdDocNew['filePath'])
 
-                try:
-                    self._collsXRDNoHPSS[target].insert(xrdDocNew)
-                except:
-                    pass
+                writer.insert(self._collsXRDNoHPSS[target], xrdDocNew)
+                writer.deleteOne(self._collsXRDNew[target], {'_id': xrdDocNew['_id']})
 
-                self._collsXRDNew[target].delete_one({'_id': xrdDocNew['_id']})
+                xrdDocsOfFilePath = xrdDocsOfFilePath[1:]
                 continue
 
             # -- Create new document
@@ -206,21 +220,18 @@ class processXRD:
             #    - if equal: add all in collection
             #    - if not:  move new documents to extra collection : Corrupt
             if hpssDoc['fileSize'] == xrdDocNew['fileSize']:
-                self._collsXRD[target].insert(doc)
+                writer.insert(self._collsXRD[target], doc)
 
             else:
                 for item in xrdDocs:
                     item['nodeFilePath'] = "{0}_{1}".format(item['storage']['detail'], item['filePath'])
-
-                try:
-                    self._collsXRDCorrupt[target].insert_many(xrdDocs)
-                except:
-                    pass
+                    writer.insert(self._collsXRDCorrupt[target], item)
 
             # -- Remove documents form new collection
-            self._collsXRDNew[target].delete_many({'storage.location': 'XRD',
-                                                   'target': target,
-                                                   'filePath': xrdDocNew['filePath']})
+            writer.deleteMany(self._collsXRDNew[target], {'storage.location': 'XRD',
+                                                          'target': target,
+                                                          'filePath': xrdDocNew['filePath']})
+            return
 
     # _________________________________________________________
     def processMiss(self, target):
@@ -229,52 +240,61 @@ class processXRD:
             Loop over collection of missing files and remove them from
             XRD collection. If file has several copies, remove the copy of
             the node where its missing.
+
+            The existing documents of a chunk of missing files are read at
+            once and kept up to date locally, the changes are written in bulk.
             """
 
         if target not in self._listOfTargets:
             print('Process Target: Unknown "target"', target, 'for processing')
             return
 
-        # -- Loop over all documents in the new collection
-        while True:
+        # -- Loop over all documents in the missing collection
+        cursor = self._collsXRDMiss[target].find({'storage.location': 'XRD', 'target': target, 'issue':'missing'})
 
-            # - Get first document of target
-            xrdDocMiss = self._collsXRDMiss[target].find_one({'storage.location': 'XRD',
-                                                              'target': target,
-                                                              'issue':'missing'})
-            if not xrdDocMiss:
-                break
+        with self._dbUtil.getBulkWriter('processXRD missing', ordered = True) as writer:
+            for listMissDocs in iterChunks(cursor, PROCESS_CHUNK_SIZE):
 
-            # -----------------------------------------------
-            # -- Get existing document
-            existDoc = self._collsXRD[target].find_one({'storage.location': 'XRD', 'target': target,
-                                                        'filePath': xrdDocMiss['filePath'],
-                                                        'storage.details': xrdDocMiss['storage']['detail']})
-            # -- Not a document
-            #    - remove it from list dependend on cases
-            if not existDoc:
-                print("Process Target: Doc not even in list", xrdDocMiss['filePath'])
-                self._collsXRDMiss[target].delete_one({'_id': xrdDocMiss['_id']})
-                continue
+                # -- Changes of the previous chunk have to be written before reading
+                writer.flush(self._collsXRD[target])
 
-            # -- Remove entry if only one copy
-            if existDoc['storage']['nCopies'] == 1:
-                self._collsXRD[target].delete_one({'_id': existDoc['_id']})
+                # -----------------------------------------------
+                # -- Get existing documents
+                existDocs = {doc['filePath']: doc
+                             for doc in self._collsXRD[target].find({'storage.location': 'XRD', 'target': target,
+                                                                     'filePath': {'$in': [doc['filePath'] for doc in listMissDocs]}},
+                                                                    {'filePath': True, 'storage.nCopies': True, 'storage.details': True})}
 
-            # -- Remove one storage detail
-            else:
-                detailsSet = set(existDoc['storage']['details'])
-                detailsSet.discard(xrdDocMiss['storage']['detail'])
+                for xrdDocMiss in listMissDocs:
+                    node = xrdDocMiss['storage']['detail']
+                    existDoc = existDocs.get(xrdDocMiss['filePath'])
+
+                    # -- Not a document
+                    #    - remove it from list dependend on cases
+                    if not existDoc or node not in existDoc['storage']['details']:
+                        print("Process Target: Doc not even in list", xrdDocMiss['filePath'])
+                        writer.deleteOne(self._collsXRDMiss[target], {'_id': xrdDocMiss['_id']})
+                        continue
+
+                    # -- Remove entry if only one copy
+                    if existDoc['storage']['nCopies'] == 1:
+                        writer.deleteOne(self._collsXRD[target], {'_id': existDoc['_id']})
+                        del existDocs[xrdDocMiss['filePath']]
+
+                    # -- Remove one storage detail
+                    else:
+                        detailsSet = set(existDoc['storage']['details'])
+                        detailsSet.discard(node)
+
+                        existDoc['storage']['nCopies'] = len(detailsSet)
+                        existDoc['storage']['details'] = list(detailsSet)
 
-                self._collsXRD[target].find_one_and_update({'storage.location': 'XRD',
-                                                            'target': target,
-                                                            'filePath': xrdDocMiss['filePath'],
-                                                            'storage.details': xrdDocMiss['storage']['detail']},
-                                                           {'$set': {'storage.nCopies': len(detailsSet),
-                                                                     'storage.details': list(detailsSet)}})
+                        writer.updateOne(self._collsXRD[target], {'_id': existDoc['_id']},
+                                         {'$set': {'storage.nCopies': len(detailsSet),
+                                                   'storage.details': list(detailsSet)}})
 
-            # -- Remove from list of missing
-            self._collsXRDMiss[target].delete_one({'_id': xrdDocMiss['_id']})
+                    # -- Remove from list of missing
+                    writer.deleteOne(self._collsXRDMiss[target], {'_id': xrdDocMiss['_id']})
 
 # ____________________________________________________________________________
 def main():
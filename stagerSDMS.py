@@ -14,16 +14,21 @@ import sys
 import os
 import re
 import json
+import collections
 import psutil
+import tempfile
 
 import logging as log
 import time
 import socket
 import datetime
+import uuid
 import shlex, subprocess
 from subprocess import STDOUT, check_output
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-from mongoUtil import mongoDbUtil
+from mongoUtil import mongoDbUtil, getSlotLockName, iterChunks
+from commandUtil import commandRunner
 import pymongo
 
 from pymongo import results
@@ -41,9 +46,23 @@ SCRATCH_FREE_MIN = 1024 # in GB
 
 HPSS_TAPE_ORDER_SCRIPT = "/usr/common/usg/bin/hpss_file_sorter.script"
 HPSS_SPLIT_MAX = 10
+HPSS_MAX_DRIVES = 4    # tape drives used at the same time by all stager processes
+HPSS_STREAMS = 4       # extraction streams per stager process
+
+HTAR_SEEK_COST = 1024*1024*1024  # in bytes - read from tape in the time of one seek to a tar member
+HTAR_EXTRACTED_PATTERN = re.compile(r'^HTAR: x (.+), ([0-9]+) bytes')
+
+HSI_GET_BATCH_SIZE = 100  # max number of files fetched in one hsi session
+HSI_GET_PATTERN = re.compile(r"^get '(.+)' : '(.+)' \(.* ([0-9]+) bytes")
+
+STAGE_DIFF_CHUNK_SIZE = 10000  # filePaths per page of the HPSS / staging target difference
 
 META_MANAGER = "pstarxrdr1"
 
+XRD_TRANSFERS = 16          # concurrent xrdcp transfers per stager process
+XRD_MANAGER_TRANSFERS = {'MENDEL_1': 8, 'MENDEL_2': 8, 'MENDEL_ALL': 16}  # per manager
+XRD_CLAIM_BATCH_SIZE = 50   # files claimed at once from Stage_To_XRD
+
 ##############################################
 
 # -- Check for a proper Python Version
@@ -67,6 +86,10 @@ class stagerSDMS:
 
         self._scratchSpaceFlag = True  # still enough space
 
+        self._nodeRoles = None  # roles of XRD nodes, see _getNodeRoles
+
+        self._runner = commandRunner()
+
         self._listOfStageTargets = ['XRD']  # , 'Disk']
 
         self._listOfQueryItems   = ['runyear', 'system', 'energy',
@@ -92,6 +115,18 @@ class stagerSDMS:
         # -- Get HPSS staging parameters
         self._getHPSSStagingParameters()
 
+    # _________________________________________________________
+    def setReplayMode(self, replayDir = None, recordDir = None):
+        """Set replay or record mode of the hsi/htar output of the staging from HPSS.
+
+           As for crawlerHPSS.py: in replay mode the output is read from a
+           capture file in replayDir, in record mode it is written in
+           addition to a capture file in recordDir - see commandUtil.py.
+           In replay mode nothing is written to the scratch space.
+           """
+
+        self._runner = commandRunner(replayDir, recordDir)
+
     # _________________________________________________________
     def _readStagingFile(self):
         """Read in staging file."""
@@ -117,9 +152,6 @@ class stagerSDMS:
         # -- Data server collection
         self._collServerXRD = self._dbUtil.getCollection('XRD_DataServers')
 
-        # -- Process Locks
-        self._collProcessLocks = self._dbUtil.getCollection('Process_Locks')
-
         # -- HPPS files collection
         self._collsHPSSFiles = self._dbUtil.getCollection('HPSS_Files')
 
@@ -164,6 +196,10 @@ class stagerSDMS:
         nEntries = self._collServerXRD.find().count()
         self._stageXRD['tryMax'] = 10 * nEntries
 
+        self._stageXRD['nTransfers'] = XRD_TRANSFERS
+        self._stageXRD['managerTransfers'] = XRD_MANAGER_TRANSFERS
+        self._stageXRD['claimBatchSize'] = XRD_CLAIM_BATCH_SIZE
+
         self._stageXRD['server'] = dict()
         doc = self._collServerXRD.find_one({'roles':'MENDEL_ONE_MANAGER'})
         self._stageXRD['server']['MENDEL_1'] = doc['nodeName'] + '-ib.nersc.gov'
@@ -187,12 +223,19 @@ class stagerSDMS:
 
         self._stageHPSS['splitMax'] = HPSS_SPLIT_MAX
 
+        self._stageHPSS['maxDrives'] = HPSS_MAX_DRIVES
+        self._stageHPSS['nStreams'] = HPSS_STREAMS
+
+        self._stageHPSS['htarSeekCost'] = HTAR_SEEK_COST
+
+        self._stageHPSS['hsiBatchSize'] = HSI_GET_BATCH_SIZE
+
     # _________________________________________________________
     def prepareStaging(self):
         """Perpare staging as start of a new cycle"""
 
-        # -- start new staging cycle
-        if not self._dbUtil.checkSetProcessLock("staging_cycle_active"):
+        # -- start new staging cycle - lock without lease, held until the end of the cycle
+        if not self._dbUtil.checkSetProcessLock("staging_cycle_active", leaseSeconds = None):
 
             # -- Read in staging File
             self._readStagingFile()
@@ -310,26 +353,47 @@ class stagerSDMS:
             for stageTarget in self._listOfStageTargets:
                 stageField = 'staging.stageMarker{0}'.format(stageTarget)
 
-                # -- Get all documents from HPSS to be staged
-                hpssDocs = list(self._collsHPSS[target].find({'target': target, stageField: True}))
-                docsSetHPSS = set([item['filePath'] for item in hpssDocs])
+                # -- Get collection to stage from HPSS and to stageTarget - chunk by chunk
+                for docsToStage in self._iterFilePathsToStage(target, stageTarget, stageField):
+                    self._prepareStageColls(docsToStage, target, stageTarget)
+
+    # _________________________________________________________
+    def _iterFilePathsToStage(self, target, stageTarget, stageField):
+        """Iterate over chunks of filePaths marked for staging in HPSS, but not on staging target.
 
-                # -- Get all files on stageing Target
-                queryNCopies = 'storage.details.{}'.format(self._nCopies - 1)
-                stagedDocs = list(self._collsStageTarget[target][stageTarget].find({'storage.location': stageTarget,
-                                                                                    'target': target,
-                                                                                    queryNCopies: {"$exists": True}}))
+           The set difference is done chunk-wise, on projected documents:
+           a page of HPSS filePaths, then one $in query for the ones of the
+           page already on the staging target with enough copies.
+           """
+
+        queryNCopies = 'storage.details.{}'.format(self._nCopies - 1)
+
+        lastFilePath = None
+        while True:
 
-                docsSetStaged = set([item['filePath'] for item in stagedDocs])
+            # -- Get next page of HPSS filePaths to be staged
+            queryHPSS = {'target': target, stageField: True}
+            if lastFilePath is not None:
+                queryHPSS['filePath'] = {'$gt': lastFilePath}
 
-                # -- Document to be staged
-                docsToStage = docsSetHPSS - docsSetStaged
+            listFilePaths = [doc['filePath'] for doc in self._collsHPSS[target].find(queryHPSS, {'filePath': True, '_id': False})
+                                                                                .sort('filePath', pymongo.ASCENDING)
+                                                                                .limit(STAGE_DIFF_CHUNK_SIZE)]
+            if not listFilePaths:
+                break
+            lastFilePath = listFilePaths[-1]
 
-                # -- Documents to be removed from stageTarget
-                docsToRemove = docsSetStaged - docsSetHPSS
+            # -- Get files of page on stageing Target
+            docsSetStaged = set(doc['filePath'] for doc in self._collsStageTarget[target][stageTarget].find({'storage.location': stageTarget,
+                                                                                                         'target': target,
+                                                                                                         'filePath': {'$in': listFilePaths},
+                                                                                                         queryNCopies: {"$exists": True}},
+                                                                                                        {'filePath': True, '_id': False}))
 
-                # -- Get collection to stage from HPSS and to stageTarget
-                self._prepareStageColls(docsToStage, target, stageTarget)
+            # -- Documents to be staged
+            docsToStage = [filePath for filePath in listFilePaths if filePath not in docsSetStaged]
+            if docsToStage:
+                yield docsToStage
 
     #  ____________________________________________________________________________
     def _prepareStageColls(self, docsToStage, target, stageTarget):
@@ -337,145 +401,281 @@ class stagerSDMS:
 
            - Fill collection to stage from HPSS to Disk
            - Fill collection to stage from Disk to Target
+
+           The documents of all files of docsToStage are resolved with one
+           $in query per collection, the stage documents are written in bulk.
            """
 
-        # -- Loop over all paths and gather information
-        for currentPath in docsToStage:
+        docsToStage = list(docsToStage)
 
-            hpssDoc = self._collsHPSS[target].find_one({'filePath': currentPath})
+        # -- Get HPSS documents of all paths
+        hpssDocs = list(self._collsHPSS[target].find({'filePath': {'$in': docsToStage}},
+                                                     {'filePath': True, 'fileFullPath': True, 'fileFullPathTar': True,
+                                                      'isInTarFile': True, 'fileSize': True, 'target': True}))
 
-            if hpssDoc['isInTarFile']:
-                hpssFilePath = hpssDoc['fileFullPathTar']
-            else:
-                hpssFilePath = hpssDoc['fileFullPath']
+        # -- Get docs of actual tar files on HPSS
+        listTarFiles = list(set(hpssDoc['fileFullPathTar'] for hpssDoc in hpssDocs if hpssDoc['isInTarFile']))
+        filesInTar = {doc['fileFullPath']: doc['filesInTar']
+                      for doc in self._collsHPSSFiles.find({'fileFullPath': {'$in': listTarFiles}},
+                                                           {'fileFullPath': True, 'filesInTar': True})}
 
-            # -- Get doc of actual file on HPSS
-            hpssDocFile = self._collsHPSSFiles.find_one({'fileFullPath': hpssFilePath})
+        # -- Get nodes of files existing already on stageTarget
+        xrdNodes = {doc['filePath']: doc['storage']['details']
+                    for doc in self._collsStageTarget[target][stageTarget].find({'filePath': {'$in': docsToStage}},
+                                                                                {'filePath': True, 'storage.details': True})}
 
-            # -- Create doc : stageDocFromHPSS
-            stageDocFromHPSS = {'fileFullPath': hpssFilePath,
-                                'stageStatus': 'unstaged',
-                                'target': target,
-                                'stageTarget': stageTarget}
+        nodeRoles = self._getNodeRoles()
 
-            if hpssDoc['isInTarFile']:
-                stageDocFromHPSS['filesInTar'] = hpssDocFile['filesInTar']
-                stageDocFromHPSS['isInTarFile'] = True
+        # -- Gather files per file on HPSS : stageDocFromHPSS, listOfFiles
+        stageDocsFromHPSS = {}
 
-            # -- Update doc in collStageFromHPSS if doc exists otherwise add new
-            self._collStageFromHPSS.find_one_and_update({'fileFullPath': hpssFilePath},
-                                                        {'$addToSet': {'listOfFiles': hpssDoc['fileFullPath']},
-                                                         '$setOnInsert' : stageDocFromHPSS}, upsert = True)
-
-            # -- Get Update doc in collStageToStagingTarget
-            emptyList = []
-            stageDocToTarget = {
-                'filePath':     currentPath,
-                'fileFullPath': hpssDoc['fileFullPath'],
-                'fileSize':     hpssDoc['fileSize'],
-                'target':       hpssDoc['target'],
-                'stageStatusHPSS':  'unstaged',
-                'stageStatusTarget': 'unstaged',
-                'note': emptyList}
-
-            # -- Basic set of stage targets if no document exists
-            if self._nCopies == 1:
-                stageDocToTarget['stageTargetList'] = ['MENDEL_ALL']
-            else:
-                stageDocToTarget['stageTargetList'] = ['MENDEL_1', 'MENDEL_2']
+        with self._dbUtil.getBulkWriter('prepareStageColls') as writer:
+            for hpssDoc in hpssDocs:
+                currentPath = hpssDoc['filePath']
 
-            # -- Get list of sub cluster for stageTarget collection if document exists already
-            xrdDoc = self._collsStageTarget[target][stageTarget].find_one({'filePath': currentPath})
-            if (xrdDoc):
+                if hpssDoc['isInTarFile']:
+                    hpssFilePath = hpssDoc['fileFullPathTar']
+                else:
+                    hpssFilePath = hpssDoc['fileFullPath']
 
-                stageTargetList = []
-                for node in xrdDoc['storage']['details']:
-                    nodeDoc = self._collServerXRD.find_one({'nodeName': node})
-                    if not 'MENDEL_ONE_DATASERVER' in nodeDoc['roles']:
-                        stageTargetList.append('MENDEL_1')
-                    if not 'MENDEL_TWO_DATASERVER' in nodeDoc['roles']:
-                        stageTargetList.append('MENDEL_2')
+                # -- Create doc : stageDocFromHPSS
+                if hpssFilePath not in stageDocsFromHPSS:
+                    stageDocFromHPSS = {'fileFullPath': hpssFilePath,
+                                        'stageStatus': 'unstaged',
+                                        'target': target,
+                                        'stageTarget': stageTarget}
 
-                if len(stageTargetList) > 0:
-                    stageDocToTarget['stageTargetList'] = stageTargetList
+                    if hpssDoc['isInTarFile']:
+                        if hpssFilePath not in filesInTar:
+                            print("Error: tar file {0} of {1} not in HPSS_Files".format(hpssFilePath, currentPath))
+                            continue
 
-            # -- Insert new doc in collStageToStagingTarget
-            try:
-                self._collsStageToStageTarget[stageTarget].insert(stageDocToTarget)
-            except:
-                pass
+                        stageDocFromHPSS['filesInTar'] = filesInTar[hpssFilePath]
+                        stageDocFromHPSS['isInTarFile'] = True
+                    else:
+                        stageDocFromHPSS['fileSize'] = hpssDoc['fileSize']
+
+                    stageDocsFromHPSS[hpssFilePath] = (stageDocFromHPSS, [])
+
+                stageDocsFromHPSS[hpssFilePath][1].append(hpssDoc['fileFullPath'])
+
+                # -- Get Update doc in collStageToStagingTarget
+                emptyList = []
+                stageDocToTarget = {
+                    'filePath':     currentPath,
+                    'fileFullPath': hpssDoc['fileFullPath'],
+                    'fileSize':     hpssDoc['fileSize'],
+                    'target':       hpssDoc['target'],
+                    'stageStatusHPSS':  'unstaged',
+                    'stageStatusTarget': 'unstaged',
+                    'note': emptyList}
+
+                # -- Basic set of stage targets if no document exists
+                if self._nCopies == 1:
+                    stageDocToTarget['stageTargetList'] = ['MENDEL_ALL']
+                else:
+                    stageDocToTarget['stageTargetList'] = ['MENDEL_1', 'MENDEL_2']
+
+                # -- Get list of sub cluster for stageTarget collection if document exists already
+                if currentPath in xrdNodes:
+
+                    stageTargetList = []
+                    for node in xrdNodes[currentPath]:
+                        roles = nodeRoles.get(node, [])
+                        if not 'MENDEL_ONE_DATASERVER' in roles:
+                            stageTargetList.append('MENDEL_1')
+                        if not 'MENDEL_TWO_DATASERVER' in roles:
+                            stageTargetList.append('MENDEL_2')
+
+                    if len(stageTargetList) > 0:
+                        stageDocToTarget['stageTargetList'] = stageTargetList
+
+                # -- Insert new doc in collStageToStagingTarget
+                writer.insert(self._collsStageToStageTarget[stageTarget], stageDocToTarget)
+
+            # -- Update doc in collStageFromHPSS if doc exists otherwise add new
+            for hpssFilePath, (stageDocFromHPSS, listOfFiles) in stageDocsFromHPSS.items():
+                writer.updateOne(self._collStageFromHPSS, {'fileFullPath': hpssFilePath},
+                                 {'$addToSet': {'listOfFiles': {'$each': listOfFiles}},
+                                  '$setOnInsert' : stageDocFromHPSS}, upsert = True)
+
+    #  ____________________________________________________________________________
+    def _getNodeRoles(self):
+        """Get roles of all XRD nodes - read once per run."""
+
+        if self._nodeRoles is None:
+            self._nodeRoles = {doc['nodeName']: doc.get('roles', [])
+                               for doc in self._collServerXRD.find({}, {'nodeName': True, 'roles': True})}
+
+        return self._nodeRoles
 
     #  ____________________________________________________________________________
     def createTapeOrderingHPSS(self):
-        """Create tape ordering"""
+        """Create tape ordering and split it into stage groups.
+
+           The files are ordered by tape volume and position, as recorded in
+           HPSS_Files by the crawler, and every tape volume is one stage group.
+           Files without tape position follow in the order of the tape ordering
+           script, split in stage groups by count. Order and stage group of
+           all unstaged files are written in bulk.
+           """
+
+        listOfFiles = [doc['fileFullPath'] for doc in self._collStageFromHPSS.find({'stageStatus':'unstaged'},
+                                                                                   {'fileFullPath': True, '_id': False})]
+
+        # -- Get tape volume and position from HPSS_Files
+        tapeInfos = {}
+        for chunk in iterChunks(listOfFiles, STAGE_DIFF_CHUNK_SIZE):
+            for doc in self._collsHPSSFiles.find({'fileFullPath': {'$in': chunk}, 'tapeVolume': {'$exists': True}},
+                                                 {'fileFullPath': True, 'tapeVolume': True, 'tapePosition': True, '_id': False}):
+                tapeInfos[doc['fileFullPath']] = (doc['tapeVolume'], doc['tapePosition'])
+
+        listOnTape = sorted(tapeInfos.keys(), key=tapeInfos.get)
+        tapeGroups = {tapeVolume: idx + 1 for idx, tapeVolume in
+                      enumerate(sorted(set(tapeVolume for tapeVolume, tapePosition in tapeInfos.values())))}
+
+        # -- Files without tape position - ordered by the tape ordering script
+        listNoTape = [fileFullPath for fileFullPath in listOfFiles if fileFullPath not in tapeInfos]
+        if listNoTape:
+            listNoTape = self._getTapeOrderFromScript(listNoTape)
+
+        # -- Update collection
+        with self._dbUtil.getBulkWriter('createTapeOrderingHPSS') as writer:
+            for orderIdx, fileFullPath in enumerate(listOnTape):
+                tapeVolume = tapeInfos[fileFullPath][0]
+                writer.updateOne(self._collStageFromHPSS, {'fileFullPath': fileFullPath, 'stageStatus': 'unstaged'},
+                                 {'$set' : {'orderIdx': orderIdx,
+                                            'stageGroup': tapeGroups[tapeVolume],
+                                            'tapeVolume': tapeVolume}})
+
+            for idx, fileFullPath in enumerate(listNoTape):
+                writer.updateOne(self._collStageFromHPSS, {'fileFullPath': fileFullPath, 'stageStatus': 'unstaged'},
+                                 {'$set' : {'orderIdx': len(listOnTape) + idx,
+                                            'stageGroup': len(tapeGroups) + self._getStageGroup(idx, len(listNoTape))}})
+
+    #  ____________________________________________________________________________
+    def _getTapeOrderFromScript(self, listOfFiles):
+        """Get list of files in tape order of the tape ordering script.
+
+           Files missing in the output of the script are appended.
+           """
+
+        setOfFiles = set(listOfFiles)
 
         # -- Write order file
         with open("{0}/orderMe.txt".format(self._scratchSpace), "w") as orderMe:
-            for hpssDocFile in self._collStageFromHPSS.find({'stageStatus':'unstaged'}):
-                print(hpssDocFile['fileFullPath'], file=orderMe)
+            for fileFullPath in listOfFiles:
+                print(fileFullPath, file=orderMe)
 
         # -- Call tape ordering script
         cmdLine = '{0} {1}/orderMe.txt'.format(self._stageHPSS['tapeOrderScript'], self._scratchSpace)
         cmd = shlex.split(cmdLine)
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-        # -- Process output and update collection
-        orderIdx = 0
+        # -- Process output - in tape order
+        listOrdered = []
         for text in iter(p.stdout.readline, b''):
-            self._collStageFromHPSS.find_one_and_update({'fileFullPath': text.decode("utf-8").rstrip(), 'stageStatus': 'unstaged'},
-                                                        {'$set' : {'orderIdx': orderIdx}})
-            orderIdx += 1
+            fileFullPath = text.decode("utf-8").rstrip()
+            if fileFullPath in setOfFiles:
+                listOrdered.append(fileFullPath)
+                setOfFiles.discard(fileFullPath)
 
         # -- Clean up order file
         os.remove("{0}/orderMe.txt".format(self._scratchSpace))
 
-        # -- Split stage set
-        self._splitStageFromHPSS()
+        # -- Files missing in the output of the script at the end
+        listOrdered.extend(fileFullPath for fileFullPath in listOfFiles if fileFullPath in setOfFiles)
 
-    #  ____________________________________________________________________________
-    def _splitStageFromHPSS(self):
-        """Split list in n parts"""
+        return listOrdered
 
-        nAll = self._collStageFromHPSS.find({'stageStatus':'unstaged'}).count()
+    #  ____________________________________________________________________________
+    def _getStageGroup(self, idx, nAll):
+        """Get stage group of idx-th file in tape order - split list in n parts"""
 
         if nAll <= self._stageHPSS['splitMax']:
-            self._collStageFromHPSS.update_many({'stageStatus':'unstaged'}, {'$set' : {'stageGroup': 1}})
-            return
-
-        self._collStageFromHPSS.update_many({'stageStatus':'unstaged'}, {'$set' : {'stageGroup': -1}})
+            return 1
 
         split = int(nAll / self._stageHPSS['splitMax'])
 
-        for splitIdx in range(1, self._stageHPSS['splitMax']+2):
-            for doc in self._collStageFromHPSS.find({'stageStatus':'unstaged',
-                                                     'stageGroup': -1}, {'_id':True}).sort('orderIdx', pymongo.ASCENDING).limit(split):
-
-                self._collStageFromHPSS.update_one({'_id': doc['_id']}, {'$set': {'stageGroup': splitIdx}})
+        return idx // split + 1
 
     #  ____________________________________________________________________________
-    def stageFromHPSS(self):
+    def stageFromHPSS(self, nStreams = None):
         """Stage list of files from HPSS on to scratch space
 
-           Implemented as single squential process to keep file ordering.
+           Runs nStreams extraction streams in parallel. Each stream holds one
+           of the maxDrives drive slots - shared by all stager processes - and
+           claims one stage group after the other, i.e. a set of tapes, by its
+           leased lock. The files of a group are staged in tape order. Streams
+           done with their group take the next free one, until no group is left.
         """
 
-        lock = True
-        for stageGroup in sorted(self._collStageFromHPSS.find({'stageStatus': 'unstaged'}).distinct('stageGroup')):
-            if not self._dbUtil.checkSetProcessLock("stagingHPSS_{}".format(stageGroup)):
-                 lock = False
-                 break
+        if nStreams is None:
+            nStreams = self._stageHPSS['nStreams']
 
-        if lock:
-            return
+        with ThreadPoolExecutor(max_workers = nStreams) as executor:
+            futures = [executor.submit(self._runStagingStream) for idx in range(nStreams)]
+            for future in as_completed(futures):
+                future.result()
+
+    #  ____________________________________________________________________________
+    def _runStagingStream(self):
+        """Run one extraction stream - on its own lock holder."""
+
+        streamDbUtil = self._dbUtil.clone()
+
+        try:
+            # -- Get tape drive
+            drive = streamDbUtil.acquireSlotLock("stagingHPSS_drives", self._stageHPSS['maxDrives'])
+            if drive is None:
+                return
+
+            # -- Stage groups one after the other
+            while streamDbUtil.isLockHeld(getSlotLockName("stagingHPSS_drives", drive)):
+                stageGroup = self._claimStageGroup(streamDbUtil)
+                if stageGroup is None:
+                    break
 
-        listOfFilesToStage = []
+                isScratchSpaceLeft = self._stageGroupFromHPSS(streamDbUtil, stageGroup)
+                streamDbUtil.releaseLock("stagingHPSS_{}".format(stageGroup))
+
+                if not isScratchSpaceLeft:
+                    break
+
+            streamDbUtil.releaseSlotLock("stagingHPSS_drives", drive)
+
+        finally:
+            streamDbUtil.close()
+
+    #  ____________________________________________________________________________
+    def _claimStageGroup(self, streamDbUtil):
+        """Claim first free stage group with unstaged files - None if none is left."""
+
+        for stageGroup in sorted(self._collStageFromHPSS.distinct('stageGroup', {'stageStatus': 'unstaged'})):
+            if streamDbUtil.acquireLock("stagingHPSS_{}".format(stageGroup)):
+                return stageGroup
+
+        return None
+
+    #  ____________________________________________________________________________
+    def _stageGroupFromHPSS(self, streamDbUtil, stageGroup):
+        """Stage files of stage group in tape order.
+
+           Returns False if the scratch space is used up.
+        """
 
         ## -- Decide on to stage file or subFile
         while True:
 
+            # -- Stop if the lease of the stage group lock has been lost
+            if not streamDbUtil.isLockHeld("stagingHPSS_{}".format(stageGroup)):
+                return True
+
             # -- Check if there is enough space on disk
-            if not self._checkScratchSpaceStatus():
-                break
+            scratchSpaceLeft = self._getScratchSpaceLeft()
+            self._scratchSpaceFlag = scratchSpaceLeft >= 0
+            if not self._scratchSpaceFlag:
+                return False
 
             now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
 
@@ -484,24 +684,22 @@ class stagerSDMS:
                                                                    {'$set':{'stageStatus': 'staging',
                                                                     'timeStamp': now}}, sort=[('orderIdx', pymongo.ASCENDING)])
             if not stageDoc:
-                break
+                return True
 
-            # -- Use hsi to extract one file only
-            if not stageDoc['isInTarFile']:
-                self._extractHPSSFile(stageDoc['fileFullPath'], stageDoc['stageTarget'])
+            # -- Use hsi to extract the file - together with the following plain files
+            if not stageDoc.get('isInTarFile'):
+                self._extractHPSSFiles(self._claimHPSSFileBatch(stageDoc, scratchSpaceLeft))
 
             # -- Use htar to extract from a htar file
             else:
-                extractFileWise = False
+                tarMembers = self._getTarMembers(stageDoc['fileFullPath'], stageDoc['target'])
 
-                # -- more the 25% percent of all file need to be extracted -> Get the whole file
-                if stageDoc['filesInTar']*0.25 > len(stageDoc['listOfFiles']):
-                    extractFileWise = True
+                # -- Extract file-wise or the whole file - whatever reads less from tape
+                extractFileWise = self._isExtractFileWise(stageDoc['listOfFiles'], tarMembers,
+                                                          self._getTarFileSize(stageDoc['fileFullPath']))
 
                 self._extractHPSSTarFile(stageDoc['fileFullPath'], stageDoc['stageTarget'],
-                                         stageDoc['listOfFiles'], stageDoc['target'], extractFileWise)
-
-        self._dbUtil.unsetProcessLock("stagingHPSS_{}".format(stageGroup))
+                                         stageDoc['listOfFiles'], tarMembers, extractFileWise)
 
     #  ____________________________________________________________________________
     def _checkScratchSpaceStatus(self):
@@ -510,22 +708,22 @@ class stagerSDMS:
            Returs true if still enough space to stage more from HPSS
         """
 
-        scratchSpaceFlag = True
+        self._scratchSpaceFlag = self._getScratchSpaceLeft() >= 0
 
-        freeSpace = self._getFreeSpaceOnScratchDisk()
-        usedSpace = self._getUsedSpaceOnStagingArea()
+        return self._scratchSpaceFlag
 
-        # -- Check that freespace is larger 1 TB, otherwise set flag to false
-        if freeSpace < self._scratchFreeMin:
-            scratchSpaceFlag = False
+    #  ____________________________________________________________________________
+    def _getScratchSpaceLeft(self):
+        """Get space in GB, which can still be staged from HPSS.
 
-        # -- Check that not more than the limit is used
-        if usedSpace > self._scratchLimit:
-            scratchSpaceFlag = False
+           Limited by the minimal free space on disk (1 TB) and by the limit of
+           the used space on the staging area - negative if one is exceeded.
+        """
 
-        self._scratchSpaceFlag = scratchSpaceFlag
+        freeSpace = self._getFreeSpaceOnScratchDisk()
+        usedSpace = self._getUsedSpaceOnStagingArea()
 
-        return self._scratchSpaceFlag
+        return min(freeSpace - self._scratchFreeMin, self._scratchLimit - usedSpace)
 
     # ____________________________________________________________________________
     def _getFreeSpaceOnScratchDisk(self):
@@ -560,77 +758,217 @@ class stagerSDMS:
         return int(usedSpace / 1073741824.) # Bytes in GBytes
 
     # ____________________________________________________________________________
-    def _extractHPSSFile(self, fileFullPath, stageTarget):
-        """Extract one file only using hsi."""
+    def _claimHPSSFileBatch(self, stageDoc, scratchSpaceLeft):
+        """Claim the plain files following stageDoc in tape order - for one hsi session.
 
-        print("NOT IMPEMENTED YET")
-        #        self._collStageFromHPSS.find_one_and_update({'fileFullPath': fileFullPath)},
-        #                                                                {'$set' : {'stageStatus': 'staged'}})
+           Up to hsiBatchSize files are claimed, as long as they are not
+           interrupted by a tar file and fit in scratchSpaceLeft (in GB).
+        """
+
+        listOfStageDocs = [stageDoc]
+        bytesLeft = scratchSpaceLeft * 1073741824 - stageDoc.get('fileSize', 0)
+
+        while len(listOfStageDocs) < self._stageHPSS['hsiBatchSize']:
+            nextDoc = self._collStageFromHPSS.find_one({'stageStatus': 'unstaged', 'stageGroup': stageDoc['stageGroup']},
+                                                       sort=[('orderIdx', pymongo.ASCENDING)])
+            if not nextDoc or nextDoc.get('isInTarFile') or nextDoc.get('fileSize', 0) > bytesLeft:
+                break
+
+            now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
+            nextDoc = self._collStageFromHPSS.find_one_and_update({'_id': nextDoc['_id'], 'stageStatus': 'unstaged'},
+                                                                  {'$set':{'stageStatus': 'staging', 'timeStamp': now}})
+            if not nextDoc:
+                break
+
+            listOfStageDocs.append(nextDoc)
+            bytesLeft -= nextDoc.get('fileSize', 0)
+
+        return listOfStageDocs
 
     # ____________________________________________________________________________
-    def _extractHPSSTarFile(self, fileFullPath, stageTarget, listOfFiles, target, extractFileWise):
-        """Extract from HTAR files using htar."""
+    def _extractHPSSFiles(self, listOfStageDocs):
+        """Extract plain files with one hsi session - in the order of the list.
 
-        # -- Extract file-by-file and add it to staging target collection as staged
-        if extractFileWise:
-            isExctractSucessful = True
-
-            for targetFile in listOfFiles:
-                # -- htar of single file
-                cmdLine = 'htar -xf {0} {1}'.format(fileFullPath, targetFile)
-                cmd = shlex.split(cmdLine)
-                p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT, cwd=self._scratchSpace)
-
-                isFileExctractSucessful = False
-                for lineTerminated in iter(p.stdout.readline, b''):
-                    line = lineTerminated.decode("utf-8").rstrip('\t\n')
-                    lineCleaned = ' '.join(line.split())
-
-                    if lineCleaned == "HTAR: HTAR SUCCESSFUL":
-                        isfileExctractSucessful = True
-                        break
+           Every file is set to staged in the staging target as soon as hsi
+           reports it and its size on the scratch space matches. Files not
+           reported are set to failed.
+           """
 
-                isExctractSucessful += isfileExctractSucessful
+        stageDocs = {doc['fileFullPath']: doc for doc in listOfStageDocs}
 
-                # -- Update staging traget if extraction was successful
-                if isfileExctractSucessful:
-                    self._collsStageToStageTarget[stageTarget].find_one_and_update({'fileFullPath': targetFile},
-                                                                                   {'$set': {'stageStatusHPSS': 'staged'}})
-        # -- Extract the full file
-        else:
-            isExctractSucessful = False
+        # -- Command file of the hsi session - get <local> : <HPSS>
+        listOfGets = []
+        for doc in listOfStageDocs:
+            fullFilePathOnScratch = self._scratchSpace + doc['fileFullPath']
+            if not self._runner.replayDir:
+                os.makedirs(os.path.dirname(fullFilePathOnScratch), exist_ok=True)
+            listOfGets.append("get '{0}' : '{1}'".format(fullFilePathOnScratch, doc['fileFullPath']))
 
-            # -- htar of full file
-            cmdLine = 'htar -xf {0}'.format(fileFullPath)
-            cmd = shlex.split(cmdLine)
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT, cwd=self._scratchSpace)
+        cmdFile = self._writeCommandFile('hsiGet_', listOfGets)
 
-            for lineTerminated in iter(p.stdout.readline, b''):
-                line = lineTerminated.decode("utf-8").rstrip('\t\n')
-                lineCleaned = ' '.join(line.split())
+        # -- Not quiet (-q), which would suppress the line of every transfer
+        #    The capture is named by the files, the command file name is random
+        cmdLine = 'hsi "in {0}"'.format(cmdFile)
+        stream = self._runner.run(cmdLine, captureKey='hsi get {0}'.format(' '.join(stageDocs.keys())))
 
-                if lineCleaned == "HTAR: HTAR SUCCESSFUL":
-                    isExctractSucessful = True
-                    break
+        # -- Stream completed files to the staging target
+        #    i.e. "get  '/scratch/path' : '/path' (2016/04/29 12:00:00 5103599 bytes, 41234.5 KBS )"
+        for lineTerminated in stream:
+            lineCleaned = ' '.join(lineTerminated.decode("utf-8").split())
+
+            matchGet = HSI_GET_PATTERN.match(lineCleaned)
+            if not matchGet or matchGet.group(2) not in stageDocs:
+                continue
+
+            # -- In replay mode the files are not on the scratch space
+            doc = stageDocs.pop(matchGet.group(2))
+            try:
+                isFileComplete = self._runner.replayDir is not None or os.path.getsize(matchGet.group(1)) == int(matchGet.group(3))
+            except OSError:
+                isFileComplete = False
+
+            if not isFileComplete:
+                stageDocs[doc['fileFullPath']] = doc
+                continue
+
+            self._collsStageToStageTarget[doc['stageTarget']].find_one_and_update({'fileFullPath': doc['fileFullPath']},
+                                                                                  {'$set': {'stageStatusHPSS': 'staged'}})
+            self._collStageFromHPSS.find_one_and_update({'_id': doc['_id']}, {'$set' : {'stageStatus': 'staged'}})
+
+        stream.close()
+        if cmdFile:
+            os.remove(cmdFile)
+
+        # -- Files not extracted
+        for doc in stageDocs.values():
+            self._collStageFromHPSS.find_one_and_update({'_id': doc['_id']}, {'$set' : {'stageStatus': 'failed'}})
+
+    # ____________________________________________________________________________
+    def _getTarMembers(self, fileFullPath, target):
+        """Get members of tar file with their size."""
+
+        return {doc['fileFullPath']: doc['fileSize']
+                for doc in self._collsHPSS[target].find({'fileFullPathTar': fileFullPath},
+                                                        {'fileFullPath': True, 'fileSize': True, '_id': False})}
+
+    # ____________________________________________________________________________
+    def _getTarFileSize(self, fileFullPath):
+        """Get size of tar file from HPSS_Files - None if unknown."""
 
-            if isExctractSucessful:
-                for doc in self._collsHPSS[target].find({'fileFullPathTar': fileFullPath}):
+        doc = self._collsHPSSFiles.find_one({'fileFullPath': fileFullPath}, {'fileSize': True, '_id': False})
+        return doc.get('fileSize') if doc else None
 
-                    upsertDoc = {'fileFullPath': doc['fileFullPath'],
-                                'fileSize': doc['fileSize'],
-                                'stageDummy': True}
+    # ____________________________________________________________________________
+    def _isExtractFileWise(self, listOfFiles, tarMembers, tarFileSize):
+        """Decide on file-wise or full extraction of tar file - by the bytes read from tape.
+
+           The full extraction reads the whole tar file - all members, also
+           duplicates and non-picoDst ones. The file-wise extraction reads
+           only the requested members, but seeks to each of them - one seek
+           costs as much as reading htarSeekCost bytes.
+           """
 
-                    self._collsStageToStageTarget[stageTarget].find_one_and_update({'fileFullPath': doc['fileFullPath']},
-                                                                                   {'$set': {'stageStatusHPSS': 'staged'},
-                                                                                    '$setOnInsert': upsertDoc}, upsert = True)
+        # -- Size of the tar file in HPSS - the sum of the known members only as fallback
+        bytesAll = tarFileSize if tarFileSize else sum(tarMembers.values())
+        bytesFileWise = sum(tarMembers.get(targetFile, 0) for targetFile in listOfFiles) + \
+            len(listOfFiles) * self._stageHPSS['htarSeekCost']
+
+        return bytesFileWise < bytesAll
+
+    # ____________________________________________________________________________
+    def _extractHPSSTarFile(self, fileFullPath, stageTarget, listOfFiles, tarMembers, extractFileWise):
+        """Extract from HTAR files using htar.
+
+           File-wise, all requested members are extracted in one htar call,
+           otherwise the full file. Every member listed as extracted by htar
+           with its size is set to staged.
+           """
+
+        # -- Extract all requested files in one htar call - member list in a file
+        #    The capture is named by the members, the member list file name is random
+        if extractFileWise:
+            memberList = self._writeCommandFile('htarList_', listOfFiles)
+
+            isHtarSuccessful, extractedFiles = self._runHtarExtraction('htar -xvf {0} -L {1}'.format(fileFullPath, memberList),
+                captureKey='htar -xvf {0} {1}'.format(fileFullPath, ' '.join(listOfFiles)))
+            if memberList:
+                os.remove(memberList)
+
+        # -- Extract the full file
+        else:
+            isHtarSuccessful, extractedFiles = self._runHtarExtraction('htar -xvf {0}'.format(fileFullPath))
+
+        # -- Update staging target for every extracted file
+        #    the not requested ones of a full extraction are added as dummy
+        listOfExtractedFiles = []
+        with self._dbUtil.getBulkWriter('stageFromHPSS') as writer:
+            for targetFile in (listOfFiles if extractFileWise else tarMembers.keys()):
+                extractedSize = extractedFiles.get(targetFile.lstrip('/'))
+                if extractedSize is None or extractedSize != tarMembers.get(targetFile, extractedSize):
+                    continue
+
+                listOfExtractedFiles.append(targetFile)
+                writer.updateOne(self._collsStageToStageTarget[stageTarget], {'fileFullPath': targetFile},
+                                 {'$set': {'stageStatusHPSS': 'staged'},
+                                  '$setOnInsert': {'fileFullPath': targetFile,
+                                                   'fileSize': extractedSize,
+                                                   'stageDummy': True}}, upsert = True)
+
+        # -- Update stage status of HPSS stage collection - failed ones are checked in _checkFailedHPSS
+        setOfExtractedFiles = set(listOfExtractedFiles)
+        isExctractSucessful = isHtarSuccessful and all(targetFile in setOfExtractedFiles for targetFile in listOfFiles)
 
-        # -- Update stage status of HPSS stage collection
         stageStatus = 'staged' if isExctractSucessful else 'failed'
         self._collStageFromHPSS.find_one_and_update({'fileFullPath': fileFullPath},
                                                     {'$set' : {'stageStatus': stageStatus}})
 
+    # ____________________________________________________________________________
+    def _runHtarExtraction(self, cmdLine, captureKey = None):
+        """Run htar extraction on scratch space.
+
+           Returns if htar was successful and the extracted files - path
+           without leading '/' - with their size, from the verbose output.
+           """
+
+        stream = self._runner.run(cmdLine, captureKey=captureKey, cwd=self._scratchSpace)
+
+        isHtarSuccessful = False
+        extractedFiles = {}
+
+        for lineTerminated in stream:
+            line = lineTerminated.decode("utf-8").rstrip('\t\n')
+            lineCleaned = ' '.join(line.split())
+
+            if lineCleaned == "HTAR: HTAR SUCCESSFUL":
+                isHtarSuccessful = True
+                continue
+
+            # -- i.e. "HTAR: x /path/file.picoDst.root, 5103599 bytes, 9969 media blocks"
+            matchExtracted = HTAR_EXTRACTED_PATTERN.match(lineCleaned)
+            if matchExtracted:
+                extractedFiles[matchExtracted.group(1).lstrip('/')] = int(matchExtracted.group(2))
+
+        stream.close()
+
+        return isHtarSuccessful and stream.isSuccessful, extractedFiles
+
+    # ____________________________________________________________________________
+    def _writeCommandFile(self, prefix, listOfLines):
+        """Write command file of a hsi/htar call to the scratch space.
+
+           Returns its name - None in replay mode, where no command is run.
+           """
+
+        if self._runner.replayDir:
+            return None
+
+        with tempfile.NamedTemporaryFile('w', dir=self._scratchSpace, prefix=prefix,
+                                         suffix='.txt', delete=False) as cmdFile:
+            for line in listOfLines:
+                print(line, file=cmdFile)
+
+        return cmdFile.name
+
     # ____________________________________________________________________________
     def _checkFileSizeOfStagedFile(self, doc):
         """Check fileSize of staged file."""
@@ -649,8 +987,34 @@ class stagerSDMS:
             return False
 
     # ____________________________________________________________________________
-    def stageToXRD(self):
-        """Stage all files from stageing area to staging target."""
+    def stageToXRD(self, nTransfers = None):
+        """Stage all files from stageing area to staging target.
+
+           Runs a pool of nTransfers concurrent xrdcp transfers, the transfers
+           to each manager are capped by managerTransfers. The files are
+           claimed in batches and queued per manager. A transfer is submitted
+           to the pool only when its manager has a free slot, so no pool
+           thread waits for a busy manager. The staging targets of a file
+           are copied one after the other, the file is staged only if all
+           of them succeeded.
+
+           Before exiting, files added in the meantime are claimed.
+        """
+
+        if nTransfers is None:
+            nTransfers = self._stageXRD['nTransfers']
+
+        managerTransfers = self._stageXRD['managerTransfers']
+
+        # -- A cap of 0 would keep its files queued forever
+        if nTransfers < 1:
+            print("Error: number of XRD transfers {0} - has to be at least 1".format(nTransfers))
+            return
+
+        listOfInvalid = sorted(manager for manager, nManager in managerTransfers.items() if nManager < 1)
+        if listOfInvalid:
+            print("Error: XRD transfers of managers {0} - have to be at least 1".format(', '.join(listOfInvalid)))
+            return
 
         # -- Remove dummy files from full file stage
         self.cleanDummyStagedFiles()
@@ -658,116 +1022,212 @@ class stagerSDMS:
         stageTarget = "XRD"
         collXRD = self._collsStageToStageTarget[stageTarget]
 
-        # -- Loop over all documents in target collection
-        while True:
-            isStagingSucessful = True
-            now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
+        # -- Per manager: queue of [stageDoc, index of staging target, isStagingSucessful] and running transfers
+        readyQueues = collections.defaultdict(collections.deque)
+        nRunning = collections.defaultdict(int)
 
-            # - Get next unstaged document and set status to staging
-            stageDoc = collXRD.find_one_and_update({'stageStatusHPSS': 'staged', 'stageStatusTarget': 'unstaged'},
-                                                   {'$set':{'stageStatusTarget': 'staging', 'timeStamp':now}})
-            if not stageDoc:
-                break
+        with ThreadPoolExecutor(max_workers = nTransfers) as executor:
+            futures = {}
+            isClaimedAll = False
 
-            # -- Get stage server
-            for serverTarget in stageDoc['stageTargetList']:
-
-                # -- XRD command to copy from HPSS staging area to XRD
-                xrdcpCmd = "xrdcp {0} {1}{2} xroot://{3}//star/{4}/{5}".format(self._stageXRD['xrdcpOptions'],
-                    self._scratchSpace, stageDoc['fileFullPath'],
-                    self._stageXRD['server'][serverTarget],
-                    self._baseFolders[stageDoc['target']],
-                    stageDoc['filePath'])
-                cmd = shlex.split(xrdcpCmd)
-
-                # -- Allow for several trials : 'tryMax'
-                trial = 0
-                while trial < self._stageXRD['tryMax']:
-                    trial += 1
-                    try:
-                        output = check_output(cmd, stderr=STDOUT, timeout=self._stageXRD['timeOut'])
-
-                    # -- Except error conditions
-                    except subprocess.CalledProcessError as err:
-                        isStagingSucessful = False
-                        xrdCode = 'Unknown'
-
-                        # -- Parse output for differnt XRD error conditions
-                        for text in err.output.decode("utf-8").rstrip().split('\n'):
-                            if "file already exists" in text:
-                                xrdCode = "FileExistsAlready"
-                                break
-                            elif "no space left on device" in text:
-                                xrdCode = "NoSpaceLeftOnDevice"
-                                break
-                            elif "No such file or directory" in text:
-                                xrdCode = "NoSuchFileOrDirectory"
-                                break
-
-                        # -- File exits - not seeas as error
-                        if xrdCode == 'FileExistsAlready':
-                            isStagingSucessful = True
-                            break
+            # -- Loop over all documents in target collection
+            while True:
+                nQueued = sum(len(readyQueue) for readyQueue in readyQueues.values())
 
-                        # -- Update entry
-                        errorType = 'ErrorCode_{0}'.format(xrdCode)
-                        note = err.output.decode("utf-8").rstrip()
-                        collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
-                                                    {'$inc': {errorType: 1},
-                                                     '$set': {'trials': trial},
-                                                     '$push': {'note': note}})
+                # -- Claim next batch of documents - files waiting for their manager are at most nTransfers
+                if not isClaimedAll and len(futures) < nTransfers and nQueued < nTransfers:
+                    listOfStageDocs = self._claimStageToXRDBatch(collXRD, self._stageXRD['claimBatchSize'])
+                    if listOfStageDocs is None:
+                        isClaimedAll = True
+                    else:
+                        for stageDoc in listOfStageDocs:
+                            self._queueFileToXRD(collXRD, readyQueues, [stageDoc, 0, True])
                         continue
 
-                    # -- Except timeout
-                    except subprocess.TimeoutExpired as err:
-                        isStagingSucessful = False
-                        xrdCode = 'TimeOut'
-
-                        errorType = 'ErrorCode_{0}'.format(xrdCode)
-                        note = "Time out after {0}s".format(self._stageXRD['timeOut'])
-                        collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
-                                                    {'$inc': {errorType: 1},
-                                                     '$set': {'trials': trial},
-                                                     '$push': {'note': note}})
-                        continue
+                # -- Submit transfers of managers with free slots
+                for serverTarget, readyQueue in readyQueues.items():
+                    while readyQueue and len(futures) < nTransfers and \
+                            nRunning[serverTarget] < managerTransfers.get(serverTarget, nTransfers):
+                        item = readyQueue.popleft()
+                        nRunning[serverTarget] += 1
+                        futures[executor.submit(self._copyFileToXRD, collXRD, item[0], serverTarget)] = (serverTarget, item)
+
+                if not futures:
+                    if isClaimedAll:
+                        # -- Check for files added since the last claim before exiting
+                        listOfStageDocs = self._claimStageToXRDBatch(collXRD, self._stageXRD['claimBatchSize'])
+                        if listOfStageDocs is None:
+                            break
 
-                    except:
-                        isStagingSucessful = False
-                        xrdCode = 'OtherError'
-
-                        errorType = 'ErrorCode_{0}'.format(xrdCode)
-                        note = "Other error"
-                        collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
-                                                    {'$inc': {errorType: 1},
-                                                     '$set': {'trials': trial},
-                                                     '$push': {'note': note}})
-                        continue
+                        isClaimedAll = False
+                        for stageDoc in listOfStageDocs:
+                            self._queueFileToXRD(collXRD, readyQueues, [stageDoc, 0, True])
+                    continue
+
+                futuresDone = wait(futures.keys(), return_when = FIRST_COMPLETED).done
 
-                    # -- XRD staging successful
-                    if isStagingSucessful:
+                # -- Queue file to its next staging target or finish it
+                isAnyStaged = False
+                for future in futuresDone:
+                    serverTarget, item = futures.pop(future)
+                    nRunning[serverTarget] -= 1
+
+                    item[1] += 1
+                    item[2] = future.result() and item[2]
+                    isAnyStaged |= self._queueFileToXRD(collXRD, readyQueues, item)
+
+                # -- Tell servers have new files have been staged
+                if isAnyStaged:
+                    self._setFileHasBeenStagedToXRD()
+
+    # ____________________________________________________________________________
+    def _claimStageToXRDBatch(self, collXRD, batchSize):
+        """Claim batch of files staged from HPSS and set them to staging.
+
+           Returns list of claimed documents - None if there is nothing left.
+        """
+
+        now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
+        claimId = uuid.uuid4().hex
+
+        listOfIds = [doc['_id'] for doc in collXRD.find({'stageStatusHPSS': 'staged', 'stageStatusTarget': 'unstaged'},
+                                                        {'_id': True}).limit(batchSize)]
+        if not listOfIds:
+            return None
+
+        # -- Documents claimed in the meantime by other processes are skipped
+        collXRD.update_many({'_id': {'$in': listOfIds}, 'stageStatusHPSS': 'staged', 'stageStatusTarget': 'unstaged'},
+                            {'$set': {'stageStatusTarget': 'staging', 'timeStamp': now, 'claimId': claimId}})
+
+        return list(collXRD.find({'_id': {'$in': listOfIds}, 'claimId': claimId}))
+
+    # ____________________________________________________________________________
+    def _queueFileToXRD(self, collXRD, readyQueues, item):
+        """Queue file to the manager of its next staging target.
+
+           The item is [stageDoc, index of staging target, isStagingSucessful].
+           After the last staging target the file is finished.
+           Returns True if the file has been staged.
+        """
+
+        stageDoc, idxTarget, isStagingSucessful = item
+
+        if idxTarget < len(stageDoc['stageTargetList']):
+            readyQueues[stageDoc['stageTargetList'][idxTarget]].append(item)
+            return False
+
+        self._finishFileToXRD(collXRD, stageDoc, isStagingSucessful)
+
+        return isStagingSucessful
+
+    # ____________________________________________________________________________
+    def _copyFileToXRD(self, collXRD, stageDoc, serverTarget):
+        """Copy one file from staging area to one staging target - within a pool thread.
+
+           Returns True if the file has been copied.
+        """
+
+        isStagingSucessful = True
+
+        # -- XRD command to copy from HPSS staging area to XRD
+        xrdcpCmd = "xrdcp {0} {1}{2} xroot://{3}//star/{4}/{5}".format(self._stageXRD['xrdcpOptions'],
+            self._scratchSpace, stageDoc['fileFullPath'],
+            self._stageXRD['server'][serverTarget],
+            self._baseFolders[stageDoc['target']],
+            stageDoc['filePath'])
+        cmd = shlex.split(xrdcpCmd)
+
+        # -- Allow for several trials : 'tryMax'
+        trial = 0
+        while trial < self._stageXRD['tryMax']:
+            trial += 1
+            try:
+                output = check_output(cmd, stderr=STDOUT, timeout=self._stageXRD['timeOut'])
+
+            # -- Except error conditions
+            except subprocess.CalledProcessError as err:
+                isStagingSucessful = False
+                xrdCode = 'Unknown'
+
+                # -- Parse output for differnt XRD error conditions
+                for text in err.output.decode("utf-8").rstrip().split('\n'):
+                    if "file already exists" in text:
+                        xrdCode = "FileExistsAlready"
+                        break
+                    elif "no space left on device" in text:
+                        xrdCode = "NoSpaceLeftOnDevice"
+                        break
+                    elif "No such file or directory" in text:
+                        xrdCode = "NoSuchFileOrDirectory"
                         break
 
-            # -- Clean up on disk and update collection
-            if isStagingSucessful:
+                # -- File exits - not seeas as error
+                if xrdCode == 'FileExistsAlready':
+                    isStagingSucessful = True
+                    break
+
+                # -- Update entry
+                errorType = 'ErrorCode_{0}'.format(xrdCode)
+                note = err.output.decode("utf-8").rstrip()
+                collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
+                                            {'$inc': {errorType: 1},
+                                             '$set': {'trials': trial},
+                                             '$push': {'note': note}})
+                continue
 
-                # -- Remove file from disk
-                fullFilePathOnScratch = self._scratchSpace + stageDoc['fileFullPath']
-                try:
-                    os.remove(fullFilePathOnScratch)
-                except:
-                    pass
+            # -- Except timeout
+            except subprocess.TimeoutExpired as err:
+                isStagingSucessful = False
+                xrdCode = 'TimeOut'
 
-                # -- Set status to staged
+                errorType = 'ErrorCode_{0}'.format(xrdCode)
+                note = "Time out after {0}s".format(self._stageXRD['timeOut'])
                 collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
-                                            {'$set': {'stageStatusTarget': 'staged'}})
+                                            {'$inc': {errorType: 1},
+                                             '$set': {'trials': trial},
+                                             '$push': {'note': note}})
+                continue
 
-                # -- Tell servers have new files have been staged
-                self._setFileHasBeenStagedToXRD()
+            except:
+                isStagingSucessful = False
+                xrdCode = 'OtherError'
 
-            # -- Staging failed
-            else:
+                errorType = 'ErrorCode_{0}'.format(xrdCode)
+                note = "Other error"
                 collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
-                                            {'$set': {'stageStatusTarget': 'failed'}})
+                                            {'$inc': {errorType: 1},
+                                             '$set': {'trials': trial},
+                                             '$push': {'note': note}})
+                continue
+
+            # -- XRD staging successful
+            if isStagingSucessful:
+                break
+
+        return isStagingSucessful
+
+    # ____________________________________________________________________________
+    def _finishFileToXRD(self, collXRD, stageDoc, isStagingSucessful):
+        """Remove staged file from scratch space and set its staging status."""
+
+        # -- Clean up on disk and update collection
+        if isStagingSucessful:
+
+            # -- Remove file from disk
+            fullFilePathOnScratch = self._scratchSpace + stageDoc['fileFullPath']
+            try:
+                os.remove(fullFilePathOnScratch)
+            except:
+                pass
+
+            # -- Set status to staged
+            collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
+                                        {'$set': {'stageStatusTarget': 'staged'}})
+
+        # -- Staging failed
+        else:
+            collXRD.find_one_and_update({'fileFullPath': stageDoc['fileFullPath']},
+                                        {'$set': {'stageStatusTarget': 'failed'}})
 
     # ____________________________________________________________________________
     def _setFileHasBeenStagedToXRD(self):
@@ -783,18 +1243,17 @@ class stagerSDMS:
         for stageTarget in self._listOfStageTargets:
             collTarget = self._collsStageToStageTarget[stageTarget]
 
-            fileListToDelete = [doc['fileFullPath'] for doc in collTarget.find({'stageStatusHPSS': 'staged', 'stageDummy': True})]
-            for fileName in fileListToDelete:
-                dummyFile = self._scratchSpace + fileName
-                try:
-                     os.remove(dummyFile)
-                except:
-                    pass
+            fileListToDelete = [doc['fileFullPath'] for doc in collTarget.find({'stageStatusHPSS': 'staged', 'stageDummy': True},
+                                                                               {'fileFullPath': True})]
+            with self._dbUtil.getBulkWriter('cleanDummyStagedFiles') as writer:
+                for fileName in fileListToDelete:
+                    dummyFile = self._scratchSpace + fileName
+                    try:
+                         os.remove(dummyFile)
+                    except:
+                        pass
 
-                try:
-                    collTarget.delete_one({'fileFullPath': fileName})
-                except:
-                    pass
+                    writer.deleteOne(collTarget, {'fileFullPath': fileName})
 
     # ____________________________________________________________________________
     def _rmEmptyFoldersOnScratch(self):
@@ -865,6 +1324,8 @@ class stagerSDMS:
     def _checkFailedXRD(self):
         """Check if some failed files are left"""
 
+        writer = self._dbUtil.getBulkWriter('checkFailedXRD', ordered = True)
+
         # -- Loop over all failed Target files
         for doc in self._collXRD.find({'stageStatusTarget': 'failed'}):
 
@@ -876,8 +1337,8 @@ class stagerSDMS:
                 pass
 
             if resetFailed > 10:
-                self._collXRD.update_one({'_id': doc['_id']},
-                                         {'$set': {'stageStatusTarget': 'investigate'}})
+                writer.updateOne(self._collXRD, {'_id': doc['_id']},
+                                 {'$set': {'stageStatusTarget': 'investigate'}})
 
             # -- Get other errors than no space left on device
             otherError = []
@@ -894,17 +1355,19 @@ class stagerSDMS:
 
             # -- If file is gone from staging area (why so ever) delete entry
             if hasNoFile:
-                self._collXRD.delete_one({'_id': doc['_id']})
+                writer.deleteOne(self._collXRD, {'_id': doc['_id']})
                 continue
 
             # -- If all errors are no space left on device, reset to unstaged and increase resetFailed count
             if hasNoSpace and len(otherError) == 0:
-                self._collXRD.update_one({'_id': doc['_id']},
-                                         {'$set': {'stageStatusTarget': 'unstaged'},
-                                          '$inc': {'resetFailed': 1}})
+                writer.updateOne(self._collXRD, {'_id': doc['_id']},
+                                 {'$set': {'stageStatusTarget': 'unstaged'},
+                                  '$inc': {'resetFailed': 1}})
 
             # -- Else , set to investigate
-            self._collXRD.update_one({'_id': doc['_id']}, {'$set': {'stageStatusTarget': 'investigate'}})
+            writer.updateOne(self._collXRD, {'_id': doc['_id']}, {'$set': {'stageStatusTarget': 'investigate'}})
+
+        writer.close()
 
     # ____________________________________________________________________________
     def _checkFailedHPSS(self):
@@ -915,7 +1378,7 @@ class stagerSDMS:
             now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
 
             # - Get next unstaged document and set status to staging
-            stageDoc = self._collHPSS.find_one_and_update({'stageStatus': 'failed',
+            stageDoc = self._collHPSS.find_one_and_update({'stageStatus': 'failed'},
                                                           {'$set':{'stageStatus': 'checking', 'timeStamp': now}})
             if not stageDoc:
                 break
@@ -930,25 +1393,26 @@ class stagerSDMS:
 
                     # -- File is not to be staged ... remove it from disk
                     if not xrdDoc:
-                        os.path.rm(os.path.join(self._scratchSpace, targetFile))
+                        os.remove(os.path.join(self._scratchSpace, targetFile))
+                        continue
 
                     # -- Compare fileSize on disk and in collXRD
                     #    Check if full file had been extracted
 
                     # -- if fileSize is OK - set to staged
-                    if self._checkFileSizeOfStagedFile(targetFile, xrdDoc):
-                        collXRD.find_one_and_update({'fileFullPath': targetFile},
-                                                    {'$set': {'stageStatusHPSS': 'staged'})
+                    if self._checkFileSizeOfStagedFile(xrdDoc):
+                        self._collXRD.find_one_and_update({'fileFullPath': targetFile},
+                                                          {'$set': {'stageStatusHPSS': 'staged'}})
 
                     # -- Otherwise remove file from disk and remove entry in collXRD
                     else:
-                        os.path.rm(os.path.join(self._scratchSpace, targetFile))
-                        collXRD.delete_one({'_id': xrdDoc['_id']})
+                        os.remove(os.path.join(self._scratchSpace, targetFile))
+                        self._collXRD.delete_one({'_id': xrdDoc['_id']})
 
                 # -- File is not on disk:
                 #      Remove it from collXRD if present
                 #      Otherwise do nothing
-                else
+                else:
                     if xrdDoc:
                         self._collXRD.delete_one({'_id': xrdDoc['_id']})
 
@@ -1041,9 +1505,7 @@ class stagerSDMS:
         self._dbUtil.unsetProcessLock("staging_cycle_active")
 
         # -- remove stageing locks
-        for key in self._collProcessLocks.find_one({'unique':'unique'}).keys():
-            if 'stagingHPSS' in key:
-                self._collProcessLocks.find_one_and_update({'unique':'unique'}, {'$unset': {key: 1}})
+        self._dbUtil.unsetProcessLocks("stagingHPSS_")
 
         # -- Print staging stats
         self.printStagingStats()
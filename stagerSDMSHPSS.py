@@ -16,6 +16,7 @@ import logging as log
 import time
 import socket
 import datetime
+import argparse
 import shlex, subprocess
 from subprocess import STDOUT, check_output
 
@@ -41,10 +42,16 @@ if sys.version[0:3] < '3.0':
 def main():
     """Initialize and run"""
 
+    parser = argparse.ArgumentParser(description='Stage files from HPSS to the staging area.')
+    parser.add_argument('--record', metavar='DIR',
+                        help='write hsi/htar output to capture files in DIR - to be replayed with setReplayMode')
+    args = parser.parse_args()
+
     # -- Connect to mongoDB
     dbUtil = mongoDbUtil("", "admin")
 
     stager = stagerSDMS(dbUtil, 'stagingRequest.json')
+    stager.setReplayMode(recordDir = args.record)
 
     # -- Clean dummy staged files
     stager.cleanDummyStagedFiles()
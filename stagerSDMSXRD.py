@@ -16,6 +16,7 @@ import logging as log
 import time
 import socket
 import datetime
+import argparse
 import shlex, subprocess
 from subprocess import STDOUT, check_output
 
@@ -28,7 +29,7 @@ from pymongo import bulk
 
 from pprint import pprint
 
-from stagerSDMS import stagerSDMS
+from stagerSDMS import stagerSDMS, XRD_TRANSFERS
 
 ##############################################
 
@@ -41,6 +42,14 @@ if sys.version[0:3] < '3.0':
 def main():
     """Initialize and run"""
 
+    parser = argparse.ArgumentParser(description='Stage files from the staging area to XRD.')
+    parser.add_argument('--transfers', type=int, default=XRD_TRANSFERS,
+                        help='number of concurrent xrdcp transfers (default: {0})'.format(XRD_TRANSFERS))
+    args = parser.parse_args()
+
+    if args.transfers < 1:
+        parser.error('--transfers has to be at least 1')
+
     # -- Connect to mongoDB
     dbUtil = mongoDbUtil("", "admin")
 
@@ -50,7 +59,7 @@ def main():
     stager.cleanDummyStagedFiles()
 
     # -- Stage from staging area to staging location
-    stager.stageToXRD()
+    stager.stageToXRD(args.transfers)
 
     # -- Kill zombie xrdcp processes
     stager.killZombieXRDCP()
@@ -1,6 +1,8 @@
 #!/bin/bash
 #
 # Submit XRD staging processes 
+#  - every process runs a pool of concurrent xrdcp transfers
+#    (XRD_TRANSFERS in stagerSDMS.py), so a few are enough
 #
 # ########################################
 #
@@ -11,7 +13,7 @@
 if [ $# -gt 0 ] ; then 
     nJobs=$1
 else
-    nJobs=1000
+    nJobs=4
 fi
 
 